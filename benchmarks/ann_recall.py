@@ -0,0 +1,56 @@
+import argparse
+import time
+
+import numpy as np
+
+from wdb_rest.ann import IVFIndex
+from wdb_rest.recommendation import SimilarityEngine
+
+# Compare the approximate index against exact search: recall@k and latency for a range of probes.
+parser = argparse.ArgumentParser(description='Recall and latency of the approximate recommendation index.')
+parser.add_argument('--matrix', help='Recommendation matrix file to benchmark. Default: synthetic catalog.')
+parser.add_argument('--tracks', type=int, default=1000000, help='Size of the synthetic catalog.')
+parser.add_argument('--dims', type=int, default=7, help='Columns of the synthetic catalog.')
+parser.add_argument('--lists', type=int, default=None, help='Index lists. Default: square root of the catalog size.')
+parser.add_argument('--probes', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32, 64])
+parser.add_argument('--queries', type=int, default=200)
+parser.add_argument('-k', type=int, default=10)
+args = parser.parse_args()
+
+rng = np.random.default_rng(0)
+if args.matrix:
+    engine, _ = SimilarityEngine.load(args.matrix)
+else:
+    # Clustered synthetic data, roughly like real audio features.
+    centers = rng.normal(size=(200, args.dims))
+    matrix = centers[rng.integers(0, len(centers), size=args.tracks)] + 0.5 * rng.normal(size=(args.tracks, args.dims))
+    engine = SimilarityEngine(matrix, np.arange(1, args.tracks + 1))
+print(f"Catalog: {engine.size} tracks, {engine.matrix.shape[1]} columns.")
+
+start = time.perf_counter()
+index = IVFIndex.build(engine.matrix[:engine.size], n_lists=args.lists)
+print(f"Built index with {len(index.centroids)} lists in {time.perf_counter() - start:.2f}s.")
+
+query_ids = rng.choice(engine.track_ids[:engine.size], size=args.queries, replace=False).tolist()
+
+
+def run(probes):
+    """Return the results and latencies (ms) of all queries."""
+    results, latencies = [], []
+    for track_id in query_ids:
+        start = time.perf_counter()
+        results.append(set(engine.top_k(track_id, args.k, probes=probes)[0].tolist()))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return results, np.array(latencies)
+
+
+exact_results, exact_latencies = run(None)
+print(f"{'probes':>8} {'recall@' + str(args.k):>10} {'mean ms':>9} {'p99 ms':>9} {'speedup':>8}")
+print(f"{'exact':>8} {1.0:>10.3f} {exact_latencies.mean():>9.3f} {np.percentile(exact_latencies, 99):>9.3f} {1.0:>8.1f}")
+
+engine.set_index(index)
+for probes in args.probes:
+    results, latencies = run(probes)
+    recall = np.mean([len(result & exact) / len(exact) for result, exact in zip(results, exact_results)])
+    print(f"{probes:>8} {recall:>10.3f} {latencies.mean():>9.3f} {np.percentile(latencies, 99):>9.3f} "
+          f"{exact_latencies.mean() / latencies.mean():>8.1f}")
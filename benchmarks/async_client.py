@@ -0,0 +1,56 @@
+import argparse
+import asyncio
+import time
+
+from wdb_rest.async_client import AsyncTrackClient
+from wdb_rest.client import TrackClient, default_url
+
+# Throughput of the synchronous and the asyncio client for many reads. Start the server first.
+parser = argparse.ArgumentParser(description='Compare the synchronous and the asyncio client against a running server.')
+parser.add_argument('--url', default=default_url, help='API URL of the server. Default value: ' + default_url)
+parser.add_argument('--requests', type=int, default=1000, help='Reads per client and method.')
+parser.add_argument('--concurrency', type=int, nargs='+', default=[10, 50, 100],
+                    help='max_concurrency values of the asyncio client.')
+parser.add_argument('-k', type=int, default=10, help='Recommendations per track.')
+args = parser.parse_args()
+
+# Without revalidation, every read is a full request.
+track_ids = list(range(1, args.requests + 1))
+
+
+def run_sync():
+    """Return the seconds the synchronous client takes for both methods."""
+    with TrackClient(args.url, validator_cache_size=0) as client:
+        start = time.perf_counter()
+        for track_id in track_ids:
+            client.get_track(track_id)
+        tracks = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for track_id in track_ids:
+            client.recommend_tracks(track_id, args.k)
+        return tracks, time.perf_counter() - start
+
+
+async def run_async(max_concurrency):
+    """Return the seconds the asyncio client takes for both methods."""
+    async with AsyncTrackClient(args.url, max_concurrency=max_concurrency, validator_cache_size=0) as client:
+        # Open the connections outside of the measurement, like the warm session of the synchronous client.
+        await client.gather_tracks(track_ids[:max_concurrency])
+
+        start = time.perf_counter()
+        await client.gather_tracks(track_ids)
+        tracks = time.perf_counter() - start
+
+        start = time.perf_counter()
+        await client.gather_recommendations(track_ids, args.k)
+        return tracks, time.perf_counter() - start
+
+
+print(f"{'client':>12} {'get_track/s':>12} {'recommend/s':>12}")
+sync_tracks, sync_recommendations = run_sync()
+print(f"{'sync':>12} {args.requests / sync_tracks:>12.0f} {args.requests / sync_recommendations:>12.0f}")
+for max_concurrency in args.concurrency:
+    tracks, recommendations = asyncio.run(run_async(max_concurrency))
+    print(f"{'async ' + str(max_concurrency):>12} {args.requests / tracks:>12.0f} {args.requests / recommendations:>12.0f}"
+          f"   {sync_tracks / tracks:.1f}x {sync_recommendations / recommendations:.1f}x")
@@ -0,0 +1,93 @@
+import os
+import sqlite3
+import tempfile
+import time
+
+import numpy as np
+
+from wdb_rest.schema import create_track_table, migrate, track_columns
+
+# Synthetic track catalogs for benchmarks: reproducible from a seed and shaped roughly like the Spotify data, so
+# sorting, filtering, searching and recommending behave like on real data at any size.
+
+words = ['love', 'night', 'heart', 'dance', 'baby', 'time', 'fire', 'dream', 'blue', 'summer', 'rain', 'gold',
+         'light', 'wild', 'home', 'road', 'river', 'star', 'city', 'girl', 'boy', 'rock', 'soul', 'sweet', 'moon',
+         'shadow', 'crazy', 'happy', 'lonely', 'forever', 'beat', 'thunder', 'angel', 'money', 'paradise', 'ocean']
+decades = ['60s', '70s', '80s', '90s', '00s', '10s']
+
+# Rows generated and inserted at once.
+chunk_size = 100000
+
+
+def generate_tracks(n, seed=0, start_id=1):
+    """
+    Generate synthetic tracks.
+
+    :param int n: number of tracks
+    :param int seed: seed of the random generator, the same seed gives the same tracks
+    :param int start_id: number of the first track, part of its name
+    :return: generator of lists of tuples in the order of schema.track_columns, chunk_size tracks per list
+    """
+    rng = np.random.default_rng(seed)
+    artists = max(n // 20, 1)
+    for start in range(0, n, chunk_size):
+        size = min(chunk_size, n - start)
+        numbers = np.arange(start_id + start, start_id + start + size)
+        first, second = rng.integers(0, len(words), size=(2, size))
+        # Few artists have many tracks.
+        artist = np.minimum(rng.zipf(1.3, size=size), artists)
+        columns = [
+            [f'{words[a].title()} {words[b]} {i}' for a, b, i in zip(first, second, numbers)],
+            [f'Artist {a}' for a in artist],
+            rng.beta(5, 3, size=size).round(3).tolist(),
+            rng.integers(0, 12, size=size).tolist(),
+            # Most tracks have vocals.
+            np.where(rng.random(size) < 0.8, rng.random(size) * 0.01, rng.random(size)).round(4).tolist(),
+            np.clip(rng.normal(120, 28, size=size), 40, 220).round(3).tolist(),
+            np.clip(rng.normal(230000, 60000, size=size), 30000, 900000).astype(int).tolist(),
+            np.clip(rng.normal(45, 20, size=size), 0, 100).astype(int).tolist(),
+            [decades[d] for d in rng.integers(0, len(decades), size=size)]
+        ]
+        yield list(zip(*columns))
+
+
+def create_catalog(path, n, seed=0):
+    """
+    Create a SQLite database with n synthetic tracks, its indexes, search table and catalog version.
+
+    :param str path: path of the database file, replaced if it exists
+    :param int n: number of tracks
+    :param int seed: seed of the random generator
+    :return: None
+    """
+    for suffix in ['', '-wal', '-shm']:
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    start = time.perf_counter()
+    conn = sqlite3.connect(path)
+    create_track_table(conn)
+    insert = f'INSERT INTO track_model ({", ".join(track_columns)}) VALUES ({", ".join("?" * len(track_columns))})'
+    for rows in generate_tracks(n, seed):
+        conn.executemany(insert, rows)
+    conn.commit()
+    migrate(conn)
+    conn.close()
+    print(f'Created catalog of {n} tracks in {time.perf_counter() - start:.1f}s: {path}')
+
+
+def get_catalog(n, seed=0, directory=None):
+    """
+    Return the path of a synthetic catalog, created on first use and reused afterwards.
+
+    :param int n: number of tracks
+    :param int seed: seed of the random generator
+    :param str directory: directory of the catalogs. Default: the temporary directory of the system
+    :return: str path of the database file
+    """
+    directory = directory or tempfile.gettempdir()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'wdb-catalog-{n}-{seed}.db')
+    if not os.path.exists(path):
+        create_catalog(path, n, seed)
+    return path
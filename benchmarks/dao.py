@@ -0,0 +1,209 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from itertools import islice
+
+from benchmarks.catalog import get_catalog
+from benchmarks.stats import percentile
+
+# Latency, throughput and peak memory of the TrackDAO operations on synthetic catalogs, fully offline. Every catalog
+# size is measured in its own process, so the memory of one size does not carry over to the next.
+parser = argparse.ArgumentParser(description='Benchmark TrackDAO queries and recommendations at catalog scale.')
+parser.add_argument('--tracks', type=int, nargs='+', default=[10000, 100000],
+                    help='Catalog sizes, e.g. 10000 100000 1000000 5000000.')
+parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic catalogs and of the requests.')
+parser.add_argument('--repeat', type=int, default=50, help='Most calls per operation.')
+parser.add_argument('--max-seconds', type=float, default=5.0, help='Stop repeating an operation after this long.')
+parser.add_argument('--operations', nargs='+', help='Only run operations whose name contains one of these.')
+parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'wdb-benchmarks'),
+                    help='Directory of the catalogs and recommendation matrices, reused by later runs.')
+parser.add_argument('--output', help='Save the results to this JSON file.')
+parser.add_argument('--compare', help='JSON results of an earlier run to compare the median latencies with.')
+parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+
+def measure(name, operation, setup=None):
+    """
+    Call an operation repeatedly and once more while tracing memory.
+
+    :param str name: name of the operation
+    :param operation: function to measure, called with the result of setup
+    :param setup: function called before every call outside of the measurement, e.g. to clear a cache
+    :return: dict of results
+    """
+    def call():
+        argument = setup() if setup else None
+        start = time.perf_counter()
+        operation(argument)
+        return time.perf_counter() - start
+
+    # The first call warms up connections and caches of the database pages.
+    call()
+    latencies = []
+    started = time.perf_counter()
+    while len(latencies) < args.repeat and (not latencies or time.perf_counter() - started < args.max_seconds):
+        latencies.append(call())
+
+    # Tracing slows everything down, memory is measured in a call of its own.
+    tracemalloc.start()
+    call()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies.sort()
+    result = {'calls': len(latencies),
+              'mean_ms': statistics.mean(latencies) * 1000,
+              'p50_ms': percentile(latencies, 50) * 1000,
+              'p90_ms': percentile(latencies, 90) * 1000,
+              'p99_ms': percentile(latencies, 99) * 1000,
+              'max_ms': latencies[-1] * 1000,
+              'per_second': len(latencies) / sum(latencies),
+              'peak_memory_kib': peak / 1024}
+    print(f"{name:<44} {result['p50_ms']:>9.2f} {result['p90_ms']:>9.2f} {result['p99_ms']:>9.2f} "
+          f"{result['per_second']:>9.0f} {result['peak_memory_kib']:>10.0f}")
+    return result
+
+
+def run_child():
+    """Measure all operations on the catalog configured through the environment, print the results as JSON."""
+    # The results go to stdout, the table and the messages of the server on the way to stderr.
+    with contextlib.redirect_stdout(sys.stderr):
+        results = measure_operations()
+    # Peak resident memory of the whole process (KiB on Linux).
+    json.dump({'tracks': args.tracks[0], 'max_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               'operations': results}, sys.stdout)
+
+
+def measure_operations():
+    """Measure all operations on the catalog configured through the environment, return dict of results."""
+    from wdb_rest.server import app, track_dao
+
+    n = args.tracks[0]
+    rng = random.Random(args.seed)
+    track_ids = [rng.randint(1, n) for _ in range(1000)]
+    next_id = iter(track_ids * 1000).__next__
+    deep_page = max(n // track_dao.per_page // 2, 1)
+
+    operations = []
+    for sort_field in ['id', 'tempo', 'popularity', 'artist', 'track']:
+        operations += [
+            (f'list sort={sort_field} first page', lambda _, f=sort_field: track_dao.get_tracks_list(
+                sort_field=f, sort_order='desc', with_total=False), None),
+            (f'list sort={sort_field} page {deep_page}', lambda _, f=sort_field: track_dao.get_tracks_list(
+                sort_field=f, page=deep_page, with_total=False), None),
+            (f'list sort={sort_field} cursor page', lambda cursor, f=sort_field: track_dao.get_tracks_list(
+                sort_field=f, cursor=cursor), lambda f=sort_field: track_dao.get_tracks_list(
+                sort_field=f, cursor='')['next_cursor']),
+        ]
+    operations += [
+        ('list with total', lambda _: track_dao.get_tracks_list(), None),
+        ('list with total, count not cached', lambda _: track_dao.get_tracks_list(), track_dao.count_cache.clear),
+        ('list filter key=5 sort=tempo', lambda _: track_dao.get_tracks_list(
+            'key', '5', 'tempo', 'desc'), track_dao.count_cache.clear),
+        ('list filter artist like, not cached', lambda _: track_dao.get_tracks_list(
+            'artist', '%Artist 12%'), track_dao.count_cache.clear),
+        ('list search "love night"', lambda _: track_dao.get_tracks_list(
+            search='love night', with_total=False), None),
+        ('get track by id', lambda track_id: track_dao.get_track_by_id(track_id), next_id),
+        ('export 10000 tracks sort=tempo', lambda _: sum(len(batch) for batch in islice(
+            track_dao.export_tracks(sort_field='tempo'), 10)), None),
+        ('recommendation matrix load', lambda _: set_recommendation_matrix(), None),
+        ('recommendation matrix build', lambda _: set_recommendation_matrix(rebuild=True), None),
+        ('recommendations k=10, not cached', lambda track_id: track_dao.get_track_recommendations(
+            track_id, 10, track_dao.recommendation_engine), lambda: clear_recommendations()),
+        ('recommendations k=10, cached', lambda _: track_dao.get_track_recommendations(
+            track_ids[0], 10, track_dao.recommendation_engine), None),
+        ('batch recommendations 100x k=10, not cached', lambda _: track_dao.get_batch_track_recommendations(
+            track_ids[:100], 10, track_dao.recommendation_engine), track_dao.recommendation_cache.clear),
+    ]
+
+    def set_recommendation_matrix(rebuild=False):
+        track_dao.set_recommendation_matrix(app.config['recommendation_matrix_path'],
+                                            app.config['columns_to_be_vectorized'], rebuild=rebuild,
+                                            index_mode=app.config['recommendation_index'],
+                                            index_min_tracks=app.config['recommendation_index_min_tracks'],
+                                            index_probes=app.config['recommendation_index_probes'])
+
+    def clear_recommendations():
+        track_dao.recommendation_cache.clear()
+        return next_id()
+
+    results = {}
+    with app.app_context():
+        # The recommendation operations need the matrix, build it outside of the measurements if missing.
+        set_recommendation_matrix()
+        print(f"{f'{n} tracks':<44} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'calls/s':>9} {'peak KiB':>10}")
+        for name, operation, setup in operations:
+            if args.operations and not any(selected in name for selected in args.operations):
+                continue
+            results[name] = measure(name, operation, setup)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run():
+    """Measure every catalog size in a child process and report the results."""
+    report = {'commit': git_commit(), 'python': platform.python_version(), 'platform': platform.platform(),
+              'seed': args.seed, 'repeat': args.repeat, 'catalogs': []}
+
+    for n in args.tracks:
+        path = get_catalog(n, args.seed, args.data_dir)
+        env = dict(os.environ,
+                   WDB_REST_SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.abspath(path),
+                   WDB_REST_RECOMMENDATION_MATRIX_PATH=os.path.splitext(path)[0] + '.bin')
+        command = [sys.executable, '-m', 'benchmarks.dao', '--child', '--tracks', str(n), '--seed', str(args.seed),
+                   '--repeat', str(args.repeat), '--max-seconds', str(args.max_seconds)]
+        if args.operations:
+            command += ['--operations'] + args.operations
+        # The table goes to stderr as it is measured, the results come back as JSON on stdout.
+        child = subprocess.run(command, env=env, stdout=subprocess.PIPE, text=True, check=True)
+        report['catalogs'].append(json.loads(child.stdout.splitlines()[-1]))
+
+    if args.compare:
+        compare(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Saved results to {args.output}.')
+
+
+def compare(report):
+    """Print the median latencies next to the ones of an earlier run."""
+    with open(args.compare) as f:
+        earlier = json.load(f)
+    earlier = {catalog['tracks']: catalog['operations'] for catalog in earlier['catalogs']}
+
+    print(f"\nCompared with {args.compare}:")
+    print(f"{'operation':<44} {'before ms':>10} {'now ms':>10} {'change':>8}")
+    for catalog in report['catalogs']:
+        print(f"{catalog['tracks']} tracks")
+        for name, result in catalog['operations'].items():
+            before = earlier.get(catalog['tracks'], {}).get(name)
+            if before is None:
+                continue
+            change = result['p50_ms'] / before['p50_ms'] - 1 if before['p50_ms'] else 0.0
+            print(f"{name:<44} {before['p50_ms']:>10.2f} {result['p50_ms']:>10.2f} {change:>+8.0%}")
+
+
+if args.child:
+    run_child()
+else:
+    run()
@@ -0,0 +1,85 @@
+import argparse
+import statistics
+import subprocess
+import sys
+
+# Import time of the entry points, measured with python -X importtime in fresh interpreters. Exits with status 1 when
+# a module takes longer than its budget or imports a heavy dependency that belongs to a later code path.
+
+# Module -> (budget in milliseconds, modules it must not import).
+budgets = {
+    'wdb_rest.server': (1000, ['numpy', 'pandas', 'scipy', 'requests']),
+    'wdb_rest.client': (300, ['numpy', 'pandas', 'flask', 'sqlalchemy']),
+    'wdb_rest.async_client': (700, ['numpy', 'pandas', 'flask', 'sqlalchemy']),
+}
+
+parser = argparse.ArgumentParser(description='Check the import time of the server and the clients against budgets.')
+parser.add_argument('--modules', nargs='+', default=list(budgets), choices=list(budgets), help='Modules to import.')
+parser.add_argument('--repeat', type=int, default=5, help='Fresh interpreters per module, the median counts.')
+parser.add_argument('--budget-factor', type=float, default=1.0, help='Scale the budgets, e.g. 2 on slow machines.')
+parser.add_argument('--top', type=int, default=5, help='Slowest direct imports reported per module.')
+
+
+def import_times(module):
+    """
+    Import a module in a fresh interpreter.
+
+    :return: list of tuple(module name, cumulative microseconds, nesting level) of every imported module, in the
+             order python -X importtime reports them: a module after the modules it imported
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, check=True)
+    times = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        times.append((name.strip(), int(cumulative), level))
+    return times
+
+
+def direct_imports(times, module):
+    """Return tuple(cumulative microseconds, name) of the modules imported by module itself, slowest first."""
+    direct = []
+    for name, cumulative, level in times:
+        if level == 0:
+            # Imports of the interpreter start up are reported before the module.
+            if name == module:
+                break
+            direct = []
+        elif level == 1:
+            direct.append((cumulative, name))
+    return sorted(direct, reverse=True)
+
+
+def main():
+    args = parser.parse_args()
+    failed = False
+    print(f"{'module':>24} {'median ms':>10} {'budget ms':>10}  slowest direct imports")
+    for module in args.modules:
+        budget, forbidden = budgets[module]
+        budget *= args.budget_factor
+
+        runs = [import_times(module) for _ in range(args.repeat)]
+        median = statistics.median(cumulative for run in runs
+                                   for name, cumulative, level in run if name == module) / 1000
+        slowest = ', '.join(f'{name} {cumulative / 1000:.0f}'
+                            for cumulative, name in direct_imports(runs[-1], module)[:args.top])
+        print(f'{module:>24} {median:>10.0f} {budget:>10.0f}  {slowest}')
+
+        if median > budget:
+            print(f'{module} takes {median:.0f}ms to import, the budget is {budget:.0f}ms.')
+            failed = True
+        imported_modules = {name for name, _, _ in runs[-1]}
+        imported = [name for name in forbidden if name in imported_modules]
+        if imported:
+            print(f"{module} imports {', '.join(imported)}, import them where they are needed.")
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
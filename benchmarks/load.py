@@ -0,0 +1,277 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+from benchmarks.catalog import get_catalog
+from benchmarks.stats import percentile
+from wdb_rest.client import TrackClient
+
+# Load test of the whole stack: simulated users send a mix of reads and writes through TrackClient, against a server
+# at --url or a gunicorn server started on a copy of a synthetic catalog.
+parser = argparse.ArgumentParser(description='Drive the REST API with concurrent users and report per endpoint.')
+parser.add_argument('--url', help='API URL of a running server. Default: start a local server for the test.')
+parser.add_argument('--tracks', type=int, default=100000, help='Catalog size of the local server.')
+parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Worker processes of the local server.')
+parser.add_argument('--threads', type=int, default=4, help='Threads per worker of the local server.')
+parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'wdb-benchmarks'),
+                    help='Directory of the synthetic catalogs, see benchmarks/dao.py.')
+parser.add_argument('--concurrency', type=int, default=16, help='Simulated users sending requests.')
+parser.add_argument('--duration', type=float, default=30, help='Seconds of the test, ramp included.')
+parser.add_argument('--ramp', type=float, default=5, help='Seconds over which the users start, one after another.')
+parser.add_argument('--mix', default='list=35,get=30,recommend=15,recommend_new=5,create=5,update=5,delete=5',
+                    help='Weights of the request kinds: list, search, get, recommend, recommend_new, create, update, '
+                         'delete.')
+parser.add_argument('--revalidate', action='store_true',
+                    help='Let the clients revalidate earlier responses (304 Not Modified) like real clients do.')
+parser.add_argument('--seed', type=int, default=0, help='Seed of the requests of the users.')
+parser.add_argument('--output', help='Save the results to this JSON file.')
+
+request_kinds = ['list', 'search', 'get', 'recommend', 'recommend_new', 'create', 'update', 'delete']
+sort_fields = ['id', 'tempo', 'popularity', 'danceability', 'artist', 'track']
+search_words = ['love', 'night', 'dance', 'fire', 'summer rain', 'blue moon']
+new_track = {'track': 'Load test track', 'artist': 'Load tester', 'danceability': 0.5, 'key': 5,
+             'instrumentalness': 0.01, 'tempo': 120.0, 'duration_ms': 200000.0, 'popularity': 50, 'decade': '10s'}
+
+
+class User:
+    """Simulated user: sends requests of the mix one after another, records the latency and outcome of each."""
+
+    def __init__(self, rng, client, max_id, end):
+        """
+        Initialize object.
+
+        :param random.Random rng: random generator of the requests of this user
+        :param TrackClient client: client of this user
+        :param int max_id: highest track id of the catalog, reads pick ids up to it
+        :param float end: time.perf_counter() at which the user stops
+        """
+        self.rng = rng
+        self.client = client
+        self.max_id = max_id
+        self.end = end
+        # Tracks created by this user, the only ones it updates and deletes.
+        self.created = []
+        # Request kind -> list of tuple(seconds, error message or None).
+        self.results = {}
+
+    def list(self):
+        page = max(1, int(self.rng.expovariate(1 / 5)))
+        return self.client.get_tracks(self.rng.choice(sort_fields), self.rng.choice(['asc', 'desc']), page=page)
+
+    def search(self):
+        return self.client.get_tracks(search=self.rng.choice(search_words), with_total=False)
+
+    def get(self):
+        return self.client.get_track(self.rng.randint(1, self.max_id))
+
+    def recommend(self):
+        return self.client.recommend_tracks(self.rng.randint(1, self.max_id), 10)
+
+    def recommend_new(self):
+        # Recommendations for a track created moments ago, possibly by another worker process of the server.
+        if not self.created:
+            return self.create()
+        return self.client.recommend_tracks(self.created[-1]['id'], 10)
+
+    def create(self):
+        track, status = self.client.create_track(new_track)
+        if status == 201:
+            self.created.append(track)
+        return track, status
+
+    def update(self):
+        if not self.created:
+            return self.create()
+        track = dict(self.rng.choice(self.created), tempo=round(self.rng.uniform(60, 200), 3))
+        return self.client.update_track(track)
+
+    def delete(self):
+        if not self.created:
+            return self.create()
+        track = self.created.pop(self.rng.randrange(len(self.created)))
+        return self.client.delete_track(track['id'])
+
+    def run(self, kinds, weights):
+        while time.perf_counter() < self.end:
+            kind = self.rng.choices(kinds, weights)[0]
+            start = time.perf_counter()
+            try:
+                response, status = getattr(self, kind)()
+                error = None
+                if status >= 400:
+                    error = f"{status} {response.get('msg', response) if isinstance(response, dict) else ''}"
+            except Exception as e:
+                error = type(e).__name__ + ': ' + str(e)
+            self.results.setdefault(kind, []).append((time.perf_counter() - start, error))
+
+    def cleanup(self):
+        # Remove the tracks created by the test.
+        for i in range(0, len(self.created), 1000):
+            self.client.delete_tracks([track['id'] for track in self.created[i:i + 1000]])
+        self.client.close()
+
+
+def parse_mix(mix):
+    """
+    Parse the request mix.
+
+    :param str mix: comma separated kind=weight pairs, e.g. 'list=3,get=1'
+    :return: dict of request kind -> weight
+    """
+    weights = dict((kind, float(weight)) for kind, weight in (item.split('=') for item in mix.split(',')))
+    for kind in weights:
+        if kind not in request_kinds:
+            raise Exception(f'Unknown request kind {kind} in --mix.')
+    return weights
+
+
+def start_server(tracks, workers, threads, data_dir):
+    """
+    Start gunicorn on a copy of a synthetic catalog.
+
+    :param int tracks: catalog size
+    :param int workers: worker processes
+    :param int threads: threads per worker
+    :param str data_dir: directory of the synthetic catalogs
+    :return: tuple(API URL, server process, temporary directory)
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='wdb-load-test-')
+    database = os.path.join(tmp_dir, 'database.db')
+    shutil.copy(get_catalog(tracks, directory=data_dir), database)
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ,
+               PYTHONPATH=root,
+               WDB_REST_SQLALCHEMY_DATABASE_URI='sqlite:///' + database,
+               WDB_REST_RECOMMENDATION_MATRIX_PATH=os.path.join(tmp_dir, 'recommendation_matrix.bin'),
+               WDB_REST_BIND=f'127.0.0.1:{port}',
+               WDB_REST_THREADS=str(threads),
+               WEB_CONCURRENCY=str(workers))
+    log = open(os.path.join(tmp_dir, 'server.log'), 'w')
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py'], cwd=root, env=env,
+                              stdout=log, stderr=subprocess.STDOUT)
+
+    # Wait for the warm-up, building the recommendation matrix of a large catalog takes a while.
+    deadline = time.monotonic() + 600
+    while True:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/ready', timeout=1)
+            break
+        except OSError:
+            if server.poll() is not None or time.monotonic() > deadline:
+                server.kill()
+                raise Exception(f'Server did not start, see {log.name}.')
+            time.sleep(0.2)
+    print(f'Started {workers} workers with {threads} threads on {tracks} tracks, log: {log.name}')
+    return f'http://127.0.0.1:{port}/api/', server, tmp_dir
+
+
+def run(url, mix, concurrency, duration, ramp, seed=0, revalidate=False):
+    """
+    Run the users against the server.
+
+    :param str url: API URL of the server
+    :param dict mix: request kind -> weight
+    :param int concurrency: number of users
+    :param float duration: seconds of the test, ramp included
+    :param float ramp: seconds over which the users start
+    :param int seed: seed of the requests of the users
+    :param bool revalidate: let the clients revalidate earlier responses
+    :return: tuple(dict of request kind -> results, elapsed seconds)
+    """
+    with TrackClient(url) as client:
+        max_id = client.get_tracks(sort_field='id', sort_order='desc', with_total=False)[0]['items'][0]['id']
+
+    start = time.perf_counter()
+    end = start + duration
+    # Clients do not retry, so every failure shows up in the results.
+    users = [User(random.Random(seed * 100000 + i),
+                  TrackClient(url, validator_cache_size=1000 if revalidate else 0, pool_size=1, retries=0),
+                  max_id, end) for i in range(concurrency)]
+    threads = []
+    for i, user in enumerate(users):
+        # Users start one after another over the ramp.
+        delay = start + ramp * i / concurrency - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        thread = threading.Thread(target=user.run, args=(list(mix), list(mix.values())))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    for user in users:
+        user.cleanup()
+
+    results = {}
+    for kind in mix:
+        samples = [sample for user in users for sample in user.results.get(kind, [])]
+        if not samples:
+            continue
+        latencies = sorted(seconds for seconds, _ in samples)
+        errors = [error for _, error in samples if error is not None]
+        results[kind] = {'requests': len(samples),
+                         'per_second': len(samples) / elapsed,
+                         'error_rate': len(errors) / len(samples),
+                         'p50_ms': percentile(latencies, 50) * 1000,
+                         'p90_ms': percentile(latencies, 90) * 1000,
+                         'p99_ms': percentile(latencies, 99) * 1000,
+                         'max_ms': latencies[-1] * 1000,
+                         'errors': sorted(set(errors))[:5]}
+    return results, elapsed
+
+
+def report(results, elapsed):
+    print(f"{'request':<14} {'requests':>9} {'req/s':>8} {'errors':>7} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} "
+          f"{'max ms':>8}")
+    for kind, result in results.items():
+        print(f"{kind:<14} {result['requests']:>9} {result['per_second']:>8.1f} {result['error_rate']:>7.1%} "
+              f"{result['p50_ms']:>8.1f} {result['p90_ms']:>8.1f} {result['p99_ms']:>8.1f} {result['max_ms']:>8.1f}")
+    total = sum(result['requests'] for result in results.values())
+    errors = sum(result['requests'] * result['error_rate'] for result in results.values())
+    print(f"{'total':<14} {total:>9} {total / elapsed:>8.1f} {errors / max(total, 1):>7.1%}")
+    for kind, result in results.items():
+        for error in result['errors']:
+            print(f'{kind} error: {error}')
+
+
+def main():
+    args = parser.parse_args()
+    mix = parse_mix(args.mix)
+
+    server, tmp_dir = None, None
+    url = args.url
+    if url is None:
+        url, server, tmp_dir = start_server(args.tracks, args.workers, args.threads, args.data_dir)
+    try:
+        print(f'{args.concurrency} users for {args.duration:.0f}s (ramp {args.ramp:.0f}s), mix {args.mix}')
+        results, elapsed = run(url, mix, args.concurrency, args.duration, args.ramp, args.seed, args.revalidate)
+        report(results, elapsed)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump({'url': args.url, 'tracks': args.tracks if args.url is None else None,
+                           'workers': args.workers if args.url is None else None, 'threads': args.threads,
+                           'concurrency': args.concurrency, 'duration': elapsed, 'ramp': args.ramp, 'mix': args.mix,
+                           'revalidate': args.revalidate, 'results': results}, f, indent=2)
+            print(f'Saved results to {args.output}.')
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,9 @@
+# Statistics shared by the benchmarks.
+
+
+def percentile(values, p):
+    """Return the p-th percentile of sorted values, interpolated between the closest ranks."""
+    position = (len(values) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
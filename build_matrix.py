@@ -0,0 +1,14 @@
+import argparse
+
+from wdb_rest.server import app, track_dao
+
+# Build the recommendation matrix ahead of time, so the server does not have to build it on the first request.
+parser = argparse.ArgumentParser(description='Build the recommendation matrix from the track database.')
+parser.add_argument('--path', default=app.config['recommendation_matrix_path'],
+                    help='Where to save the matrix. Default value: recommendation_matrix_path of the server.')
+args = parser.parse_args()
+
+with app.app_context():
+    track_dao.set_recommendation_matrix(args.path, app.config['columns_to_be_vectorized'], rebuild=True,
+                                        index_mode=app.config['recommendation_index'],
+                                        index_min_tracks=app.config['recommendation_index_min_tracks'])
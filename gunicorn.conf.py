@@ -0,0 +1,50 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+# Production server settings, run from the root of the project with: gunicorn -c gunicorn.conf.py
+
+# Create and warm up the application once in the master, before the workers are forked from it.
+wsgi_app = 'wdb_rest.wsgi:create_app()'
+preload_app = True
+
+bind = os.environ.get('WDB_REST_BIND', '0.0.0.0:5000')
+
+# One worker process per core serves the CPU bound work (JSON encoding, recommendations) in parallel, its threads
+# overlap the waits for the database and the network.
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('WDB_REST_THREADS', 4))
+
+# Long exports stream for a while, the timeout only ends workers that stopped responding.
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+
+# Every worker keeps its own metrics, they write snapshots to a shared directory that /metrics merges, so a scrape
+# answered by any worker reports the requests of all of them.
+os.environ.setdefault('WDB_REST_METRICS_DIR', os.path.join(tempfile.gettempdir(), f'wdb-metrics-{os.getpid()}'))
+
+
+def on_starting(server):
+    from wdb_rest import metrics
+    # Snapshots of an earlier server would be added to the counters. The master's snapshot holds the counts of the
+    # warm-up, its gauges (cache sizes, requests in flight) do not change once the workers serve the requests.
+    metrics.remove_snapshots(os.environ['WDB_REST_METRICS_DIR'])
+    metrics.default_registry.write(os.environ['WDB_REST_METRICS_DIR'], gauges=False)
+
+
+def post_fork(server, worker):
+    from wdb_rest.server import start_metrics_export
+    start_metrics_export()
+
+
+def worker_exit(server, worker):
+    from wdb_rest import metrics
+    # The last requests of the worker, its counters stay in the merged metrics.
+    metrics.default_registry.write(os.environ['WDB_REST_METRICS_DIR'])
+
+
+def on_exit(server):
+    shutil.rmtree(os.environ['WDB_REST_METRICS_DIR'], ignore_errors=True)
@@ -1,39 +1,121 @@
-import pandas as pd
+import argparse
+import os
 import sqlite3
+import time
+
+import pandas as pd
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from wdb_rest.recommendation import FeatureEncoder, SimilarityEngine
+from wdb_rest.schema import create_track_table_sql, indexed_columns, migrate, track_columns
+from wdb_rest.server import app, track_dao
+
+# Import the Spotify tracks from a CSV file. The file is streamed in chunks, all rows are written in one transaction
+# and the indexes and the search table are built in it once the rows are loaded, the recommendation matrix after it.
+parser = argparse.ArgumentParser(description='Import tracks from a CSV file into the track database.')
+parser.add_argument('--csv', default='data/spotify_dataset.csv',
+                    help='CSV file with the track columns and optionally an id column. '
+                         'Default value: data/spotify_dataset.csv')
+parser.add_argument('--database', default='database.db', help='Path to the SQLite database. Default value: database.db')
+parser.add_argument('--upsert', action='store_true',
+                    help='Insert new tracks and update existing ones instead of replacing all tracks.')
+parser.add_argument('--keep-indexes', action='store_true',
+                    help='With --upsert, update the indexes and the search table row by row instead of rebuilding '
+                         'them after the load, faster for upserts of a few tracks into a large catalog.')
+parser.add_argument('--chunk-size', type=int, default=50000, help='Rows read and inserted at once.')
+parser.add_argument('--matrix', default=app.config['recommendation_matrix_path'],
+                    help='Where to save the recommendation matrix. Default value: recommendation_matrix_path of the '
+                         'server.')
+parser.add_argument('--no-matrix', action='store_true', help='Do not build the recommendation matrix.')
+args = parser.parse_args()
+
+columns_to_be_vectorized = app.config['columns_to_be_vectorized']
+# Page cache of the import connection (KiB), building the indexes sorts the whole table.
+cache_size_kib = 262144
+
+header = pd.read_csv(args.csv, nrows=0).columns
+missing = [column for column in track_columns if column not in header]
+if missing:
+    raise Exception(f'{args.csv} lacks the columns {", ".join(missing)}.')
+# Without an id column a track is identified by its row in the file, the first row gets id 1.
+has_ids = 'id' in header
+
+insert = (f'INSERT INTO track_model (id, {", ".join(track_columns)}) '
+          f'VALUES ({", ".join("?" * (len(track_columns) + 1))})')
+if args.upsert:
+    insert += f' ON CONFLICT(id) DO UPDATE SET {", ".join(f"{c} = excluded.{c}" for c in track_columns)}'
+
+# Autocommit mode, the transaction is started and committed explicitly.
+conn = sqlite3.connect(args.database, isolation_level=None)
+conn.execute(f'PRAGMA cache_size = -{cache_size_kib}')
+conn.execute('BEGIN IMMEDIATE')
+
+# Updating the indexes and the search table row by row is much slower than building them after the load. They are
+# dropped and rebuilt in the transaction (DDL is transactional in SQLite), a failed import leaves the database as it
+# was.
+if not args.upsert:
+    conn.execute('DROP TABLE IF EXISTS track_model')
+conn.execute(create_track_table_sql)
+if not (args.upsert and args.keep_indexes):
+    for column in indexed_columns:
+        conn.execute(f'DROP INDEX IF EXISTS ix_track_model_{column}')
+    for trigger in ['insert', 'delete', 'update']:
+        conn.execute(f'DROP TRIGGER IF EXISTS track_search_{trigger}')
+    conn.execute('DROP TABLE IF EXISTS track_search')
+
+start = time.perf_counter()
+rows, skipped = 0, 0
+# The vectorized columns of the imported tracks, a full import builds the recommendation matrix from them.
+features = []
+for chunk in pd.read_csv(args.csv, usecols=(['id'] if has_ids else []) + track_columns, chunksize=args.chunk_size):
+    if not has_ids:
+        # The index of the chunks continues from chunk to chunk.
+        chunk.insert(0, 'id', chunk.index + 1)
+    size = len(chunk)
+    chunk = chunk.dropna()
+    skipped += size - len(chunk)
+
+    conn.executemany(insert, zip(*(chunk[column].tolist() for column in ['id'] + track_columns)))
+    if not args.upsert and not args.no_matrix:
+        features.append(chunk[['id'] + columns_to_be_vectorized])
+    rows += len(chunk)
+    print(f'Imported {rows} rows, {rows / (time.perf_counter() - start):.0f} rows/s.')
+
+load_seconds = time.perf_counter() - start
+print(f'Imported {rows} rows from {args.csv} in {load_seconds:.2f}s ({rows / load_seconds:.0f} rows/s), '
+      f'skipped {skipped} rows with missing values.')
+
+# Let the servers know the tracks changed, so they do not answer conditional requests from their caches.
+if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'catalog_version'").fetchone() is not None:
+    conn.execute('UPDATE catalog_version SET version = version + 1, modified = ?', (time.time(),))
+# Create the indexes, the search table and the catalog version, committed together with the rows.
+index_start = time.perf_counter()
+migrate(conn, commit=False)
+conn.execute('COMMIT')
+print(f'Built indexes and search table in {time.perf_counter() - index_start:.2f}s.')
+
+if not args.no_matrix:
+    matrix_start = time.perf_counter()
+    if args.upsert:
+        # Tracks that are not in the file belong into the matrix too, read the whole catalog.
+        df = pd.read_sql(f'SELECT id, {", ".join(columns_to_be_vectorized)} FROM track_model ORDER BY id', conn)
+    else:
+        # Rows ordered by id let the engine find tracks by binary search.
+        df = pd.concat(features).sort_values('id') if features else pd.DataFrame()
+    if df.empty:
+        print('No tracks for a recommendation matrix.')
+    else:
+        encoder, recommendation_matrix = FeatureEncoder.fit_transform(df, columns_to_be_vectorized)
+        # The fingerprint is computed like the server does, so the server loads the matrix instead of rebuilding it.
+        engine = create_engine('sqlite:///' + os.path.abspath(args.database))
+        with Session(engine) as session:
+            fingerprint = track_dao.get_catalog_fingerprint(columns_to_be_vectorized, session)
+        engine.dispose()
+        version, = conn.execute('SELECT version FROM catalog_version').fetchone()
+        SimilarityEngine(recommendation_matrix, df['id'].to_numpy(), encoder).save(args.matrix, fingerprint, version)
+        print(f'Saved {recommendation_matrix.shape[0]}x{recommendation_matrix.shape[1]} recommendation matrix to '
+              f'{args.matrix} in {time.perf_counter() - matrix_start:.2f}s.')
 
-# Connect to the database.
-# Create pandas df.
-df = pd.read_csv('data/spotify_dataset.csv')
-df = df.reset_index()
-df = df.rename(columns={'index': 'id'})
-
-# Connect to database.
-conn = sqlite3.connect('database.db')
-
-# Create table needed for import from Pandas dataframe.
-create_table_sql = '''
-CREATE TABLE "track_model" (
-  "id" INTEGER PRIMARY KEY AUTOINCREMENT,
-  "track" TEXT NOT NULL,
-  "artist" TEXT NOT NULL,
-  "danceability" REAL NOT NULL,
-  "key" INTEGER NOT NULL,
-  "instrumentalness" REAL NOT NULL,
-  "tempo" REAL NOT NULL,
-  "duration_ms" INTEGER NOT NULL,
-  "popularity" INTEGER NOT NULL,
-  "decade" TEXT NOT NULL
-)
-'''
-
-
-c = conn.cursor()
-# Delete table if already exists.
-c.execute("DROP TABLE IF EXISTS track_model")
-# Execute create table query.
-c.execute(create_table_sql)
-
-# Store pandas df to database. Select only columns of interest.
-df = pd.read_csv('data/spotify_dataset.csv')[['track', 'artist', 'danceability', 'key', 'instrumentalness',
-                                              'tempo', 'duration_ms', 'popularity', 'decade']]
-df.to_sql('track_model', conn, if_exists='append', index=False)
+conn.close()
+print(f'Done in {time.perf_counter() - start:.2f}s.')
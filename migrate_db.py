@@ -0,0 +1,14 @@
+import argparse
+import sqlite3
+
+from wdb_rest.schema import migrate
+
+# Add the indexes, the search table and the catalog version to a database that was imported before they existed.
+parser = argparse.ArgumentParser(description='Create the indexes, search table and catalog version of the track database.')
+parser.add_argument('--database', default='database.db', help='Path to the SQLite database. Default value: database.db')
+args = parser.parse_args()
+
+conn = sqlite3.connect(args.database)
+migrate(conn)
+conn.close()
+print(f'Migrated {args.database}.')
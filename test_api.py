@@ -1,5 +1,7 @@
-import json
 import unittest
+
+import requests
+
 from wdb_rest.client import TrackClient
 
 
@@ -166,11 +168,167 @@ class IntegrationTests(unittest.TestCase):
         self.assertEqual(500, status_code)
         self.assertEqual(response['msg'], 'Invalid track id or track not found.')
 
+    def test_get_batch_recommendations_success(self):
+        response, status_code = self.client.recommend_tracks_batch([42, 43, self.invalid_track_id], 12)
+        self.assertEqual(200, status_code)
+        self.assertEqual(3, len(response))
+
+        # Results come back in request order, with the same recommendations as single requests.
+        single_response, _ = self.client.recommend_tracks(42, 12)
+        self.assertEqual(42, response[0]['track_id'])
+        self.assertEqual(single_response, response[0]['recommendations'])
+        self.assertEqual(12, len(response[1]['recommendations']))
+
+        self.assertEqual(response[2]['msg'], 'Invalid track id or track not found.')
+
+    def test_get_batch_recommendations_fail(self):
+        response, status_code = self.client.recommend_tracks_batch(list(range(1, 1002)), 1)
+        self.assertEqual(400, status_code)
+
+    def test_bulk_writes(self):
+        response, status_code = self.client.create_tracks([self.track, {'track': 'Incomplete'}, 'Track', None])
+        self.assertEqual(200, status_code)
+        self.assertEqual([201, 400, 400, 400], [result['status'] for result in response])
+        self.assertEqual('Track must be an object.', response[2]['msg'])
+        created_track = response[0]['track']
+
+        created_track['tempo'] = 99.0
+        response, status_code = self.client.update_tracks([created_track])
+        self.assertEqual(200, response[0]['status'])
+        self.assertEqual(99.0, self.client.get_track(created_track['id'])[0]['tempo'])
+
+        response, status_code = self.client.delete_tracks([created_track['id'], self.invalid_track_id])
+        self.assertEqual([200, 404], [result['status'] for result in response])
+        self.assertEqual(500, self.client.get_track(created_track['id'])[1])
+
+    def test_conditional_reads(self):
+        created_track, status_code = self.client.create_track(self.track)
+        track_id = created_track['id']
+
+        # The second read is revalidated with the ETag of the first one.
+        not_modified = self.client.not_modified
+        first, status_code = self.client.get_track(track_id)
+        second, status_code = self.client.get_track(track_id)
+        self.assertEqual(200, status_code)
+        self.assertEqual(first, second)
+        self.assertEqual(not_modified + 1, self.client.not_modified)
+
+        # A write changes the ETag, the next read gets the new data.
+        self.client.update_track(dict(first, tempo=123.0))
+        third, status_code = self.client.get_track(track_id)
+        self.assertEqual(123.0, third['tempo'])
+        self.assertEqual(not_modified + 1, self.client.not_modified)
+
+        self.client.delete_track(track_id)
+
+    def test_not_modified_response(self):
+        r = requests.get(self.client.url + 'tracks/', params={'page': 2})
+        self.assertIn('ETag', r.headers)
+        self.assertIn('Last-Modified', r.headers)
+
+        r = requests.get(self.client.url + 'tracks/', params={'page': 2}, headers={'If-None-Match': r.headers['ETag']})
+        self.assertEqual(304, r.status_code)
+        self.assertEqual(b'', r.content)
+
+    def test_html_views(self):
+        server_url = self.client.url[:-len('api/')]
+
+        r = requests.get(server_url + 'alltracks/', params={'page': 2})
+        self.assertEqual(200, r.status_code)
+        self.assertIn('Page 2', r.text)
+
+        r = requests.post(server_url + 'recommendation/', data={'track_id': 1})
+        self.assertEqual(200, r.status_code)
+        self.assertEqual(self.client.recommend_tracks(1, 10)[0], r.json())
+
+    def test_ready(self):
+        server_url = self.client.url[:-len('api/')]
+
+        # The server warms up in the background and reports ready once it is done.
+        r = requests.get(server_url + 'ready')
+        self.assertEqual(200, r.status_code)
+        self.assertEqual({'ready': True}, r.json())
+
+    def test_metrics(self):
+        server_url = self.client.url[:-len('api/')]
+        self.client.get_track(1)
+
+        r = requests.get(server_url + 'metrics')
+        self.assertEqual(200, r.status_code)
+        self.assertTrue(r.headers['Content-Type'].startswith('text/plain'))
+        self.assertIn('wdb_http_request_duration_seconds_count{endpoint="track",method="GET"}', r.text)
+        self.assertIn('wdb_sql_statements_total{kind="select"}', r.text)
+        self.assertIn('wdb_cache_hit_ratio{cache="recommendation"}', r.text)
+
     def test_get_all_tracks_sorting(self):
 
         #check if sorting asc/desc yields different search results based on sort_field
         tracks_asc, status_code = self.client.get_tracks(sort_order = "asc", sort_field = "tempo")
         tracks_desc, status_code = self.client.get_tracks(sort_order = "desc", sort_field = "tempo")
-        first_item_asc = json.loads(tracks_asc["items"])[0]
-        first_item_desc = json.loads(tracks_desc["items"])[0]
+        first_item_asc = tracks_asc["items"][0]
+        first_item_desc = tracks_desc["items"][0]
         self.assertGreater(first_item_desc["tempo"], first_item_asc["tempo"])
+
+
+    def test_get_all_tracks_cursor(self):
+        first_page, status_code = self.client.get_tracks(sort_order="desc", sort_field="tempo", cursor='')
+        self.assertEqual(200, status_code)
+        second_page, status_code = self.client.get_tracks(sort_order="desc", sort_field="tempo",
+                                                          cursor=first_page['next_cursor'])
+        self.assertEqual(200, status_code)
+
+        # The second page continues where the first one stopped.
+        last_item_first = first_page["items"][-1]
+        first_item_second = second_page["items"][0]
+        self.assertGreaterEqual(last_item_first["tempo"], first_item_second["tempo"])
+        self.assertNotEqual(last_item_first["id"], first_item_second["id"])
+
+
+    def test_get_all_tracks_without_total(self):
+        tracks, status_code = self.client.get_tracks(sort_field="tempo", with_total=False)
+        self.assertEqual(200, status_code)
+        self.assertNotIn('tracks_iter', tracks)
+        self.assertTrue(tracks['has_next'])
+        self.assertEqual(10, len(tracks['items']))
+
+
+    def test_get_all_tracks_search(self):
+        tracks, status_code = self.client.get_tracks(search='track 12')
+        self.assertEqual(200, status_code)
+        items = tracks['items']
+        self.assertGreater(len(items), 0)
+        for item in items:
+            self.assertIn('12', item['track'] + ' ' + item['artist'])
+
+
+    def test_export_tracks(self):
+        tracks, status_code = self.client.get_tracks(sort_field="tempo", with_total=False)
+        exported = self.client.export_tracks(sort_field="tempo")
+        self.assertEqual(tracks['items'], [next(exported) for _ in range(10)])
+
+        # CSV has the same tracks, with every value as a string.
+        exported_csv = self.client.export_tracks(sort_field="tempo", export_format='csv')
+        self.assertEqual([str(item['id']) for item in tracks['items']],
+                         [next(exported_csv)['id'] for _ in range(10)])
+
+        # Both formats export the whole catalog.
+        self.assertEqual(len(list(exported)), len(list(exported_csv)))
+
+
+    def test_iter_tracks(self):
+        # Few prefetched pages, so the pool has to keep submitting pages while the tracks are consumed.
+        tracks = list(self.client.iter_tracks(sort_field="tempo", sort_order="desc", prefetch=3))
+        self.assertEqual([track['id'] for track in self.client.export_tracks(sort_field="tempo", sort_order="desc")],
+                         [track['id'] for track in tracks])
+
+        # Stopping early is fine.
+        first = next(self.client.iter_tracks(sort_field="tempo", sort_order="desc"))
+        self.assertEqual(tracks[0], first)
+
+    def test_iter_tracks_fail(self):
+        with self.assertRaises(Exception):
+            list(self.client.iter_tracks(sort_field="unknown"))
+
+    def test_export_tracks_fail(self):
+        with self.assertRaises(Exception):
+            list(self.client.export_tracks(sort_field="tempo", export_format='xml'))
@@ -0,0 +1,126 @@
+import asyncio
+import unittest
+
+import aiohttp
+
+from wdb_rest.async_client import AsyncTrackClient
+from wdb_rest.client import TrackClient
+
+
+class AsyncIntegrationTests(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.track = {
+            'track': 'Testing track',
+            'artist': 'tester',
+            'danceability': 1.0,
+            'key': 2,
+            'instrumentalness': 3.0,
+            'tempo': 4.0,
+            'duration_ms': 5.0,
+            'popularity': 6.0,
+            'decade': '70s'
+        }
+
+        self.client = AsyncTrackClient(max_concurrency=8)
+        # The synchronous client gives the expected results.
+        self.sync_client = TrackClient()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        self.sync_client.close()
+
+    async def test_track_crud(self):
+        created_track, status_code = await self.client.create_track(self.track)
+        self.assertEqual(201, status_code)
+
+        track, status_code = await self.client.get_track(created_track['id'])
+        self.assertEqual(created_track, track)
+
+        track, status_code = await self.client.update_track(dict(track, tempo=123.0))
+        self.assertEqual(200, status_code)
+        self.assertEqual(123.0, track['tempo'])
+
+        response, status_code = await self.client.delete_track(created_track['id'])
+        self.assertEqual(200, status_code)
+        response, status_code = await self.client.get_track(created_track['id'])
+        self.assertEqual(500, status_code)
+
+    async def test_gather_tracks(self):
+        track_ids = list(range(1, 51)) + [99999999]
+        results = await self.client.gather_tracks(track_ids)
+
+        self.assertEqual(len(track_ids), len(results))
+        for track_id, (track, status_code) in zip(track_ids[:-1], results):
+            self.assertEqual(200, status_code)
+            self.assertEqual(self.sync_client.get_track(track_id)[0], track)
+        self.assertEqual(500, results[-1][1])
+
+        # Repeated reads are revalidated.
+        await self.client.gather_tracks(track_ids[:10])
+        self.assertEqual(10, self.client.not_modified)
+
+    async def test_gather_recommendations(self):
+        results = await self.client.gather_recommendations([1, 2, 3], 5)
+        for track_id, (recommendations, status_code) in zip([1, 2, 3], results):
+            self.assertEqual(200, status_code)
+            self.assertEqual(self.sync_client.recommend_tracks(track_id, 5)[0], recommendations)
+
+        response, status_code = await self.client.recommend_tracks_batch([1, 2], 5)
+        self.assertEqual([recommendations for recommendations, _ in results[:2]],
+                         [result['recommendations'] for result in response])
+
+    async def test_iter_and_export_tracks(self):
+        expected = [track['id'] for track in self.sync_client.export_tracks(sort_field='tempo')]
+
+        iterated = [track['id'] async for track in self.client.iter_tracks(sort_field='tempo', prefetch=3)]
+        self.assertEqual(expected, iterated)
+
+        exported = [int(track['id']) async for track in self.client.export_tracks(sort_field='tempo',
+                                                                                   export_format='csv')]
+        self.assertEqual(expected, exported)
+
+    async def test_concurrency_is_bounded(self):
+        await self.client.get_tracks()
+        self.assertEqual(8, self.client.semaphore._value)
+
+        # More reads than allowed in flight, all of them complete.
+        results = await asyncio.gather(*(self.client.get_tracks(page=page) for page in range(1, 41)))
+        self.assertTrue(all(status_code == 200 for _, status_code in results))
+        self.assertEqual(8, self.client.semaphore._value)
+
+
+class AsyncRetryTests(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        # Server that reads every request and closes the connection without answering.
+        self.received = []
+
+        async def disconnect(reader, writer):
+            self.received.append((await reader.readline()).decode().split()[0])
+            writer.close()
+
+        self.server = await asyncio.start_server(disconnect, '127.0.0.1', 0)
+        port = self.server.sockets[0].getsockname()[1]
+        self.client = AsyncTrackClient(f'http://127.0.0.1:{port}/api/', retries=2, backoff_factor=0)
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def test_retry_read_after_disconnect(self):
+        with self.assertRaises(aiohttp.ClientConnectionError):
+            await self.client.get_track(1)
+        self.assertEqual(['GET'] * 3, self.received)
+
+    async def test_no_retry_of_received_create(self):
+        # The server may have created the track before the connection broke, sending it again could duplicate it.
+        with self.assertRaises(aiohttp.ClientConnectionError):
+            await self.client.create_track({'track': 'Testing track'})
+        self.assertEqual(['PUT'], self.received)
+        self.assertEqual(self.client.max_concurrency, self.client.semaphore._value)
+
+
+if __name__ == '__main__':
+    unittest.main()
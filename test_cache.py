@@ -0,0 +1,65 @@
+import time
+import unittest
+
+from wdb_rest.cache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_get_and_set(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+
+        self.assertEqual(1, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(dict(size=1, max_size=2, hits=1, misses=1, hit_ratio=0.5), cache.stats())
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # Reading 'a' makes 'b' the least recently used entry.
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(1, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
+
+    def test_ttl(self):
+        cache = LRUCache(ttl=0.05)
+        cache.set('a', 1)
+        time.sleep(0.1)
+
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(0, cache.stats()['size'])
+
+    def test_accept(self):
+        cache = LRUCache()
+        cache.set('a', 10)
+
+        self.assertIsNone(cache.get('a', accept=lambda value: value > 20))
+        self.assertEqual(10, cache.get('a', accept=lambda value: value > 5))
+        self.assertEqual(1, cache.misses)
+
+    def test_clear_drops_stale_values(self):
+        cache = LRUCache()
+        generation = cache.generation
+        cache.clear()
+
+        # Computed before the clear, must not be cached.
+        cache.set('a', 1, generation)
+        self.assertIsNone(cache.get('a'))
+
+        cache.set('a', 2, cache.generation)
+        self.assertEqual(2, cache.get('a'))
+
+    def test_disabled(self):
+        cache = LRUCache(max_size=0)
+        cache.set('a', 1)
+
+        self.assertIsNone(cache.get('a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
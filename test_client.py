@@ -0,0 +1,28 @@
+import unittest
+
+from wdb_rest.client import TrackClient
+
+
+class FailingTrackClient(TrackClient):
+    """Client whose track list requests are answered like invalid arguments by Flask-RESTful."""
+
+    def get_tracks(self, *args, **kwargs):
+        return {'message': {'page': 'Page must be a positive number.'}}, 400
+
+
+class TestTrackClient(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FailingTrackClient()
+        self.addCleanup(self.client.close)
+
+    def test_iter_tracks_error(self):
+        # Errors of reqparse and abort carry a message instead of a msg.
+        with self.assertRaises(Exception) as context:
+            list(self.client.iter_tracks(prefetch=2))
+        self.assertNotIsInstance(context.exception, KeyError)
+        self.assertEqual({'page': 'Page must be a positive number.'}, context.exception.args[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from flask import Config
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import QueuePool
+
+from wdb_rest.config import default_engine_options, load_config, set_sqlite_pragmas
+
+
+class TestConfig(unittest.TestCase):
+
+    def test_load_config(self):
+        config = Config('.')
+        config.update(SQLALCHEMY_DATABASE_URI='sqlite:///../database.db', recommendation_cache_ttl=300,
+                      sqlite_pragmas={'journal_mode': 'WAL'})
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'config.json')
+            with open(path, 'w') as f:
+                json.dump({'sqlite_pragmas': {'journal_mode': 'DELETE'}, 'recommendation_cache_ttl': 60}, f)
+
+            environ = {'WDB_REST_CONFIG': path,
+                       'WDB_REST_SQLALCHEMY_DATABASE_URI': 'sqlite:///../database-test.db',
+                       'WDB_REST_RECOMMENDATION_CACHE_TTL': '10'}
+            with mock.patch.dict(os.environ, environ):
+                load_config(config)
+
+        # Variables override the file, the file overrides the defaults. JSON values are parsed.
+        self.assertEqual('sqlite:///../database-test.db', config['SQLALCHEMY_DATABASE_URI'])
+        self.assertEqual(10, config['recommendation_cache_ttl'])
+        self.assertEqual({'journal_mode': 'DELETE'}, config['sqlite_pragmas'])
+
+    def test_default_engine_options(self):
+        self.assertIs(QueuePool, default_engine_options('sqlite:///../database.db', 4)['poolclass'])
+        self.assertEqual(4, default_engine_options('sqlite:///../database.db', 4)['pool_size'])
+        self.assertEqual({}, default_engine_options('sqlite://'))
+        self.assertEqual({}, default_engine_options('postgresql://wdb@localhost/wdb'))
+
+    def test_sqlite_pragmas(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            uri = 'sqlite:///' + os.path.join(tmp_dir, 'test.db')
+            engine = create_engine(uri, **default_engine_options(uri))
+            set_sqlite_pragmas(engine, {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'busy_timeout': 5000})
+
+            with engine.connect() as connection:
+                self.assertEqual('wal', connection.execute(text('PRAGMA journal_mode')).scalar())
+                self.assertEqual(1, connection.execute(text('PRAGMA synchronous')).scalar())
+                self.assertEqual(5000, connection.execute(text('PRAGMA busy_timeout')).scalar())
+            engine.dispose()
+
+    def test_writer_not_blocked_by_readers(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            uri = 'sqlite:///' + os.path.join(tmp_dir, 'test.db')
+            engine = create_engine(uri, **default_engine_options(uri))
+            set_sqlite_pragmas(engine, {'journal_mode': 'WAL', 'busy_timeout': 100})
+            with engine.begin() as connection:
+                connection.execute(text('CREATE TABLE t (x INTEGER)'))
+                connection.execute(text('INSERT INTO t VALUES (1), (2)'))
+
+            # A reader is in the middle of a query while a writer commits. With a rollback journal the commit
+            # would fail with "database is locked", with the write-ahead log both go ahead.
+            with engine.connect() as reader, engine.connect() as writer:
+                result = reader.execute(text('SELECT x FROM t'))
+                self.assertEqual(1, result.fetchone()[0])
+
+                with writer.begin():
+                    writer.execute(text('INSERT INTO t VALUES (3)'))
+
+                # The reader still sees the data as of the start of its query.
+                self.assertEqual([(2,)], result.fetchall())
+                self.assertEqual(3, reader.execute(text('SELECT COUNT(*) FROM t')).scalar())
+            engine.dispose()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,26 @@
+import os
+import tempfile
 import unittest
 
+import numpy as np
+from flask_restful import marshal
+from sqlalchemy import text
+
 from wdb_rest.data import TrackDAO
-from wdb_rest.server import db, TrackModel, app
+from wdb_rest.schema import migrate
+from wdb_rest.server import db, TrackModel, app, track_fields
 
 
 class TestTrackDAO(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        # Make sure the database has the indexes and the search table.
+        with app.app_context():
+            conn = db.engine.raw_connection()
+            migrate(conn)
+            conn.close()
+
     def setUp(self):
         # http://tinyurl.com/2jj8sm6h
         self.app_context = app.app_context()
@@ -29,6 +44,13 @@ class TestTrackDAO(unittest.TestCase):
         # Look at the tinyurl in the setUp method.
         self.app_context.pop()
 
+    def set_recommendation_matrix(self):
+        # Build a fresh matrix in a temporary directory, so it reflects the current database.
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        return self.track_dao.set_recommendation_matrix(os.path.join(temp_dir.name, 'recommendation_matrix.bin'),
+                                                        app.config['columns_to_be_vectorized'])
+
     def test_create_track_success(self):
         try:
             track = self.track_dao.create_track(self.track)
@@ -118,6 +140,316 @@ class TestTrackDAO(unittest.TestCase):
         with self.assertRaises(Exception):
             self.track_dao.delete_track_by_id(invalid_track_id, self.track)
 
+    def test_build_recommendation_matrix(self):
+        columns = app.config['columns_to_be_vectorized']
+        matrix, track_ids, encoder = self.track_dao.build_recommendation_matrix(columns)
+
+        tracks = TrackModel.query.order_by(TrackModel.id).all()
+        self.assertEqual([track.id for track in tracks], track_ids.tolist())
+        self.assertEqual((len(tracks), len(columns)), matrix.shape)
+        self.assertEqual('float32', matrix.dtype)
+
+        # Every row must be encoded exactly like a single track written later on.
+        for row in [0, len(tracks) // 2, len(tracks) - 1]:
+            np.testing.assert_allclose(matrix[row], encoder.encode(tracks[row]), rtol=1e-5)
+
+        # Standardized columns.
+        np.testing.assert_allclose(matrix.mean(axis=0), np.zeros(len(columns)), atol=1e-3)
+
+    def test_get_tracks_list_cursor(self):
+        for sort_field, sort_order in [('id', 'asc'), ('tempo', 'desc'), ('decade', 'asc')]:
+            # Walk the first pages with page numbers and with cursors, they must match.
+            cursor = ''
+            for page in range(1, 6):
+                by_page = self.track_dao.get_tracks_list(sort_field=sort_field, sort_order=sort_order, page=page)
+                by_cursor = self.track_dao.get_tracks_list(sort_field=sort_field, sort_order=sort_order,
+                                                           cursor=cursor)
+
+                self.assertEqual(by_page['items'], by_cursor['items'])
+                self.assertTrue(by_cursor['has_next'])
+                cursor = by_cursor['next_cursor']
+
+    def test_get_tracks_list_cursor_last_page(self):
+        result = self.track_dao.get_tracks_list(filter_field='decade', filter_value='70s', cursor='')
+        tracks = result['items']
+        while result['has_next']:
+            result = self.track_dao.get_tracks_list(filter_field='decade', filter_value='70s',
+                                                    cursor=result['next_cursor'])
+            tracks += result['items']
+
+        self.assertIsNone(result['next_cursor'])
+        expected = TrackModel.query.filter_by(decade='70s').order_by(TrackModel.id).all()
+        self.assertEqual([track.id for track in expected], [track['id'] for track in tracks])
+
+    def test_get_tracks_list_cursor_fail(self):
+        result = self.track_dao.get_tracks_list(sort_field='tempo', cursor='')
+
+        # The cursor belongs to another sort order.
+        with self.assertRaises(Exception):
+            self.track_dao.get_tracks_list(sort_field='tempo', sort_order='desc', cursor=result['next_cursor'])
+        with self.assertRaises(Exception):
+            self.track_dao.get_tracks_list(cursor='not a cursor')
+
+    def test_export_tracks(self):
+        # Small batches, so the export needs many queries that seek past ties in the sort field.
+        batches = list(self.track_dao.export_tracks(filter_field='decade', filter_value='80s', sort_field='key',
+                                                    sort_order='desc', batch_size=7))
+        self.assertTrue(all(len(batch) <= 7 for batch in batches))
+
+        exported = [track['id'] for batch in batches for track in batch]
+        expected = TrackModel.query.filter_by(decade='80s') \
+            .order_by(TrackModel.key.desc(), TrackModel.id.desc()).with_entities(TrackModel.id).all()
+        self.assertEqual([track_id for track_id, in expected], exported)
+
+    def test_export_tracks_fail(self):
+        # Invalid criteria raise before anything is streamed.
+        with self.assertRaises(Exception):
+            self.track_dao.export_tracks(sort_field='query')
+        with self.assertRaises(Exception):
+            self.track_dao.export_tracks(sort_order='up')
+
+    def test_get_tracks_list_without_total(self):
+        for page in [1, 2, 50]:
+            with_total = self.track_dao.get_tracks_list(sort_field='tempo', page=page)
+            without_total = self.track_dao.get_tracks_list(sort_field='tempo', page=page, with_total=False)
+
+            self.assertNotIn('tracks_iter', without_total)
+            del with_total['tracks_iter']
+            self.assertEqual(with_total, without_total)
+
+    def test_get_tracks_list_count_cache(self):
+        result = self.track_dao.get_tracks_list(filter_field='decade', filter_value='80s')
+        hits = self.track_dao.count_cache.hits
+
+        # The second page reuses the count of the first one.
+        self.track_dao.get_tracks_list(filter_field='decade', filter_value='80s', page=2)
+        self.assertEqual(hits + 1, self.track_dao.count_cache.hits)
+
+        # A new track changes the count.
+        created_track = self.track_dao.create_track(dict(self.track, decade='80s'))
+        pages = (TrackModel.query.filter_by(decade='80s').count() + 9) // 10
+        last_page = self.track_dao.get_tracks_list(filter_field='decade', filter_value='80s', page=pages)
+        self.assertEqual(pages, last_page['tracks_iter'][-1])
+        self.assertIn(created_track.id, [track['id'] for track in last_page['items']])
+
+        self.track_dao.delete_track_by_id(created_track.id)
+
+    def test_get_tracks_list_search(self):
+        created_track = self.track_dao.create_track(dict(self.track, track='Zanzibar Quokka', artist='Ukulele Owl'))
+
+        # Every word must prefix a word of the track or the artist name.
+        for search in ['zanzibar', 'Zanz quok', 'quokka ukul', 'zanzibar (quokka']:
+            result = self.track_dao.get_tracks_list(search=search)
+            self.assertEqual([created_track.id], [track['id'] for track in result['items']])
+            self.assertEqual([1], result['tracks_iter'])
+        self.assertEqual([], self.track_dao.get_tracks_list(search='zanzibar walrus')['items'])
+
+        # The search table follows updates and deletes.
+        self.track_dao.update_track_by_id(created_track.id, dict(self.track, track='Walrus', artist='Ukulele Owl'))
+        self.assertEqual([], self.track_dao.get_tracks_list(search='zanzibar')['items'])
+        result = self.track_dao.get_tracks_list(search='walrus ukulele', with_total=False)
+        self.assertEqual([created_track.id], [track['id'] for track in result['items']])
+
+        self.track_dao.delete_track_by_id(created_track.id)
+        self.assertEqual([], self.track_dao.get_tracks_list(search='walrus', cursor='')['items'])
+
+    def test_get_tracks_list_search_fail(self):
+        with self.assertRaises(Exception):
+            self.track_dao.get_tracks_list(search=' "" ')
+
+    def test_get_tracks_list_items_match_marshal(self):
+        track_dao = TrackDAO(db, TrackModel, track_fields=track_fields)
+        result = track_dao.get_tracks_list(sort_field='tempo', sort_order='desc', page=3)
+
+        tracks = [db.session.get(TrackModel, item['id']) for item in result['items']]
+        self.assertEqual(marshal(tracks, track_fields), result['items'])
+
+    def test_recommendation_matrix_file(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        path = os.path.join(temp_dir.name, 'recommendation_matrix.bin')
+        columns = app.config['columns_to_be_vectorized']
+
+        built_engine = self.track_dao.set_recommendation_matrix(path, columns)
+        modified_time = os.path.getmtime(path)
+
+        # An up to date file is memory mapped instead of rebuilt.
+        loaded_engine = self.track_dao.set_recommendation_matrix(path, columns)
+        self.assertIsInstance(loaded_engine.matrix, np.memmap)
+        self.assertEqual(modified_time, os.path.getmtime(path))
+        track_id = int(built_engine.track_ids[0])
+        self.assertEqual(built_engine.top_k(track_id, 10)[0].tolist(), loaded_engine.top_k(track_id, 10)[0].tolist())
+
+        # Writes since the file was saved are replayed from the change log and the file is saved again.
+        created_track = self.track_dao.create_track(self.track)
+        updated_engine = self.track_dao.set_recommendation_matrix(path, columns)
+        self.assertEqual(created_track.id, updated_engine.track_ids[updated_engine.size - 1])
+        loaded_engine = self.track_dao.set_recommendation_matrix(path, columns)
+        self.assertIsInstance(loaded_engine.matrix, np.memmap)
+        self.assertEqual(created_track.id, loaded_engine.track_ids[-1])
+
+        # Even one that leaves the row count, the ids and the column sums unchanged.
+        updated_track = self.track_dao.update_track_by_id(created_track.id, dict(self.track, decade='80s'))
+        updated_engine = self.track_dao.set_recommendation_matrix(path, columns)
+        row = updated_engine.find_row(created_track.id)
+        expected = updated_engine.normalize(updated_engine.encoder.encode(updated_track)[None])[0]
+        np.testing.assert_allclose(expected, updated_engine.matrix[row], rtol=1e-6)
+
+        # Writes the change log does not cover (an import) rebuild the file.
+        db.session.execute(text('UPDATE catalog_version SET version = version + 1'))
+        db.session.commit()
+        rebuilt_engine = self.track_dao.set_recommendation_matrix(path, columns)
+        self.assertNotIsInstance(rebuilt_engine.matrix, np.memmap)
+
+        # So does a different set of columns.
+        engine = self.track_dao.set_recommendation_matrix(path, columns[:-1])
+        self.assertEqual(len(columns) - 1, engine.matrix.shape[1])
+
+        self.track_dao.delete_track_by_id(created_track.id)
+
+    def test_get_batch_track_recommendations(self):
+        engine = self.set_recommendation_matrix()
+        track_ids = [int(i) for i in engine.track_ids[:3]] + [9999999]
+
+        recommendations = self.track_dao.get_batch_track_recommendations(track_ids, 5, engine)
+
+        self.assertEqual(4, len(recommendations))
+        self.assertIsNone(recommendations[3])
+        for track_id, tracks in zip(track_ids, recommendations[:3]):
+            expected = self.track_dao.get_track_recommendations(track_id, 5, engine)
+            self.assertEqual([track.id for track in expected], [track.id for track in tracks])
+
+    def test_recommendation_cache(self):
+        engine = self.set_recommendation_matrix()
+        track_id = int(engine.track_ids[0])
+        cache = self.track_dao.recommendation_cache
+
+        recommendations = self.track_dao.get_track_recommendations(track_id, 20, engine)
+        hits = cache.hits
+
+        # Fewer recommendations are served from the cache, with the same ranking.
+        cached = self.track_dao.get_track_recommendations(track_id, 5, engine)
+        self.assertEqual(hits + 1, cache.hits)
+        self.assertEqual([track.id for track in recommendations[:5]], [track.id for track in cached])
+        self.assertEqual(recommendations[0].track, cached[0].track)
+
+        # More recommendations are not.
+        self.track_dao.get_track_recommendations(track_id, 30, engine)
+        self.assertEqual(hits + 1, cache.hits)
+
+        # Writes invalidate the cache.
+        created_track = self.track_dao.create_track(self.track)
+        self.assertEqual(0, cache.stats()['size'])
+        self.track_dao.delete_track_by_id(created_track.id)
+
+    def test_recommendation_matrix_follows_writes(self):
+        engine = self.set_recommendation_matrix()
+        # Other tests leave copies of self.track in the database, use attributes nobody else has.
+        track_args = dict(self.track, tempo=777.0, duration_ms=77777.0)
+        created_track = self.track_dao.create_track(track_args)
+        copied_track = self.track_dao.create_track(dict(track_args, track='Copied track'))
+
+        # Identical attributes, so the tracks are each other's best match.
+        recommendations = self.track_dao.get_track_recommendations(created_track.id, 1, engine)
+        self.assertEqual(copied_track.id, recommendations[0].id)
+
+        # After an update the copy is not identical anymore.
+        self.track_dao.update_track_by_id(copied_track.id, dict(track_args, tempo=400.0, popularity=0))
+        recommendations = self.track_dao.get_track_recommendations(created_track.id, 5, engine)
+        self.assertNotEqual(copied_track.id, recommendations[0].id)
+
+        # Deleted tracks are not recommended anymore.
+        self.track_dao.delete_track_by_id(copied_track.id)
+        with self.assertRaises(Exception):
+            self.track_dao.get_track_recommendations(copied_track.id, 5, engine)
+        recommendations = self.track_dao.get_track_recommendations(created_track.id, 100, engine)
+        self.assertNotIn(copied_track.id, [track.id for track in recommendations])
+
+        self.track_dao.delete_track_by_id(created_track.id)
+
+    def test_bulk_writes(self):
+        engine = self.set_recommendation_matrix()
+        track_args = dict(self.track, tempo=666.0, duration_ms=66666.0)
+
+        # Invalid tracks are reported and skipped, the valid ones are created in one transaction.
+        results = self.track_dao.create_tracks([track_args, dict(track_args, key='high'), dict(track_args, track='Copy'),
+                                                {'track': 'Incomplete'}, dict(track_args, popularity=6.7), 'Track'])
+        self.assertEqual([201, 400, 201, 400, 400, 400], [result['status'] for result in results])
+        self.assertEqual('Field popularity has an invalid value.', results[4]['msg'])
+        created_ids = [results[0]['track']['id'], results[2]['track']['id']]
+        for result in [results[0], results[2]]:
+            track = self.track_dao.get_track_by_id(result['track']['id'])
+            self.assertEqual(result['track']['track'], track.track)
+            self.assertEqual(666.0, track.tempo)
+
+        # The created tracks are each other's best match.
+        recommendations = self.track_dao.get_track_recommendations(created_ids[0], 1, engine)
+        self.assertEqual(created_ids[1], recommendations[0].id)
+
+        # Updates need existing ids.
+        results = self.track_dao.update_tracks([dict(track_args, id=created_ids[1], tempo=400.0, popularity=0),
+                                                dict(track_args, id=-1),
+                                                dict(track_args, id=created_ids[1])])
+        self.assertEqual([200, 404, 400], [result['status'] for result in results])
+        self.assertEqual(400.0, self.track_dao.get_track_by_id(created_ids[1]).tempo)
+        recommendations = self.track_dao.get_track_recommendations(created_ids[0], 5, engine)
+        self.assertNotEqual(created_ids[1], recommendations[0].id)
+
+        results = self.track_dao.delete_tracks(created_ids + [-1])
+        self.assertEqual([200, 200, 404], [result['status'] for result in results])
+        for track_id in created_ids:
+            with self.assertRaises(Exception):
+                self.track_dao.get_track_by_id(track_id)
+            with self.assertRaises(Exception):
+                self.track_dao.get_track_recommendations(track_id, 5, engine)
+
+    def test_catalog_version(self):
+        version, modified = self.track_dao.get_catalog_version()
+
+        created_track = self.track_dao.create_track(self.track)
+        self.track_dao.update_tracks([dict(self.track, id=created_track.id)])
+        self.track_dao.delete_track_by_id(created_track.id)
+
+        # Every write bumps the version, reads do not.
+        self.track_dao.get_tracks_list()
+        new_version, new_modified = self.track_dao.get_catalog_version()
+        self.assertEqual(version + 3, new_version)
+        self.assertGreaterEqual(new_modified, modified)
+
+    def test_sync_catalog(self):
+        engine = self.set_recommendation_matrix()
+        self.track_dao.get_tracks_list()
+        # Another server process, with its own engine and caches, writes tracks.
+        other_dao = TrackDAO(db, TrackModel)
+        created_track = other_dao.create_track(self.track)
+        updated_track = other_dao.update_track_by_id(created_track.id, dict(self.track, decade='60s'))
+
+        self.track_dao.sync_catalog()
+        self.assertEqual(self.track_dao.get_catalog_version()[0], self.track_dao.catalog_version)
+        self.assertEqual(0, self.track_dao.count_cache.stats()['size'])
+        self.assertTrue(np.allclose(engine.normalize(engine.encoder.encode(updated_track)[None])[0],
+                                    engine.matrix[engine.find_row(created_track.id)]))
+        self.assertEqual(5, len(self.track_dao.get_track_recommendations(created_track.id, 5, engine)))
+
+        other_dao.delete_track_by_id(created_track.id)
+        self.track_dao.sync_catalog()
+        with self.assertRaises(Exception):
+            engine.top_k(created_track.id, 5)
+
+    def test_sync_catalog_reload(self):
+        self.set_recommendation_matrix()
+        # A write that is not in the change log, e.g. by import_data.py.
+        db.session.execute(text('UPDATE catalog_version SET version = version + 1'))
+        db.session.commit()
+
+        self.track_dao.sync_catalog()
+        self.assertEqual(self.track_dao.get_catalog_version()[0], self.track_dao.catalog_version)
+        self.assertEqual(db.session.query(TrackModel).count(), self.track_dao.recommendation_engine.size)
+
+    def test_bulk_writes_fail(self):
+        with self.assertRaises(Exception):
+            self.track_dao.delete_tracks(list(range(self.track_dao.max_bulk_tracks + 1)))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,106 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from wdb_rest.recommendation import SimilarityEngine
+from wdb_rest.server import app, track_dao
+
+
+class TestImportData(unittest.TestCase):
+
+    header = 'track,artist,danceability,key,instrumentalness,tempo,duration_ms,popularity,decade\n'
+    rows = ['Love song,Singer,0.5,1,0.01,120.5,200000,50,80s\n',
+            'Night drive,Band,0.7,5,0.2,98.0,240000,60,90s\n',
+            'Dance all night,Singer,0.9,7,0.0,128.0,180000,70,10s\n',
+            'No artist,,0.9,7,0.0,128.0,180000,70,10s\n']
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.database = os.path.join(temp_dir.name, 'database.db')
+        self.matrix = os.path.join(temp_dir.name, 'recommendation_matrix.bin')
+        self.csv = os.path.join(temp_dir.name, 'tracks.csv')
+
+    def import_data(self, lines, *options, returncode=0):
+        with open(self.csv, 'w') as f:
+            f.writelines(lines)
+        result = subprocess.run([sys.executable, 'import_data.py', '--csv', self.csv, '--database', self.database,
+                                 '--matrix', self.matrix, '--chunk-size', '2', *options],
+                                cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+        self.assertEqual(returncode, result.returncode, result.stdout + result.stderr)
+        conn = sqlite3.connect(self.database)
+        self.addCleanup(conn.close)
+        return conn
+
+    def assert_matrix_up_to_date(self, track_ids):
+        # The server loads the matrix only if its fingerprint matches the database.
+        engine = create_engine('sqlite:///' + self.database)
+        self.addCleanup(engine.dispose)
+        with Session(engine) as session:
+            fingerprint = track_dao.get_catalog_fingerprint(app.config['columns_to_be_vectorized'], session)
+        recommendation_engine, header = SimilarityEngine.load(self.matrix)
+        self.assertEqual(fingerprint, header['fingerprint'])
+        conn = sqlite3.connect(self.database)
+        self.addCleanup(conn.close)
+        self.assertEqual((header['catalog_version'],), conn.execute('SELECT version FROM catalog_version').fetchone())
+        self.assertEqual(track_ids, sorted(recommendation_engine.track_ids[:recommendation_engine.size].tolist()))
+
+    def test_import(self):
+        conn = self.import_data([self.header] + self.rows)
+
+        # Rows with missing values are skipped, the others get their row number as id.
+        self.assertEqual([(1, 'Love song'), (2, 'Night drive'), (3, 'Dance all night')],
+                         conn.execute('SELECT id, track FROM track_model ORDER BY id').fetchall())
+        indexes = [name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")]
+        self.assertIn('ix_track_model_tempo', indexes)
+        self.assertEqual([(2,), (3,)], conn.execute(
+            "SELECT rowid FROM track_search WHERE track_search MATCH 'night' ORDER BY rowid").fetchall())
+        self.assert_matrix_up_to_date([1, 2, 3])
+
+    def test_import_replaces_tracks(self):
+        self.import_data([self.header] + self.rows)
+        conn = self.import_data([self.header] + self.rows[1:2])
+
+        self.assertEqual([(1, 'Night drive')], conn.execute('SELECT id, track FROM track_model').fetchall())
+        self.assertEqual([], conn.execute("SELECT rowid FROM track_search WHERE track_search MATCH 'love'").fetchall())
+        self.assertEqual((2,), conn.execute('SELECT version FROM catalog_version').fetchone())
+        self.assert_matrix_up_to_date([1])
+
+    def test_failed_import(self):
+        self.import_data([self.header] + self.rows)
+        # The duplicate id fails the import after the indexes and the search table were dropped.
+        conn = self.import_data(['id,' + self.header, '5,' + self.rows[0], '6,' + self.rows[1], '5,' + self.rows[2]],
+                                returncode=1)
+
+        self.assertEqual([(1, 'Love song'), (2, 'Night drive'), (3, 'Dance all night')],
+                         conn.execute('SELECT id, track FROM track_model ORDER BY id').fetchall())
+        indexes = [name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")]
+        self.assertIn('ix_track_model_tempo', indexes)
+        self.assertEqual([(2,), (3,)], conn.execute(
+            "SELECT rowid FROM track_search WHERE track_search MATCH 'night' ORDER BY rowid").fetchall())
+        self.assertEqual((1,), conn.execute('SELECT version FROM catalog_version').fetchone())
+
+    def test_upsert(self):
+        self.import_data([self.header] + self.rows)
+        for options in [['--upsert'], ['--upsert', '--keep-indexes']]:
+            with self.subTest(options=options):
+                conn = self.import_data(['id,' + self.header,
+                                         '2,Night drive remix,Band,0.7,5,0.2,98.0,240000,60,90s\n',
+                                         '10,Summer love,Duo,0.6,2,0.1,110.0,210000,40,00s\n'], *options)
+
+                self.assertEqual([(1, 'Love song'), (2, 'Night drive remix'), (3, 'Dance all night'),
+                                  (10, 'Summer love')],
+                                 conn.execute('SELECT id, track FROM track_model ORDER BY id').fetchall())
+                self.assertEqual([(1,), (10,)], conn.execute(
+                    "SELECT rowid FROM track_search WHERE track_search MATCH 'love' ORDER BY rowid").fetchall())
+                self.assert_matrix_up_to_date([1, 2, 3, 10])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+from benchmarks.import_time import budgets
+
+
+class TestImportTime(unittest.TestCase):
+
+    def test_deferred_imports(self):
+        # Importing the server or a client must not pull in a heavy dependency that belongs to a later code path.
+        # The time budgets depend on the machine, benchmarks/import_time.py checks them.
+        for module, (budget, forbidden) in budgets.items():
+            with self.subTest(module=module):
+                script = f'import json, sys, {module}; print(json.dumps(sorted(sys.modules)))'
+                result = subprocess.run([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                        capture_output=True, text=True)
+                self.assertEqual(0, result.returncode, result.stderr)
+                imported = set(json.loads(result.stdout))
+                self.assertEqual([], [name for name in forbidden if name in imported])
+
+
+if __name__ == '__main__':
+    unittest.main()
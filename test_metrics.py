@@ -0,0 +1,119 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine, text
+
+from wdb_rest import metrics
+from wdb_rest.metrics import CallbackMetric, Counter, Gauge, Histogram, Ratio, Registry
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter_and_gauge(self):
+        counter = Counter('requests_total', 'Requests.', ['status'], registry=self.registry)
+        counter.inc(status=200)
+        counter.inc(2, status=200)
+        counter.inc(status=404)
+        gauge = Gauge('in_flight', 'In flight.', registry=self.registry)
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+
+        self.assertEqual('# HELP requests_total Requests.\n'
+                         '# TYPE requests_total counter\n'
+                         'requests_total{status="200"} 3\n'
+                         'requests_total{status="404"} 1\n'
+                         '# HELP in_flight In flight.\n'
+                         '# TYPE in_flight gauge\n'
+                         'in_flight 1\n', self.registry.render())
+
+    def test_histogram(self):
+        histogram = Histogram('latency_seconds', 'Latency.', buckets=(0.1, 1.0), registry=self.registry)
+        for value in [0.05, 0.1, 0.5, 2.0]:
+            histogram.observe(value)
+
+        # Buckets are cumulative and include their upper bound.
+        lines = self.registry.render().splitlines()[2:]
+        self.assertEqual(['latency_seconds_bucket{le="0.1"} 2',
+                          'latency_seconds_bucket{le="1.0"} 3',
+                          'latency_seconds_bucket{le="+Inf"} 4',
+                          'latency_seconds_count 4',
+                          'latency_seconds_sum 2.65'], lines)
+
+    def test_callback_metric(self):
+        CallbackMetric('cache_hits_total', 'Hits.', 'counter', lambda: {('count',): 5}, ['cache'],
+                       registry=self.registry)
+        self.assertIn('cache_hits_total{cache="count"} 5', self.registry.render())
+
+    def test_instrument_engine(self):
+        engine = create_engine('sqlite://')
+        metrics.instrument_engine(engine)
+        selects = dict(metrics.sql_statements_total.values).get(('select',), 0)
+
+        metrics.start_request_sql()
+        with engine.connect() as connection:
+            connection.execute(text('SELECT 1'))
+            connection.execute(text('SELECT 2'))
+
+        self.assertEqual(2, metrics.request_sql())
+        self.assertEqual(selects + 2, metrics.sql_statements_total.values[('select',)])
+
+    def test_merge_processes(self):
+        counter = Counter('requests_total', 'Requests.', ['status'], registry=self.registry)
+        gauge = Gauge('in_flight', 'In flight.', registry=self.registry)
+        counter.inc(2, status=200)
+        gauge.set(1)
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        directory = temp_dir.name
+        # Snapshots of another worker that is running and of one that exited.
+        exited = subprocess.Popen([sys.executable, '-c', 'pass'])
+        exited.wait()
+        for pid, requests in [(os.getppid(), 3), (exited.pid, 4)]:
+            with open(os.path.join(directory, f'{pid}.json'), 'w') as f:
+                json.dump([['requests_total', 'Requests.', 'counter', [['', {'status': '200'}, requests]]],
+                           ['in_flight', 'In flight.', 'gauge', [['', {}, 5]]]], f)
+
+        # Counters are summed over all processes, gauges are reported per running process.
+        rendered = self.registry.render(directory)
+        self.assertIn('requests_total{status="200"} 9\n', rendered)
+        self.assertIn(f'in_flight{{pid="{os.getpid()}"}} 1\n', rendered)
+        self.assertIn(f'in_flight{{pid="{os.getppid()}"}} 5\n', rendered)
+        self.assertNotIn(f'pid="{exited.pid}"', rendered)
+
+        # A forked worker starts from zero, the master's snapshot holds what it counted before.
+        self.registry.reset()
+        self.assertIn('requests_total{status="200"} 7\n', self.registry.render(directory))
+
+    def test_ratio(self):
+        hits = Counter('hits_total', 'Hits.', ['cache'], registry=self.registry)
+        Counter('misses_total', 'Misses.', ['cache'], registry=self.registry).inc(3, cache='count')
+        Ratio('hit_ratio', 'Hit ratio.', 'hits_total', 'misses_total', ['cache'], registry=self.registry)
+        hits.inc(cache='count')
+        self.assertIn('hit_ratio{cache="count"} 0.25\n', self.registry.render())
+
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        # Snapshot of a master process, without its gauges.
+        master = Registry()
+        Counter('hits_total', 'Hits.', ['cache'], registry=master).inc(4, cache='count')
+        Gauge('cache_size', 'Size.', registry=master).set(10)
+        master.write(temp_dir.name, gauges=False)
+        path = os.path.join(temp_dir.name, f'{os.getppid()}.json')
+        os.rename(os.path.join(temp_dir.name, f'{os.getpid()}.json'), path)
+        with open(path) as f:
+            self.assertEqual(['hits_total'], [name for name, help, type, samples in json.load(f)])
+
+        # The ratio of the merged processes comes from the summed counters, without a pid label.
+        self.assertIn('hit_ratio{cache="count"} 0.625\n', self.registry.render(temp_dir.name))
+
+
+if __name__ == '__main__':
+    unittest.main()
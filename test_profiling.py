@@ -0,0 +1,74 @@
+import os
+import tempfile
+import unittest
+
+from sqlalchemy import Column, Integer, String, create_engine, text
+from sqlalchemy.orm import Session, declarative_base
+
+from wdb_rest import profiling
+
+Base = declarative_base()
+
+
+class Item(Base):
+    __tablename__ = 'item'
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        self.session = Session(self.engine)
+        profiling.instrument(self.engine, self.session)
+        self.session.execute(Item.__table__.insert(), [{'name': f'item {i}'} for i in range(5)])
+
+    def tearDown(self):
+        profiling.stop()
+        self.session.close()
+
+    def test_profile_request(self):
+        profile = profiling.start()
+        self.assertIsNotNone(profile)
+
+        items = self.session.query(Item).filter(Item.id > 2).all()
+        self.session.execute(text('UPDATE item SET name = :name'), {'name': 'updated'})
+
+        self.assertIs(profile, profiling.stop())
+        # The caller still gets all rows of a query when they are counted.
+        self.assertEqual(3, len(items))
+        self.assertEqual([3, 5], [statement['rows'] for statement in profile.statements])
+        self.assertTrue(profile.statements[1]['statement'].startswith('UPDATE item'))
+
+        headers = profile.summary_headers(3)
+        self.assertEqual('2 statements', headers['X-Profile-SQL'].split(',')[0])
+        self.assertEqual(3, len(headers['X-Profile-Functions'].split('; ')))
+        self.assertGreater(profile.duration, 0)
+
+    def test_not_profiled(self):
+        # Without start nothing is traced and stop has nothing to return.
+        self.session.query(Item).all()
+        self.assertIsNone(profiling.stop())
+
+    def test_one_profile_at_a_time(self):
+        self.assertIsNotNone(profiling.start())
+        self.assertIsNone(profiling.start())
+        profiling.stop()
+        self.assertIsNotNone(profiling.start())
+
+    def test_dump(self):
+        profiling.start()
+        self.session.query(Item).all()
+        profile = profiling.stop()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = profile.dump(os.path.join(tmp_dir, 'profiles'), 'tracklist')
+            self.assertTrue(path.endswith('-tracklist.prof'))
+            self.assertTrue(os.path.exists(path))
+            self.assertTrue(os.path.exists(path[:-len('.prof')] + '.sql.json'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,365 @@
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from wdb_rest.ann import IVFIndex
+from wdb_rest.recommendation import FeatureEncoder, SimilarityEngine
+
+
+class Track:
+    """Stand-in for TrackModel rows."""
+
+    def __init__(self, id, **attributes):
+        self.id = id
+        self.__dict__.update(attributes)
+
+
+class TestSimilarityEngine(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(42)
+        self.matrix = rng.normal(size=(200, 7))
+        # Track ids deliberately do not match the row numbers.
+        self.track_ids = np.arange(1000, 1200)
+        self.engine = SimilarityEngine(self.matrix, self.track_ids)
+
+    def exact_ranking(self, track_id):
+        # Reference implementation: full cosine similarity and full sort.
+        row = track_id - 1000
+        norms = np.linalg.norm(self.matrix, axis=1)
+        similarities = self.matrix @ self.matrix[row] / (norms * norms[row])
+        ranking = [i for i in np.argsort(-similarities) if i != row]
+        return self.track_ids[ranking], similarities[ranking]
+
+    def test_rows_are_unit_length(self):
+        norms = np.linalg.norm(self.engine.matrix, axis=1)
+        np.testing.assert_allclose(norms, np.ones(len(norms)), rtol=1e-5)
+
+    def test_top_k_matches_exact_ranking(self):
+        ids, scores = self.engine.top_k(1042, 12)
+        expected_ids, expected_scores = self.exact_ranking(1042)
+
+        self.assertEqual(ids.tolist(), expected_ids[:12].tolist())
+        np.testing.assert_allclose(scores, expected_scores[:12], rtol=1e-5)
+
+    def test_top_k_skips_query_track(self):
+        ids, _ = self.engine.top_k(1042, 199)
+
+        self.assertNotIn(1042, ids.tolist())
+        self.assertEqual(199, len(ids))
+
+    def test_top_k_larger_than_catalog(self):
+        ids, scores = self.engine.top_k(1000, 1000)
+
+        self.assertEqual(199, len(ids))
+        # Scores are returned best match first.
+        self.assertTrue(np.all(np.diff(scores) <= 0))
+
+    def test_top_k_batch_matches_top_k(self):
+        track_ids = [1000, 1042, 5, 1199]
+        # A tiny memory budget forces one chunk per track.
+        for max_chunk_bytes in [1, 64 * 1024 * 1024]:
+            results = self.engine.top_k_batch(track_ids, 12, max_chunk_bytes=max_chunk_bytes)
+
+            self.assertEqual(4, len(results))
+            self.assertIsNone(results[2])
+            for track_id, result in zip(track_ids, results):
+                if result is None:
+                    continue
+                ids, scores = self.engine.top_k(track_id, 12)
+                self.assertEqual(ids.tolist(), result[0].tolist())
+                np.testing.assert_allclose(scores, result[1], rtol=1e-5)
+
+    def test_top_k_invalid_track(self):
+        with self.assertRaises(Exception):
+            self.engine.top_k(5, 10)
+
+    def test_zero_vector(self):
+        matrix = np.array([[0.0, 0.0], [1.0, 0.0], [0.0, 1.0]])
+        engine = SimilarityEngine(matrix, [1, 2, 3])
+
+        ids, scores = engine.top_k(1, 2)
+        self.assertFalse(np.isnan(scores).any())
+
+
+class TestFeatureEncoder(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.DataFrame({'tempo': [100.0, 120.0, 140.0],
+                                'key': [1, 1, 1],
+                                'decade': ['90s', '60s', '90s']})
+        self.encoder = FeatureEncoder.fit(self.df, ['tempo', 'key', 'decade'])
+
+    def test_fit_statistics(self):
+        self.assertEqual(self.encoder.categories, {'decade': ['60s', '90s']})
+        np.testing.assert_allclose(self.encoder.means, [120.0, 1.0, 2 / 3])
+        # Constant columns must not divide by zero.
+        self.assertEqual(self.encoder.stds[1], 1)
+
+    def test_encode_matches_encode_frame(self):
+        matrix = self.encoder.encode_frame(self.df)
+        vector = self.encoder.encode(Track(1, tempo=140.0, key=1, decade='90s'))
+
+        np.testing.assert_allclose(vector, matrix[2])
+
+    def test_unseen_category(self):
+        self.encoder.encode({'tempo': 90.0, 'key': 2, 'decade': '10s'})
+
+        self.assertEqual(self.encoder.categories['decade'], ['60s', '90s', '10s'])
+
+    def test_unseen_category_threads(self):
+        decades = [f'{decade}s' for decade in range(0, 100, 10)]
+
+        def encode(i):
+            return [self.encoder.category_code('decade', decades[(i + j) % len(decades)])
+                    for j in range(len(decades))]
+
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(encode, range(32)))
+
+        # Every value got one code, whichever thread saw it first.
+        categories = self.encoder.categories['decade']
+        self.assertEqual(len(set(categories)), len(categories))
+        for i, codes in enumerate(results):
+            self.assertEqual([categories.index(decades[(i + j) % len(decades)]) for j in range(len(decades))], codes)
+
+    def test_round_trip(self):
+        encoder = FeatureEncoder.from_dict(self.encoder.to_dict())
+
+        np.testing.assert_allclose(encoder.encode_frame(self.df), self.encoder.encode_frame(self.df))
+
+
+class TestIncrementalUpdates(unittest.TestCase):
+
+    def setUp(self):
+        self.columns = ['a', 'b', 'c']
+        rng = np.random.default_rng(7)
+        self.df = pd.DataFrame(rng.normal(size=(50, 3)), columns=self.columns)
+        encoder = FeatureEncoder.fit(self.df, self.columns)
+        self.engine = SimilarityEngine(encoder.encode_frame(self.df), np.arange(1, 51), encoder)
+
+    def test_append_track(self):
+        # Exact copy of track 1, it must be its best match.
+        self.engine.set_track(Track(100, **self.df.iloc[0].to_dict()))
+
+        ids, scores = self.engine.top_k(1, 1)
+        self.assertEqual([100], ids.tolist())
+        self.assertAlmostEqual(1.0, scores[0], places=5)
+        self.assertEqual(51, self.engine.size)
+
+    def test_many_appends_grow_capacity(self):
+        for track_id in range(100, 300):
+            self.engine.set_track(Track(track_id, a=track_id, b=1.0, c=2.0))
+
+        self.assertEqual(250, self.engine.size)
+        ids, _ = self.engine.top_k(299, 5)
+        self.assertEqual(5, len(ids))
+
+    def test_overwrite_track(self):
+        self.engine.set_track(Track(2, a=1.0, b=2.0, c=3.0))
+        self.engine.set_track(Track(3, a=1.0, b=2.0, c=3.0))
+
+        ids, scores = self.engine.top_k(2, 1)
+        self.assertEqual([3], ids.tolist())
+        self.assertAlmostEqual(1.0, scores[0], places=5)
+        self.assertEqual(50, self.engine.size)
+
+    def test_remove_track(self):
+        self.engine.remove_track(5)
+
+        ids, _ = self.engine.top_k(1, 100)
+        self.assertNotIn(5, ids.tolist())
+        self.assertEqual(48, len(ids))
+        with self.assertRaises(Exception):
+            self.engine.top_k(5, 10)
+
+    def test_compaction(self):
+        for track_id in range(1, 20):
+            self.engine.remove_track(track_id)
+
+        # Compaction drops the tombstones once they pass the ratio.
+        self.assertLess(self.engine.size, 50)
+        ids, _ = self.engine.top_k(30, 100)
+        self.assertEqual(sorted(ids.tolist()), [i for i in range(20, 51) if i != 30])
+
+    def test_bulk_updates(self):
+        # Dictionaries work like track objects.
+        self.engine.set_tracks([dict(id=100, **self.df.iloc[0].to_dict()), dict(id=101, a=1.0, b=2.0, c=3.0)])
+        self.assertEqual(52, self.engine.size)
+        self.assertEqual([100], self.engine.top_k(1, 1)[0].tolist())
+
+        self.engine.remove_tracks(list(range(1, 20)) + [999])
+        self.assertEqual(0, self.engine.tombstones)
+        ids, _ = self.engine.top_k(30, 100)
+        self.assertEqual(sorted(ids.tolist()), [i for i in range(20, 51) if i != 30] + [100, 101])
+
+    def test_unordered_ids(self):
+        self.engine.set_track(Track(10, **self.df.iloc[0].to_dict()))
+        self.engine.set_track(Track(0, **self.df.iloc[0].to_dict()))
+
+        # Track 0 is appended after track 50, lookups must still find every row.
+        self.assertEqual(51, self.engine.size)
+        ids, _ = self.engine.top_k(0, 2)
+        self.assertEqual([1, 10], sorted(ids.tolist()))
+
+    def test_recreate_deleted_track(self):
+        self.engine.remove_track(3)
+        self.engine.set_track(Track(3, **self.df.iloc[0].to_dict()))
+
+        ids, _ = self.engine.top_k(3, 1)
+        self.assertEqual([1], ids.tolist())
+        self.assertEqual(0, self.engine.tombstones)
+
+    def test_encoder_required(self):
+        engine = SimilarityEngine(np.eye(3), [1, 2, 3])
+
+        with self.assertRaises(Exception):
+            engine.set_track(Track(4, a=1.0, b=2.0, c=3.0))
+
+
+class TestMatrixFile(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.path = os.path.join(temp_dir.name, 'recommendation_matrix.bin')
+
+        rng = np.random.default_rng(3)
+        self.df = pd.DataFrame({'a': rng.normal(size=40), 'decade': rng.choice(['60s', '70s'], size=40)})
+        encoder, matrix = FeatureEncoder.fit_transform(self.df, ['a', 'decade'])
+        self.engine = SimilarityEngine(matrix, np.arange(1, 41), encoder)
+
+    def test_round_trip(self):
+        self.engine.remove_track(7)
+        self.engine.save(self.path, fingerprint=['40', '1', '40'])
+
+        engine, header = SimilarityEngine.load(self.path)
+
+        self.assertEqual(1, header['format_version'])
+        self.assertEqual(['a', 'decade'], header['columns'])
+        self.assertEqual(['40', '1', '40'], header['fingerprint'])
+        self.assertEqual(39, header['rows'])
+        self.assertIsInstance(engine.matrix, np.memmap)
+        self.assertEqual(0, engine.matrix.ctypes.data % 64)
+        self.assertEqual(self.engine.encoder.to_dict(), engine.encoder.to_dict())
+        self.assertEqual(self.engine.top_k(1, 10)[0].tolist(), engine.top_k(1, 10)[0].tolist())
+
+    def test_loaded_engine_accepts_writes(self):
+        self.engine.save(self.path)
+        engine, _ = SimilarityEngine.load(self.path)
+
+        engine.set_track(Track(2, a=5.0, decade='60s'))
+        engine.set_track(Track(100, a=5.0, decade='60s'))
+        engine.remove_track(5)
+
+        self.assertEqual([100], engine.top_k(2, 1)[0].tolist())
+        # Copy-on-write, the file is not modified.
+        self.assertEqual(40, SimilarityEngine.load(self.path)[1]['rows'])
+
+    def test_invalid_file(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a matrix file')
+
+        with self.assertRaises(Exception):
+            SimilarityEngine.load(self.path)
+
+
+class TestIVFIndex(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(11)
+        # Clustered data, like real catalogs.
+        centers = rng.normal(size=(20, 7))
+        matrix = centers[rng.integers(0, 20, size=2000)] + 0.3 * rng.normal(size=(2000, 7))
+        self.track_ids = np.arange(1, 2001)
+        self.exact = SimilarityEngine(matrix, self.track_ids)
+        self.approximate = SimilarityEngine(matrix, self.track_ids)
+        self.index = IVFIndex.build(self.approximate.matrix, n_lists=30)
+        self.approximate.set_index(self.index, probes=3)
+
+    def recall(self, probes, k=10):
+        found = 0
+        for track_id in range(1, 2001, 40):
+            exact_ids = self.exact.top_k(track_id, k)[0]
+            approximate_ids = self.approximate.top_k(track_id, k, probes=probes)[0]
+            found += len(set(exact_ids.tolist()) & set(approximate_ids.tolist()))
+        return found / (k * 50)
+
+    def test_lists_cover_all_rows(self):
+        self.assertEqual(list(range(2000)), sorted(self.index.order.tolist()))
+        self.assertEqual(2000, self.index.offsets[-1])
+
+    def test_recall(self):
+        self.assertGreater(self.recall(3), 0.8)
+        # Probing every list is an exact search.
+        self.assertEqual(1.0, self.recall(30))
+
+    def test_results_are_ranked(self):
+        ids, scores = self.approximate.top_k(5, 20)
+
+        self.assertNotIn(5, ids.tolist())
+        self.assertTrue(np.all(np.diff(scores) <= 0))
+
+    def test_writes(self):
+        df = pd.DataFrame({'a': [1.0, 2.0, 3.0]})
+        encoder = FeatureEncoder.fit(df, ['a'])
+        engine = SimilarityEngine(encoder.encode_frame(df), [1, 2, 3], encoder)
+        engine.set_index(IVFIndex.build(engine.matrix, n_lists=2), probes=1)
+
+        # Appended rows are always scanned, tombstones never returned.
+        engine.set_track(Track(4, a=3.0))
+        engine.remove_track(2)
+        self.assertEqual([4], engine.top_k(3, 1)[0].tolist())
+        self.assertNotIn(2, engine.top_k(1, 10)[0].tolist())
+
+    def test_update_moves_row(self):
+        df = pd.DataFrame({'a': [1.0, 1.1, 1.2, -1.0, -1.1, -1.2], 'b': [1.0, 1.2, 1.1, -1.0, -1.2, -1.1]})
+        encoder = FeatureEncoder.fit(df, ['a', 'b'])
+        engine = SimilarityEngine(encoder.encode_frame(df), [1, 2, 3, 4, 5, 6], encoder)
+        index = IVFIndex.build(engine.matrix, n_lists=2)
+        engine.set_index(index, probes=1)
+
+        # Track 1 moves to the other cluster, a search probing one list has to find it there.
+        engine.set_track(Track(1, a=-1.05, b=-1.05))
+        self.assertEqual(1, engine.top_k(4, 1)[0][0])
+        self.assertNotIn(1, engine.top_k(2, 5)[0].tolist())
+        self.assertEqual(list(range(6)), sorted(engine.index.order.tolist()))
+        lists = IVFIndex.assign(engine.matrix, index.centroids)
+        for l in range(2):
+            rows = engine.index.order[engine.index.offsets[l]:engine.index.offsets[l + 1]]
+            self.assertTrue(np.all(lists[rows] == l))
+        # The old index is left as it was for searches still using it.
+        self.assertEqual(list(range(6)), sorted(index.order.tolist()))
+        self.assertIsNot(index, engine.index)
+
+    def test_compaction(self):
+        for track_id in range(1, 600):
+            self.approximate.remove_track(track_id)
+            self.exact.remove_track(track_id)
+
+        # The engine gets an index for the new row numbers, the old one still matches the old matrix.
+        self.assertLess(self.approximate.size, 2000)
+        self.assertIsNot(self.index, self.approximate.index)
+        self.assertEqual(sorted(self.approximate.index.order.tolist()), list(range(self.approximate.size)))
+        self.assertEqual(list(range(2000)), sorted(self.index.order.tolist()))
+        self.assertEqual(self.exact.top_k(1500, 10)[0].tolist(), self.approximate.top_k(1500, 10, probes=30)[0].tolist())
+
+    def test_save_and_load(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        path = os.path.join(temp_dir.name, 'recommendation_matrix.ivf')
+
+        self.index.save(path, ['1', '2'])
+        index, fingerprint = IVFIndex.load(path)
+
+        self.assertEqual(['1', '2'], fingerprint)
+        np.testing.assert_array_equal(self.index.order, index.order)
+        np.testing.assert_array_equal(self.index.centroids, index.centroids)
+
+
+if __name__ == '__main__':
+    unittest.main()
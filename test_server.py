@@ -0,0 +1,71 @@
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from wdb_rest.schema import create_track_table
+
+# Warms the server up in-process on the database of the environment and answers a few requests with the test client
+# of Flask, like a production server without debug mode.
+server_script = '''
+import json
+from wdb_rest.server import app, warm_up
+
+warm_up()
+client = app.test_client()
+responses = {path: client.get(path) for path in ['/api/track/1', '/api/track/99999999', '/api/tracks/']}
+print(json.dumps({'debug': app.debug,
+                  'responses': {path: [r.status_code, r.get_json()] for path, r in responses.items()}}))
+'''
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.database = os.path.join(temp_dir.name, 'database.db')
+        self.matrix = os.path.join(temp_dir.name, 'recommendation_matrix.bin')
+
+        # Database of an import from before the catalog version and the change log existed.
+        conn = sqlite3.connect(self.database)
+        create_track_table(conn)
+        conn.executemany('INSERT INTO track_model (track, artist, danceability, key, instrumentalness, tempo, '
+                         'duration_ms, popularity, decade) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         [('Love song', 'Singer', 0.5, 1, 0.01, 120.5, 200000, 50, '80s'),
+                          ('Night drive', 'Band', 0.7, 5, 0.2, 98.0, 240000, 60, '90s')])
+        conn.commit()
+        conn.close()
+
+    def run_server(self):
+        environ = dict(os.environ, WDB_REST_SQLALCHEMY_DATABASE_URI='sqlite:///' + self.database,
+                       WDB_REST_RECOMMENDATION_MATRIX_PATH=self.matrix)
+        result = subprocess.run([sys.executable, '-c', server_script], env=environ, capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(0, result.returncode, result.stdout + result.stderr)
+        return json.loads(result.stdout.splitlines()[-1])
+
+    def test_database_without_migration(self):
+        result = self.run_server()
+
+        # The warm-up creates the catalog version and the change log every request reads.
+        self.assertEqual(200, result['responses']['/api/track/1'][0])
+        self.assertEqual(2, len(result['responses']['/api/tracks/'][1]['items']))
+        conn = sqlite3.connect(self.database)
+        self.addCleanup(conn.close)
+        self.assertEqual((1,), conn.execute('SELECT version FROM catalog_version').fetchone())
+
+    def test_errors_without_debug(self):
+        result = self.run_server()
+
+        # Production servers (gunicorn) run without debug mode, errors must keep their message there too.
+        self.assertFalse(result['debug'])
+        self.assertEqual([500, {'msg': 'Cannot get track, track_id does not exist.'}],
+                         result['responses']['/api/track/99999999'])
+
+
+if __name__ == '__main__':
+    unittest.main()
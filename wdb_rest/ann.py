@@ -0,0 +1,192 @@
+import numpy as np
+
+
+class IVFIndex:
+    """
+    Inverted file index for approximate cosine similarity search.
+
+    The unit length rows of the recommendation matrix are clustered with spherical k-means, every row is stored
+    in the list of its closest centroid. A search scores the query against the centroids, only scans the rows
+    of the best `probes` lists and returns the best k of those. More probes give better recall and slower
+    searches, probing all lists is an exact search.
+
+    Rows appended to the matrix after the index was built are not in any list, they are always scanned.
+    """
+
+    # Memory budget for the similarity scores computed at once while clustering.
+    max_chunk_bytes = 64 * 1024 * 1024
+
+    def __init__(self, centroids, order, offsets):
+        """
+        Initialize object.
+
+        :param np.array centroids: unit length centroid of every list.
+        :param np.array order: matrix rows sorted by list.
+        :param np.array offsets: list l holds the rows order[offsets[l]:offsets[l + 1]].
+        """
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.order = np.asarray(order, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        # Rows at or above this index were added after the index was built.
+        self.rows = len(self.order)
+
+    @classmethod
+    def build(cls, matrix, n_lists=None, iterations=10, sample_size=100000, seed=0):
+        """Cluster the rows of a matrix into lists.
+
+        :param np.array matrix: unit length rows to index
+        :param int n_lists: number of lists. Default value: square root of the number of rows
+        :param int iterations: k-means iterations
+        :param int sample_size: number of rows the centroids are trained on
+        :param int seed: seed of the random centroid initialization
+        :return: IVFIndex
+        """
+        rng = np.random.default_rng(seed)
+        if n_lists is None:
+            n_lists = int(np.sqrt(len(matrix)))
+        n_lists = max(1, min(n_lists, len(matrix)))
+
+        sample = matrix
+        if len(matrix) > sample_size:
+            sample = matrix[np.sort(rng.choice(len(matrix), sample_size, replace=False))]
+        sample = np.asarray(sample, dtype=np.float32)
+
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = cls.assign(sample, centroids)
+            counts = np.bincount(assignments, minlength=n_lists)
+            sums = np.stack([np.bincount(assignments, weights=sample[:, d], minlength=n_lists)
+                             for d in range(sample.shape[1])], axis=1)
+
+            # Empty lists keep their old centroid.
+            filled = counts > 0
+            norms = np.linalg.norm(sums[filled], axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            centroids[filled] = sums[filled] / norms
+
+        assignments = cls.assign(matrix, centroids)
+        order = np.argsort(assignments, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))])
+        return cls(centroids, order, offsets)
+
+    @classmethod
+    def assign(cls, matrix, centroids):
+        """Return the closest centroid of every row, computed in chunks of bounded memory."""
+        chunk_size = max(1, cls.max_chunk_bytes // (4 * len(centroids)))
+        assignments = np.empty(len(matrix), dtype=np.int64)
+        for start in range(0, len(matrix), chunk_size):
+            chunk = np.asarray(matrix[start:start + chunk_size], dtype=np.float32)
+            assignments[start:start + chunk_size] = np.argmax(chunk @ centroids.T, axis=1)
+        return assignments
+
+    @classmethod
+    def load(cls, path):
+        """Load an index saved with save.
+
+        :param str path: path to the index file
+        :return: tuple(IVFIndex, fingerprint it was saved with)
+        """
+        with np.load(path, allow_pickle=False) as data:
+            index = cls(data['centroids'], data['order'], data['offsets'])
+            fingerprint = data['fingerprint'].tolist()
+        return index, fingerprint
+
+    def save(self, path, fingerprint):
+        """Save the index next to the recommendation matrix.
+
+        :param str path: path to the index file
+        :param list fingerprint: fingerprint of the matrix the index was built for
+        :return: None
+        """
+        # np.savez appends .npz to paths without it, write through a file object to keep the name.
+        with open(path, 'wb') as f:
+            np.savez(f, centroids=self.centroids, order=self.order[:self.rows], offsets=self.offsets,
+                     fingerprint=np.array(fingerprint, dtype=str))
+
+    def search(self, matrix, alive, query_row, k, probes):
+        """Approximate top k search for a row of the matrix.
+
+        :param np.array matrix: unit length rows, the matrix the index was built for
+        :param np.array alive: mask of the rows that may be returned
+        :param int query_row: row to search for, it is never part of the result
+        :param int k: how many rows to return
+        :param int probes: how many lists to scan
+        :return: tuple(np.array of rows, np.array of scores), best match first
+        """
+        query = matrix[query_row]
+        candidates = self.candidates(query, probes, len(matrix))
+        candidates = candidates[alive[candidates] & (candidates != query_row)]
+
+        scores = matrix[candidates] @ query
+        k = min(k, len(candidates))
+        if k <= 0:
+            return candidates[:0], scores[:0]
+
+        best = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+        best = best[np.argsort(-scores[best], kind='stable')]
+        return candidates[best], scores[best]
+
+    def candidates(self, query, probes, size):
+        """Return the rows of the `probes` lists closest to the query and all rows added after the build."""
+        n_lists = len(self.centroids)
+        probes = max(1, min(probes, n_lists))
+
+        centroid_scores = self.centroids @ query
+        if probes < n_lists:
+            lists = np.argpartition(-centroid_scores, probes - 1)[:probes]
+        else:
+            lists = np.arange(n_lists)
+
+        parts = [self.order[self.offsets[l]:self.offsets[l + 1]] for l in lists]
+        parts.append(np.arange(self.rows, size))
+        return np.concatenate(parts)
+
+    def reassign(self, rows, vectors):
+        """Follow rows of the matrix that were overwritten with new vectors: every row moves to the list of its
+        closest centroid. Like remap the index is not changed, the moved rows are in a new one.
+
+        :param np.array rows: overwritten row numbers
+        :param np.array vectors: their new unit length vectors
+        :return: IVFIndex with the rows in their new lists
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        # Rows appended after the build are scanned by every search, they stay out of the lists.
+        indexed = rows < self.rows
+        rows, vectors = rows[indexed], np.asarray(vectors)[indexed]
+        if not len(rows):
+            return self
+
+        n_lists = len(self.centroids)
+        positions = np.flatnonzero(np.isin(self.order, rows))
+        old_lists = np.searchsorted(self.offsets, positions, side='right') - 1
+        new_lists = self.assign(vectors, self.centroids)
+        order = np.delete(self.order, positions)
+        offsets = self.offsets - np.concatenate([[0], np.cumsum(np.bincount(old_lists, minlength=n_lists))])
+
+        # Append every row to the end of its new list.
+        by_list = np.argsort(new_lists, kind='stable')
+        order = np.insert(order, offsets[new_lists[by_list] + 1], rows[by_list])
+        offsets = offsets + np.concatenate([[0], np.cumsum(np.bincount(new_lists, minlength=n_lists))])
+
+        index = IVFIndex(self.centroids, order, offsets)
+        index.rows = self.rows
+        return index
+
+    def remap(self, keep):
+        """Follow a compaction of the matrix. The index is not changed, searches that still use it together with
+        the matrix before the compaction stay consistent.
+
+        :param np.array keep: sorted old row numbers that survived, the new row of keep[i] is i
+        :return: IVFIndex for the compacted matrix
+        """
+        new_rows = np.full(max(self.rows, int(keep[-1]) + 1 if len(keep) else 0), -1, dtype=np.int64)
+        new_rows[keep] = np.arange(len(keep))
+
+        lists = np.repeat(np.arange(len(self.centroids)), np.diff(self.offsets))
+        mapped = new_rows[self.order]
+        kept = mapped >= 0
+
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(lists[kept], minlength=len(self.centroids)))])
+        index = IVFIndex(self.centroids, mapped[kept], offsets)
+        index.rows = int(np.searchsorted(keep, self.rows))
+        return index
@@ -0,0 +1,343 @@
+import asyncio
+import csv
+import json
+
+import aiohttp
+
+from wdb_rest.cache import LRUCache
+from wdb_rest.client import default_url, error_message, TrackClient
+
+
+class AsyncTrackClient:
+    """
+    Asyncio client for communicating with the REST API
+
+    Offers the methods of TrackClient as coroutines, so thousands of reads can wait for the server at the same time
+    instead of one after another. At most max_concurrency requests are in flight at once, they share a pool of
+    kept alive connections. gather_tracks and gather_recommendations run many reads concurrently.
+
+    Example:
+        async with AsyncTrackClient('http://127.0.0.1:5000/api/') as client:
+            tracks = await client.gather_tracks(range(1, 1001))
+    """
+
+    retry_methods = TrackClient.retry_methods
+    retry_statuses = TrackClient.retry_statuses
+
+    def __init__(self, url=default_url, max_concurrency=100, validator_cache_size=1000, timeout=(3.05, 30),
+                 retries=3, backoff_factor=0.5):
+        """
+        Create an instance of a client. The connections are opened on the first request.
+
+        :param str url: URL of the REST server to connect to. Default value: http://127.0.0.1:5000/api/
+        :param int max_concurrency: most requests in flight (and connections open) at once.
+        :param int validator_cache_size: most responses remembered for revalidation, 0 disables it.
+        :param timeout: seconds to wait for the server, a number or a tuple(connect timeout, read timeout).
+        :param int retries: how often a failed request is retried, 0 disables retries.
+        :param float backoff_factor: retry n waits backoff_factor * 2 ** (n - 1) seconds.
+        :return: AsyncTrackClient instance
+        """
+        self.url = url
+        self.max_concurrency = max_concurrency
+        connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.session = None
+        self.semaphore = None
+        # (path, params) -> (ETag, response body) of earlier reads.
+        self.validator_cache = LRUCache(validator_cache_size, ttl=None)
+        # Reads answered with 304 Not Modified.
+        self.not_modified = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """Close the connections of the client."""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def get_session(self):
+        """Return the session of the client, created on first use because it belongs to the running event loop."""
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            # aiohttp resends GET, PUT and DELETE once when a kept alive connection breaks, it has no option for it.
+            # PUT creates tracks here, request decides on the retries itself.
+            self.session._retry_connection = False
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self.session
+
+    async def request(self, method, path, params=None, json_body=None, headers=None):
+        """
+        Send a request to a path of the API and read its body, retrying like TrackClient.
+
+        Connection errors are retried for retry_methods; the other methods are only retried if the connection could
+        not be opened, so the server never received them.
+
+        :param str method: HTTP method
+        :param str path: path relative to the API URL
+        :param dict params: URL parameters, None values are left out
+        :param json_body: JSON body of the request
+        :param dict headers: request headers
+        :return: tuple(HTTP response code, response headers, response body as bytes)
+        """
+        session = self.get_session()
+        params = {name: str(value) for name, value in (params or {}).items() if value is not None}
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                # Waits outside the semaphore, other requests use the slot meanwhile.
+                await asyncio.sleep(self.backoff_factor * 2 ** (attempt - 1))
+            async with self.semaphore:
+                try:
+                    async with session.request(method, self.url + path, params=params, json=json_body,
+                                               headers=headers) as r:
+                        body = await r.read()
+                except aiohttp.ClientConnectionError as e:
+                    # A request that failed to connect was never sent and is retried whatever its method. Once
+                    # connected the server may have received it, only retry_methods are sent again (a repeated PUT
+                    # would create the track twice), like TrackClient does.
+                    sent = not isinstance(e, aiohttp.ClientConnectorError)
+                    if attempt == self.retries or (sent and method not in self.retry_methods):
+                        raise
+                    continue
+            if r.status not in self.retry_statuses or method not in self.retry_methods or attempt == self.retries:
+                return r.status, r.headers, body
+
+    async def request_json(self, method, path, params=None, json_body=None):
+        """Send a request and return tuple(response JSON, HTTP response code)."""
+        status, headers, body = await self.request(method, path, params, json_body)
+        return json.loads(body), status
+
+    async def get_json(self, path, params=None):
+        """
+        GET a path of the API, revalidating a remembered response instead of downloading it again.
+
+        :param str path: path relative to the API URL
+        :param dict params: URL parameters, None values are left out
+        :return: tuple(response JSON, HTTP response code), 200 for revalidated responses
+        """
+        params = {name: value for name, value in (params or {}).items() if value is not None}
+        key = (path, tuple(sorted(params.items())))
+
+        cached = self.validator_cache.get(key)
+        headers = {'If-None-Match': cached[0]} if cached is not None else None
+        status, response_headers, body = await self.request('GET', path, params, headers=headers)
+
+        if status == 304 and cached is not None:
+            self.not_modified += 1
+            return json.loads(cached[1]), 200
+
+        if status == 200 and 'ETag' in response_headers:
+            self.validator_cache.set(key, (response_headers['ETag'], body))
+        return json.loads(body), status
+
+    async def create_track(self, track):
+        """
+        Create a new track, see TrackClient.create_track.
+
+        :param dict track: Dictionary with fields to create a new record.
+        :return: tuple(dict of created object, HTTP response code)
+        """
+        # Passed id=0 is ignored.
+        return await self.request_json('PUT', 'track/0', json_body=track)
+
+    async def get_tracks(self, sort_field='id', sort_order='asc', filter_field=None, filter_value=None, cursor=None,
+                         with_total=True, search=None, page=1):
+        """
+        Get a list of tracks based on sort and filter criteria, see TrackClient.get_tracks.
+
+        :return: tuple(dict of pagination attributes, HTTP response code)
+        """
+        params = {'sort_field': sort_field,
+                  'sort_order': sort_order,
+                  'filter_field': filter_field,
+                  'filter_value': filter_value,
+                  'cursor': cursor,
+                  'search': search}
+        if page != 1:
+            params['page'] = page
+        if not with_total:
+            params['with_total'] = 'false'
+
+        return await self.get_json('tracks/', params)
+
+    async def iter_tracks(self, sort_field='id', sort_order='asc', filter_field=None, filter_value=None, search=None,
+                          prefetch=10):
+        """
+        Iterate over all tracks matching sort and filter criteria, prefetching pages, see TrackClient.iter_tracks.
+
+        Example:
+            async for track in client.iter_tracks(sort_field='popularity', sort_order='desc'):
+                print(track['track'])
+
+        :param int prefetch: Pages fetched ahead of the current one. Default value: 10
+        :return: async iterator of track dicts
+        """
+        def fetch(page):
+            return asyncio.ensure_future(self.get_tracks(sort_field, sort_order, filter_field, filter_value,
+                                                         with_total=False, search=search, page=page))
+
+        prefetch = max(1, prefetch)
+        pending = [fetch(page) for page in range(1, prefetch + 1)]
+        next_page = prefetch + 1
+        try:
+            while pending:
+                response, status_code = await pending.pop(0)
+                if status_code != 200:
+                    raise Exception(error_message(response))
+
+                for track in response['items']:
+                    yield track
+                if not response['has_next']:
+                    return
+
+                pending.append(fetch(next_page))
+                next_page += 1
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def export_tracks(self, sort_field='id', sort_order='asc', filter_field=None, filter_value=None,
+                            search=None, export_format='ndjson'):
+        """
+        Iterate over all tracks matching sort and filter criteria, streamed in a single request, see
+        TrackClient.export_tracks.
+
+        :return: async iterator of track dicts
+        """
+        params = {'sort_field': sort_field,
+                  'sort_order': sort_order,
+                  'filter_field': filter_field,
+                  'filter_value': filter_value,
+                  'search': search,
+                  'format': export_format}
+        params = {name: value for name, value in params.items() if value is not None}
+
+        # Not limited by the semaphore, a long export must not hold a slot of the short requests.
+        async with self.get_session().get(self.url + 'tracks/export/', params=params) as r:
+            if r.status != 200:
+                raise Exception(error_message(await r.json()))
+
+            if export_format == 'csv':
+                header = None
+                async for line in r.content:
+                    values = next(csv.reader([line.decode('utf-8')]))
+                    if header is None:
+                        header = values
+                    elif values:
+                        yield dict(zip(header, values))
+            else:
+                async for line in r.content:
+                    if line.strip():
+                        yield json.loads(line)
+
+    async def get_track(self, track_id):
+        """
+        Return a single track by id.
+
+        :param int track_id: id of the track to retrieve.
+        :return: tuple(dict of requested object, HTTP response code)
+        """
+        return await self.get_json('track/' + str(track_id))
+
+    async def update_track(self, track):
+        """
+        Update an existing track, see TrackClient.update_track.
+
+        :param dict track: Dictionary with fields to update an existing track.
+        :return: tuple(dict of created object, HTTP response code)
+        """
+        return await self.request_json('PATCH', 'track/' + str(track['id']), json_body=track)
+
+    async def delete_track(self, track_id):
+        """
+        Delete a single track by id.
+
+        :param int track_id: id of the track to delete.
+        :return: tuple(empty dict, HTTP response code)
+        """
+        return await self.request_json('DELETE', 'track/' + str(track_id))
+
+    async def create_tracks(self, tracks):
+        """
+        Create many tracks in a single request and database transaction, see TrackClient.create_tracks.
+
+        :param list tracks: Dictionaries with fields to create new records.
+        :return: tuple(list of dicts, HTTP response code)
+        """
+        return await self.request_json('PUT', 'tracks/bulk/', json_body={'tracks': tracks})
+
+    async def update_tracks(self, tracks):
+        """
+        Update many existing tracks in a single request and database transaction, see TrackClient.update_tracks.
+
+        :param list tracks: Dictionaries with the id and the fields of existing tracks.
+        :return: tuple(list of dicts, HTTP response code)
+        """
+        return await self.request_json('PATCH', 'tracks/bulk/', json_body={'tracks': tracks})
+
+    async def delete_tracks(self, track_ids):
+        """
+        Delete many tracks by id in a single request and database transaction, see TrackClient.delete_tracks.
+
+        :param list track_ids: ids of the tracks to delete.
+        :return: tuple(list of dicts, HTTP response code)
+        """
+        return await self.request_json('DELETE', 'tracks/bulk/', json_body={'track_ids': track_ids})
+
+    async def recommend_tracks(self, track_id, how_many_recommendations):
+        """
+        Recommend me n tracks similar to my track based on id.
+
+        :param int track_id: id of the track to get recommendations for.
+        :param int how_many_recommendations: how many recommendations for the track
+        :return: tuple(list of dicts, HTTP response code)
+        """
+        params = {'how_many_recommendations': how_many_recommendations}
+        return await self.get_json('recommendation/' + str(track_id) + '/', params)
+
+    async def recommend_tracks_batch(self, track_ids, how_many_recommendations):
+        """
+        Recommend me n tracks similar to each of my tracks, in a single request, see
+        TrackClient.recommend_tracks_batch.
+
+        :param list track_ids: ids of the tracks to get recommendations for.
+        :param int how_many_recommendations: how many recommendations per track
+        :return: tuple(list of dicts, HTTP response code)
+        """
+        body = {'track_ids': track_ids, 'how_many_recommendations': how_many_recommendations}
+        return await self.request_json('POST', 'recommendations/', json_body=body)
+
+    async def gather_tracks(self, track_ids):
+        """
+        Get many tracks by id concurrently.
+
+        Example:
+            results = await client.gather_tracks([15, 16, 17])
+            tracks = [track for track, status_code in results if status_code == 200]
+
+        :param track_ids: ids of the tracks to retrieve.
+        :return: list of tuple(dict of requested object, HTTP response code), in the order of track_ids
+        """
+        return await asyncio.gather(*(self.get_track(track_id) for track_id in track_ids))
+
+    async def gather_recommendations(self, track_ids, how_many_recommendations):
+        """
+        Get recommendations for many tracks concurrently, one request per track.
+
+        For ids known up front recommend_tracks_batch needs fewer requests; this helper suits callers that want
+        a separate, individually cached and revalidated response per track.
+
+        :param track_ids: ids of the tracks to get recommendations for.
+        :param int how_many_recommendations: how many recommendations per track
+        :return: list of tuple(list of dicts, HTTP response code), in the order of track_ids
+        """
+        return await asyncio.gather(*(self.recommend_tracks(track_id, how_many_recommendations)
+                                      for track_id in track_ids))
@@ -0,0 +1,88 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe in-process cache with a size bound and a time to live.
+
+    Once the cache holds max_size entries, setting a new one evicts the least recently used entry. Entries
+    older than ttl seconds are treated as missing. Hits and misses are counted for monitoring.
+
+    Every clear starts a new generation. A value computed before a clear can be stored with the generation it
+    was computed in, set then drops it instead of caching a stale value.
+    """
+
+    def __init__(self, max_size=10000, ttl=300):
+        """
+        Initialize object.
+
+        :param int max_size: most entries held at once, 0 disables the cache.
+        :param float ttl: seconds an entry stays valid, None for no expiry.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+
+    def get(self, key, default=None, accept=None):
+        """Return the value stored for a key and mark it as recently used.
+
+        :param key: hashable key
+        :param default: returned (and counted as a miss) when the key is missing or expired
+        :param accept: optional function, a cached value it returns False for is treated as a miss
+        :return: cached value or default
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[0] >= self.ttl:
+                del self.entries[key]
+                entry = None
+
+            if entry is not None and (accept is None or accept(entry[1])):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            self.misses += 1
+            return default
+
+    def set(self, key, value, generation=None):
+        """Store a value, evicting the least recently used entry if the cache is full.
+
+        :param key: hashable key
+        :param value: value to store
+        :param int generation: generation the value was computed in, the value is dropped if the cache was
+                               cleared since. None to always store it.
+        :return: None
+        """
+        if self.max_size <= 0:
+            return
+
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """Drop all entries and start a new generation, the hit and miss counters are kept."""
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+    def stats(self):
+        """Return the size and the hit and miss counters of the cache.
+
+        :return: dict with size, max_size, hits, misses and hit_ratio
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return dict(size=len(self.entries), max_size=self.max_size, hits=self.hits, misses=self.misses,
+                        hit_ratio=self.hits / lookups if lookups else 0.0)
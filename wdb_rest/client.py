@@ -1,9 +1,25 @@
+import csv
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from wdb_rest.cache import LRUCache
 
 # If no URL is provided to the client, try to connect to local instance.
 default_url = 'http://127.0.0.1:5000/api/'
 
 
+def error_message(response):
+    """Return the message of an error response: msg of the API, message of Flask-RESTful (e.g. invalid arguments)."""
+    if not isinstance(response, dict):
+        return response
+    return response.get('msg') or response.get('message') or response
+
+
 class TrackClient:
     """
     Client for communicating with the REST API
@@ -12,18 +28,93 @@ class TrackClient:
     Additionally, it allows for filtering and sorting the results.
     """
 
-    def __init__(self, url=default_url):
+    # Retried when a request fails to connect or the server answers with one of retry_statuses. PUT is left out,
+    # it creates tracks and a retry could create a track twice.
+    retry_methods = frozenset(['GET', 'HEAD', 'OPTIONS', 'PATCH', 'DELETE'])
+    retry_statuses = frozenset([502, 503, 504])
+
+    def __init__(self, url=default_url, validator_cache_size=1000, pool_size=10, timeout=(3.05, 30), retries=3,
+                 backoff_factor=0.5):
         """
         Create an instance of a client.
 
+        Reads of tracks, track lists and recommendations are remembered with their ETag. Repeating a read sends
+        the ETag along, if nothing changed on the server it answers 304 Not Modified without a body and the
+        remembered response is returned.
+
         Example:
             from wdb_rest.client import TrackClient
             client = TrackClient('http://127.0.0.1:5000/api/')
 
         :param str url: URL of the REST server to connect to. Default value: http://127.0.0.1:5000/
+        :param int validator_cache_size: most responses remembered for revalidation, 0 disables it.
+        :param int pool_size: most connections kept open to the server, also the default prefetch of iter_tracks.
+        :param timeout: seconds to wait for the server, a number or a tuple(connect timeout, read timeout).
+        :param int retries: how often a failed request is retried, 0 disables retries.
+        :param float backoff_factor: retry n waits backoff_factor * 2 ** (n - 1) seconds.
         :return: TrackClient instance
         """
         self.url = url
+        self.timeout = timeout
+        self.pool_size = pool_size
+
+        # Connections are kept alive and reused by all requests, also from several threads.
+        retry = Retry(total=retries, connect=retries, read=retries, status=retries, backoff_factor=backoff_factor,
+                      status_forcelist=self.retry_statuses, allowed_methods=self.retry_methods,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # (path, params) -> (ETag, response body) of earlier reads.
+        self.validator_cache = LRUCache(validator_cache_size, ttl=None)
+        # Reads answered with 304 Not Modified.
+        self.not_modified = 0
+
+    def close(self):
+        """Close the connections of the client."""
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def request(self, method, path, **kwargs):
+        """
+        Send a request to a path of the API over the pooled session, with the timeout of the client.
+
+        :param str method: HTTP method
+        :param str path: path relative to the API URL
+        :param kwargs: passed to requests, like params, json or headers
+        :return: requests.Response
+        """
+        return self.session.request(method, self.url + path, timeout=self.timeout, **kwargs)
+
+    def get_json(self, path, params=None):
+        """
+        GET a path of the API, revalidating a remembered response instead of downloading it again.
+
+        :param str path: path relative to the API URL
+        :param dict params: URL parameters, None values are left out
+        :return: tuple(response JSON, HTTP response code), 200 for revalidated responses
+        """
+        params = {name: value for name, value in (params or {}).items() if value is not None}
+        key = (path, tuple(sorted(params.items())))
+
+        cached = self.validator_cache.get(key)
+        headers = {'If-None-Match': cached[0]} if cached is not None else {}
+        r = self.request('GET', path, params=params, headers=headers)
+
+        if r.status_code == 304 and cached is not None:
+            self.not_modified += 1
+            # Parsed again, so callers can modify what they get without changing the remembered response.
+            return json.loads(cached[1]), 200
+
+        if r.status_code == 200 and 'ETag' in r.headers:
+            self.validator_cache.set(key, (r.headers['ETag'], r.content))
+        return r.json(), r.status_code
 
     def create_track(self, track):
         """
@@ -50,10 +141,11 @@ class TrackClient:
         :return: tuple(dict of created object, HTTP response code)
         """
         # Passed id=0 is ignored.
-        r = requests.put(self.url + 'track/0', json=track)
+        r = self.request('PUT', 'track/0', json=track)
         return r.json(), r.status_code
 
-    def get_tracks(self, sort_field='id', sort_order='asc', filter_field=None, filter_value=None):
+    def get_tracks(self, sort_field='id', sort_order='asc', filter_field=None, filter_value=None, cursor=None,
+                   with_total=True, search=None, page=1):
         """
         Get a list of tracks based on sort and filter criteria.
 
@@ -65,27 +157,140 @@ class TrackClient:
         You can search on string fields using %like% search. Example: %Happy% will match all tracks that contain "Happy".
         For numerical fields, the match is always exact to the specified number.
 
+        To page through large results pass a cursor: an empty string for the first page, then the next_cursor
+        of the previous response. Deep pages are as fast as the first one.
+
+        If you do not need tracks_iter, pass with_total=False and the server skips counting the matching tracks.
+
+        search finds tracks whose track or artist name contains words starting with every given word, using the
+        full-text index of the server. Much faster than a %like% filter on large catalogs.
+
         Example:
             client.get_tracks(filter_field='track', filter_value='Beat%',
                               sort_field='danceability', sort_order='desc')
 
+            client.get_tracks(search='beat it')
+
+            page, status_code = client.get_tracks(sort_field='tempo', cursor='')
+            while page['has_next']:
+                page, status_code = client.get_tracks(sort_field='tempo', cursor=page['next_cursor'])
+
         :param str sort_field: Field to sort by. Default value: 'id'
         :param str sort_order: Ascending or descending order. Valid values: 'asc', 'desc'. Default value: 'asc'
         :param str filter_field: Field to filter by. No filter by default.
         :param str filter_value: Value to filter on. Supported %like% search for string fields.
+        :param str cursor: Cursor of the page to get, '' for the first page. No cursor pagination by default.
+        :param bool with_total: Count the matching tracks to fill tracks_iter. Default value: True
+        :param str search: Words to look up in track and artist names. No search by default.
+        :param int page: Page to get when paginating by page number. Default value: 1
         :return: tuple(dict of pagination attributes, HTTP response code)
                  pagination attributes: page:int, has_next:bool, has_prev:bool, 
-                                        tracks_iter:list(int), next_num:int, items:str (list of items that needs to be jsonified), 
+                                        tracks_iter:list(int), next_num:int, items:list(dict) (tracks of the current page), 
                                         prev_num=int
+                 with a cursor: has_next:bool, next_cursor:str, items:list(dict) (tracks of the current page)
+                 without total: tracks_iter is left out
         """
         # Prepare parameters for sending to the API.
         params = {'sort_field': sort_field,
                   'sort_order': sort_order,
                   'filter_field': filter_field,
-                  'filter_value': filter_value}
+                  'filter_value': filter_value,
+                  'cursor': cursor,
+                  'search': search}
+        if page != 1:
+            params['page'] = page
+        if not with_total:
+            params['with_total'] = 'false'
+
+        return self.get_json('tracks/', params)
+
+    def iter_tracks(self, sort_field='id', sort_order='asc', filter_field=None, filter_value=None, search=None,
+                    prefetch=None):
+        """
+        Iterate over all tracks matching sort and filter criteria, page by page.
 
-        r = requests.get(self.url + 'tracks/', params=params)
-        return r.json(), r.status_code
+        Takes the same criteria as get_tracks. While the caller works through a page, the following pages are
+        already being fetched on a thread pool, so the round trips overlap. Pages are fetched by number without
+        counting the matching tracks; writes during the iteration can shift tracks between pages. To read
+        everything in one request use export_tracks.
+
+        Example:
+            for track in client.iter_tracks(sort_field='popularity', sort_order='desc'):
+                print(track['track'])
+
+        :param str sort_field: Field to sort by. Default value: 'id'
+        :param str sort_order: Ascending or descending order. Valid values: 'asc', 'desc'. Default value: 'asc'
+        :param str filter_field: Field to filter by. No filter by default.
+        :param str filter_value: Value to filter on. Supported %like% search for string fields.
+        :param str search: Words to look up in track and artist names. No search by default.
+        :param int prefetch: Pages fetched ahead of the current one. Default value: pool_size of the client
+        :return: iterator of track dicts
+        """
+        prefetch = max(1, prefetch or self.pool_size)
+
+        def fetch(page):
+            return self.get_tracks(sort_field, sort_order, filter_field, filter_value, with_total=False,
+                                   search=search, page=page)
+
+        with ThreadPoolExecutor(max_workers=prefetch) as executor:
+            pending = deque(executor.submit(fetch, page) for page in range(1, prefetch + 1))
+            next_page = prefetch + 1
+            try:
+                while pending:
+                    response, status_code = pending.popleft().result()
+                    if status_code != 200:
+                        raise Exception(error_message(response))
+
+                    yield from response['items']
+                    if not response['has_next']:
+                        return
+
+                    pending.append(executor.submit(fetch, next_page))
+                    next_page += 1
+            finally:
+                # Pages past the last one are not needed anymore.
+                for future in pending:
+                    future.cancel()
+
+    def export_tracks(self, sort_field='id', sort_order='asc', filter_field=None, filter_value=None, search=None,
+                      export_format='ndjson'):
+        """
+        Iterate over all tracks matching sort and filter criteria, streamed in a single request.
+
+        Takes the same criteria as get_tracks. The tracks are read from the response while it is being received,
+        so the whole catalog can be exported without holding it in memory.
+
+        Example:
+            for track in client.export_tracks(filter_field='decade', filter_value='80s'):
+                print(track['track'])
+
+        :param str sort_field: Field to sort by. Default value: 'id'
+        :param str sort_order: Ascending or descending order. Valid values: 'asc', 'desc'. Default value: 'asc'
+        :param str filter_field: Field to filter by. No filter by default.
+        :param str filter_value: Value to filter on. Supported %like% search for string fields.
+        :param str search: Words to look up in track and artist names. No search by default.
+        :param str export_format: 'ndjson' (typed values) or 'csv' (all values are strings). Default value: 'ndjson'
+        :return: iterator of track dicts
+        """
+        params = {'sort_field': sort_field,
+                  'sort_order': sort_order,
+                  'filter_field': filter_field,
+                  'filter_value': filter_value,
+                  'search': search,
+                  'format': export_format}
+
+        with self.request('GET', 'tracks/export/', params=params, stream=True) as r:
+            if r.status_code != 200:
+                raise Exception(error_message(r.json()))
+
+            r.encoding = 'utf-8'
+            lines = r.iter_lines(decode_unicode=True)
+            if export_format == 'csv':
+                yield from csv.DictReader(lines)
+            else:
+                for line in lines:
+                    if line:
+                        yield json.loads(line)
 
     def get_track(self, track_id):
         """
@@ -97,8 +302,7 @@ class TrackClient:
         :param int track_id: id of the track to retrieve.
         :return: tuple(dict of requested object, HTTP response code)
         """
-        r = requests.get(self.url + 'track/' + str(track_id))
-        return r.json(), r.status_code
+        return self.get_json('track/' + str(track_id))
 
     def update_track(self, track):
         """
@@ -117,7 +321,7 @@ class TrackClient:
         :param dict track: Dictionary with fields to update an existing track.
         :return: tuple(dict of created object, HTTP response code)
         """
-        r = requests.patch(self.url + 'track/' + str(track['id']), json=track)
+        r = self.request('PATCH', 'track/' + str(track['id']), json=track)
         return r.json(), r.status_code
 
     def delete_track(self, track_id):
@@ -130,7 +334,58 @@ class TrackClient:
         :param int track_id: id of the track to delete.
         :return: tuple(empty string, HTTP response code)
         """
-        r = requests.delete(self.url + 'track/' + str(track_id))
+        r = self.request('DELETE', 'track/' + str(track_id))
+        return r.json(), r.status_code
+
+    def create_tracks(self, tracks):
+        """
+        Create many tracks in a single request and database transaction.
+
+        All fields are mandatory, like for create_track. Invalid tracks are reported and skipped, the valid ones
+        are created. At most 10000 tracks can be passed per call.
+
+        Example:
+            results, status_code = client.create_tracks([track, other_track])
+            created_ids = [result['track']['id'] for result in results if result['status'] == 201]
+
+        :param list tracks: Dictionaries with fields to create new records.
+        :return: tuple(list of dicts, HTTP response code)
+                 one dict per track, in request order: status:201 and track:dict of the created track,
+                 or status:400 and msg:str if the track is invalid
+        """
+        r = self.request('PUT', 'tracks/bulk/', json={'tracks': tracks})
+        return r.json(), r.status_code
+
+    def update_tracks(self, tracks):
+        """
+        Update many existing tracks in a single request and database transaction.
+
+        Every track needs its id and all other fields, like for update_track. At most 10000 tracks per call.
+
+        Example:
+            results, status_code = client.update_tracks([track, other_track])
+
+        :param list tracks: Dictionaries with the id and the fields of existing tracks.
+        :return: tuple(list of dicts, HTTP response code)
+                 one dict per track, in request order: track_id:int and status:200 and track:dict of the updated
+                 track, status:404 and msg:str if the track does not exist or status:400 and msg:str if it is invalid
+        """
+        r = self.request('PATCH', 'tracks/bulk/', json={'tracks': tracks})
+        return r.json(), r.status_code
+
+    def delete_tracks(self, track_ids):
+        """
+        Delete many tracks by id in a single request and database transaction. At most 10000 ids per call.
+
+        Example:
+            results, status_code = client.delete_tracks([25, 26, 27])
+
+        :param list track_ids: ids of the tracks to delete.
+        :return: tuple(list of dicts, HTTP response code)
+                 one dict per id, in request order: track_id:int and status:200,
+                 or track_id:int, status:404 and msg:str if the track does not exist
+        """
+        r = self.request('DELETE', 'tracks/bulk/', json={'track_ids': track_ids})
         return r.json(), r.status_code
 
     def recommend_tracks(self, track_id, how_many_recommendations):
@@ -146,5 +401,25 @@ class TrackClient:
 
         params = {'how_many_recommendations': how_many_recommendations}
 
-        r = requests.get(self.url + 'recommendation/' + str(track_id), params)
+        return self.get_json('recommendation/' + str(track_id) + '/', params)
+
+    def recommend_tracks_batch(self, track_ids, how_many_recommendations):
+        """
+        Recommend me n tracks similar to each of my tracks, in a single request.
+
+        At most 1000 track ids can be passed per call.
+
+        Example:
+            client.recommend_tracks_batch([25, 26, 27], 10)
+
+        :param list track_ids: ids of the tracks to get recommendations for.
+        :param int how_many_recommendations: how many recommendations per track
+        :return: tuple(list of dicts, HTTP response code)
+                 one dict per requested track, in request order: track_id:int and recommendations:list(dict),
+                 or track_id:int and msg:str if the track does not exist
+        """
+
+        body = {'track_ids': track_ids, 'how_many_recommendations': how_many_recommendations}
+
+        r = self.request('POST', 'recommendations/', json=body)
         return r.json(), r.status_code
@@ -0,0 +1,96 @@
+import json
+import os
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+# Settings are read from the JSON file named by WDB_REST_CONFIG, then from WDB_REST_<SETTING NAME> variables.
+env_prefix = 'WDB_REST_'
+
+# Applied to every new SQLite connection. With the write-ahead log readers keep reading while a writer commits,
+# NORMAL sync is safe in WAL mode and skips one fsync per commit, mmap_size and cache_size (negative: KiB) keep
+# pages in memory and busy_timeout makes a second writer wait for the lock instead of failing.
+default_sqlite_pragmas = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 268435456,
+    'cache_size': -65536,
+    'busy_timeout': 5000,
+    'temp_store': 'MEMORY'
+}
+
+
+def load_config(config):
+    """
+    Override settings of a Flask config from a JSON file and from environment variables.
+
+    The file is named by WDB_REST_CONFIG and holds a JSON object of settings. Environment variables override
+    single settings that already have a default: WDB_REST_SQLALCHEMY_DATABASE_URI overrides
+    SQLALCHEMY_DATABASE_URI, WDB_REST_RECOMMENDATION_CACHE_TTL overrides recommendation_cache_ttl. Values are
+    parsed as JSON, values that are not JSON are taken as strings.
+
+    :param config: flask.Config with the default settings
+    :return: None
+    """
+    path = os.environ.get(env_prefix + 'CONFIG')
+    if path:
+        with open(path) as f:
+            config.update(json.load(f))
+
+    for name in list(config):
+        value = os.environ.get(env_prefix + name.upper())
+        if value is None:
+            continue
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+        config[name] = value
+
+
+def is_sqlite_file(uri):
+    """Return True for a URI of a SQLite database file (not an in-memory database)."""
+    url = make_url(uri)
+    return url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:')
+
+
+def default_engine_options(uri, pool_size=10):
+    """
+    Engine options for a database URI, SQLALCHEMY_ENGINE_OPTIONS of the config override them.
+
+    SQLite files get a pool of connections shared across threads, so the pragmas and the page cache of a connection
+    are kept between requests instead of opening the file for every one. Server databases use the pool defaults
+    of SQLAlchemy.
+
+    :param str uri: database URI
+    :param int pool_size: connections kept open for SQLite files
+    :return: dict of options for create_engine
+    """
+    if not is_sqlite_file(uri):
+        return {}
+    return {'poolclass': QueuePool,
+            'pool_size': pool_size,
+            'max_overflow': pool_size,
+            'connect_args': {'check_same_thread': False}}
+
+
+def set_sqlite_pragmas(engine, pragmas):
+    """
+    Apply pragmas to every new connection of a SQLite engine, other engines are left alone.
+
+    :param engine: SQLAlchemy engine
+    :param dict pragmas: pragma name to value, for example {'journal_mode': 'WAL'}
+    :return: None
+    """
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return
+
+    statements = [f'PRAGMA {name} = {value}' for name, value in pragmas.items()]
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
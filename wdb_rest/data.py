@@ -1,30 +1,71 @@
+import base64
 import json
 import os
-import numpy as np
-from scipy.spatial import distance
-import pandas as pd
+import threading
+import time
 
-from sqlalchemy import literal_column
-from sqlalchemy.orm import load_only
+from sqlalchemy import String, bindparam, func, literal_column, text, tuple_
+
+from wdb_rest.cache import LRUCache
+from wdb_rest.json_encoders import ColumnSerializer
+from wdb_rest.metrics import recommendation_compute_seconds, recommendation_fetch_seconds, \
+    recommendation_matrix_load_seconds
+
+def whole_number(value):
+    """Convert a value of an integer field, int alone would cut 6.7 down to 6 instead of rejecting it."""
+    if isinstance(value, float) and not value.is_integer():
+        raise ValueError(f'{value} is not a whole number.')
+    return int(value)
 
-from wdb_rest.json_encoders import AlchemyEncoder, NumpyArrayEncoder
 
 class TrackDAO:
     """
     Data access object for reading Tracks from the database.
     """
 
-    def __init__(self, db, track_model):
+    # Largest number of ids passed to a single IN (...) query.
+    max_query_parameters = 30000
+    # Tracks per page of get_tracks_list.
+    per_page = 10
+    # Tracks read per query by export_tracks.
+    export_batch_size = 1000
+    # Most tracks or ids accepted by a single bulk write.
+    max_bulk_tracks = 10000
+    # Catalog versions kept in the change log. A server process that falls further behind reloads its
+    # recommendation matrix instead of applying the changes.
+    catalog_change_versions = 1000
+
+    def __init__(self, db, track_model, recommendation_cache_size=10000, recommendation_cache_ttl=300,
+                 count_cache_size=1000, count_cache_ttl=300, track_fields=None):
         """
         Initialize object.
 
         :param db: SQLAlcemy instance of database.
         :param track_model: Model to access.
+        :param int recommendation_cache_size: most tracks whose recommendations are cached, 0 disables the cache.
+        :param float recommendation_cache_ttl: seconds cached recommendations stay valid.
+        :param int count_cache_size: most filters whose number of tracks is cached, 0 disables the cache.
+        :param float count_cache_ttl: seconds cached numbers of tracks stay valid.
+        :param dict track_fields: Flask-RESTful fields of the model, the columns and types of listed tracks.
         """
         self.db = db
         self.track_model = track_model
+        # Kept up to date on every write once set_recommendation_matrix was called.
+        self.recommendation_engine = None
+        # Arguments of the last set_recommendation_matrix call, a full reload repeats it.
+        self.recommendation_matrix_args = None
+        # Catalog version the recommendation engine and the caches reflect, see sync_catalog.
+        self.catalog_version = None
+        self.sync_lock = threading.Lock()
+        # Recommendation results by track id, cleared on every write.
+        self.recommendation_cache = LRUCache(recommendation_cache_size, recommendation_cache_ttl)
+        # Number of tracks per (filter_field, filter_value), cleared on every write.
+        self.count_cache = LRUCache(count_cache_size, count_cache_ttl)
+        # Lists read plain column tuples and serialize them without going through model objects.
+        self.serializer = ColumnSerializer(track_model, track_fields)
 
-    def get_tracks_list(self, filter_field=None, filter_value=None, sort_field='id', sort_order='asc', page=1):
+    def get_tracks_list(self, filter_field=None, filter_value=None, sort_field='id', sort_order='asc', page=1,
+                        cursor=None, with_total=True, search=None):
         """
         Get a list of tracks based on sort and filter criteria.
 
@@ -34,6 +75,20 @@ class TrackDAO:
         You can search on string fields using %like% search. Example: %Happy% will match all tracks that contain "Happy".
         For numerical fields, the match is always exact to the sepcified number.
 
+        Tracks with the same value in the sort field are ordered by id, so the order is stable.
+
+        search looks up words in the track and artist names through the full-text index instead of scanning
+        the table: every word must match the start of a word of the track or the artist, case-insensitive.
+        Example: search='beat it' matches "Beat It" and "Beats of Italy". It can be combined with a filter.
+
+        Passing a cursor (an empty string for the first page) switches from page numbers to cursor pagination:
+        the cursor encodes the last track of the previous page and the next page starts right after it, so
+        every page costs the same no matter how deep it is. Use next_cursor of the response to get the next page.
+
+        Page numbers need the total number of matching tracks for tracks_iter. Totals are counted once per
+        filter and cached until the next write. With with_total=False nothing is counted, one extra row tells
+        whether there is a next page and tracks_iter is left out.
+
         Example:
             track_dao.get_tracks_list(filter_field='track', filter_value='Beat%',
                                       sort_field='danceability', sort_order='desc')
@@ -42,24 +97,66 @@ class TrackDAO:
         :param str sort_order: Ascending or descending order. Valid values: 'asc', 'desc'. Default value: 'asc'
         :param str filter_field: Field to filter by. No filter by default.
         :param str filter_value: Value to filter on. Supported %like% search for string fields.
+        :param int page: Page to return when paginating by page number.
+        :param str cursor: Cursor of the page to return, '' for the first page. None paginates by page number.
+        :param bool with_total: Count the matching tracks to fill tracks_iter.
+        :param str search: Words to look up in track and artist names. No search by default.
         :return: tuple(dict of pagination attributes, HTTP response code)
                  pagination attributes: page:int, has_next:bool, has_prev:bool, 
-                                        tracks_iter:list(int), next_num:int, items:json (list of items for current page), 
+                                        tracks_iter:list(int), next_num:int, items:list(dict) (tracks of the current page), 
                                         prev_num=int
+                 without total: page:int, has_next:bool, has_prev:bool, next_num:int, items:list(dict), prev_num=int
+                 with a cursor: has_next:bool, next_cursor:str, items:list(dict) (tracks of the current page)
         """
 
+        query = self.build_tracks_query(filter_field, filter_value, sort_field, sort_order, search)
+
+        if cursor is not None:
+            return self.get_tracks_page_after(query, sort_field, sort_order, cursor)
+
+        if not with_total:
+            return self.get_tracks_page_without_total(query, page)
+
+        # Request pagination from the database, the total comes from the count cache.
+        tracks = query.with_entities(*self.serializer.columns).paginate(page=page, per_page=self.per_page,
+                                                                        count=False)
+        tracks.total = self.count_tracks(query, filter_field, filter_value, search)
+
+        # Iterate instead of returning dictionary at once.
+        pages_nums = []
+        for page_num in tracks.iter_pages():
+            pages_nums.append(page_num)
+
+        # Create response object.
+        items = self.serializer.to_dicts(tracks.items)
+        return dict(page=tracks.page, has_next=tracks.has_next, has_prev=tracks.has_prev,
+                       tracks_iter=pages_nums, next_num=tracks.next_num, items=items, prev_num=tracks.prev_num)
+
+    def build_tracks_query(self, filter_field=None, filter_value=None, sort_field='id', sort_order='asc',
+                           search=None):
+        """
+        Build the sorted and filtered track query shared by the track list and the export.
+
+        :param str filter_field: Field to filter by. No filter by default.
+        :param str filter_value: Value to filter on. Supported %like% search for string fields.
+        :param str sort_field: Field to sort by. Default value: 'id'
+        :param str sort_order: Ascending or descending order. Valid values: 'asc', 'desc'. Default value: 'asc'
+        :param str search: Words to look up in track and artist names. No search by default.
+        :return: track query
+        """
         # Create query object for track_model.
         query = self.track_model.query
 
         # Sort by the user-provided column.
         if getattr(self.track_model, sort_field, None) is None:
             raise Exception(f'Provided sort_field {sort_field} does not exist.')
+        sort_column = getattr(self.track_model, sort_field)
 
-        # Check if sorting order is valid.
+        # Check if sorting order is valid, ties are broken by id.
         if sort_order == 'asc':
-            query = query.order_by(getattr(self.track_model, sort_field))
+            query = query.order_by(sort_column, self.track_model.id)
         elif sort_order == 'desc':
-            query = query.order_by(getattr(self.track_model, sort_field).desc())
+            query = query.order_by(sort_column.desc(), self.track_model.id.desc())
         else:
             raise Exception(f'Provided sort_order {sort_order} is invalid. Use asc or desc.')
 
@@ -75,37 +172,303 @@ class TrackDAO:
             else:
                 query = query.filter(getattr(self.track_model, filter_field) == filter_value)
 
-        # Request pagination from the database.
-        tracks = query.paginate(page=page, per_page=10)
+        # Full-text search on track and artist names.
+        if search is not None:
+            match = self.build_search_query(search)
+            if match is None:
+                raise Exception('Provided search is empty.')
+            query = query.filter(self.track_model.id.in_(
+                text('SELECT rowid FROM track_search WHERE track_search MATCH :match').bindparams(match=match)))
 
-        # Iterate instead of returning dictionary at once.
-        pages_nums = []
-        for page_num in tracks.iter_pages():
-            pages_nums.append(page_num)
+        return query
 
-        # Create response object.
-        items = json.dumps(tracks.items, cls=AlchemyEncoder)
-        return dict(page=tracks.page, has_next=tracks.has_next, has_prev=tracks.has_prev,
-                       tracks_iter=pages_nums, next_num=tracks.next_num, items=items, prev_num=tracks.prev_num)
+    def get_tracks_page_without_total(self, query, page):
+        """
+        Get a page of a sorted query without counting all matching tracks.
+
+        :param query: sorted and filtered track query
+        :param int page: page to return
+        :return: dict with page:int, has_next:bool, has_prev:bool, next_num:int, items:list(dict), prev_num=int
+        """
+        if page < 1:
+            raise Exception(f'Provided page {page} is invalid.')
+
+        # One extra row tells whether there is a next page.
+        tracks = query.with_entities(*self.serializer.columns).limit(self.per_page + 1) \
+            .offset((page - 1) * self.per_page).all()
+        has_next = len(tracks) > self.per_page
+        has_prev = page > 1
+
+        items = self.serializer.to_dicts(tracks[:self.per_page])
+        return dict(page=page, has_next=has_next, has_prev=has_prev, next_num=page + 1 if has_next else None,
+                    items=items, prev_num=page - 1 if has_prev else None)
+
+    def count_tracks(self, query, filter_field, filter_value, search=None):
+        """
+        Count the tracks matching a filter, cached per filter until the next write.
+
+        :param query: filtered track query
+        :param str filter_field: field the query is filtered by
+        :param str filter_value: value the query is filtered on
+        :param str search: words the query searches for
+        :return: int number of matching tracks
+        """
+        # Queries are only filtered when both are given.
+        key = (filter_field, filter_value) if filter_field is not None and filter_value is not None else None
+        if search is not None:
+            key = (key, search)
+
+        total = self.count_cache.get(key)
+        if total is None:
+            generation = self.count_cache.generation
+            total = query.order_by(None).count()
+            self.count_cache.set(key, total, generation)
+        return total
+
+    def get_tracks_page_after(self, query, sort_field, sort_order, cursor):
+        """
+        Get the page of a sorted query that follows a cursor.
+
+        The query seeks directly to the first row after the cursor (sort value, id) instead of skipping rows
+        with OFFSET, one extra row tells whether there is a next page.
+
+        :param query: sorted and filtered track query
+        :param str sort_field: field the query is sorted by
+        :param str sort_order: 'asc' or 'desc'
+        :param str cursor: cursor returned with the previous page, '' for the first page
+        :return: dict with has_next:bool, next_cursor:str or None, items:list(dict)
+        """
+        if sort_field not in self.track_model.__table__.columns.keys():
+            raise Exception(f'Provided sort_field {sort_field} does not exist.')
+
+        if cursor:
+            last_value, last_id = self.decode_cursor(cursor, sort_field, sort_order)
+            query = self.seek_after(query, sort_field, sort_order, last_value, last_id)
+
+        tracks = query.with_entities(*self.serializer.columns).limit(self.per_page + 1).all()
+        has_next = len(tracks) > self.per_page
+        items = self.serializer.to_dicts(tracks[:self.per_page])
+
+        next_cursor = None
+        if has_next:
+            next_cursor = self.encode_cursor(sort_field, sort_order, items[-1][sort_field], items[-1]['id'])
+
+        return dict(has_next=has_next, next_cursor=next_cursor, items=items)
+
+    def seek_after(self, query, sort_field, sort_order, last_value, last_id):
+        """
+        Filter a sorted query to the tracks after a position (sort value, id).
+
+        :param query: track query sorted by sort_field and id
+        :param str sort_field: field the query is sorted by
+        :param str sort_order: 'asc' or 'desc'
+        :param last_value: sort value of the last track already read
+        :param int last_id: id of the last track already read
+        :return: filtered track query
+        """
+        # A row value comparison lets the database seek in the (sort_field, id) index, the equivalent
+        # OR of comparisons makes SQLite scan the index from the start.
+        position = tuple_(getattr(self.track_model, sort_field), self.track_model.id)
+        if sort_order == 'asc':
+            return query.filter(position > tuple_(last_value, last_id))
+        return query.filter(position < tuple_(last_value, last_id))
 
-    def get_track_recommendations(self, track_id, how_many_recommendations, recommendation_matrix):
+    def export_tracks(self, filter_field=None, filter_value=None, sort_field='id', sort_order='asc', search=None,
+                      batch_size=None):
+        """
+        Read all tracks matching sort and filter criteria, batch by batch.
+
+        The criteria are the ones of get_tracks_list and are checked right away, so invalid criteria raise here
+        and not while the result is being streamed. Every batch seeks past the last track of the previous one
+        like cursor pagination does, so only one batch is held in memory however large the catalog is.
+
+        Example:
+            for tracks in track_dao.export_tracks(sort_field='popularity', sort_order='desc'):
+                ...
+
+        :param str filter_field: Field to filter by. No filter by default.
+        :param str filter_value: Value to filter on. Supported %like% search for string fields.
+        :param str sort_field: Field to sort by. Default value: 'id'
+        :param str sort_order: Ascending or descending order. Valid values: 'asc', 'desc'. Default value: 'asc'
+        :param str search: Words to look up in track and artist names. No search by default.
+        :param int batch_size: Tracks read per query. Default value: export_batch_size
+        :return: generator of lists of track dicts
+        """
+        if sort_field not in self.track_model.__table__.columns.keys():
+            raise Exception(f'Provided sort_field {sort_field} does not exist.')
+        query = self.build_tracks_query(filter_field, filter_value, sort_field, sort_order, search)
+        query = query.with_entities(*self.serializer.columns)
+        return self.iter_track_batches(query, sort_field, sort_order, batch_size or self.export_batch_size)
+
+    def iter_track_batches(self, query, sort_field, sort_order, batch_size):
+        """Yield the tracks of a sorted column query in batches of batch_size, see export_tracks."""
+        last = None
+        while True:
+            batch_query = query
+            if last is not None:
+                batch_query = self.seek_after(query, sort_field, sort_order, last[sort_field], last['id'])
+
+            tracks = self.serializer.to_dicts(batch_query.limit(batch_size).all())
+            if tracks:
+                yield tracks
+            if len(tracks) < batch_size:
+                return
+            last = tracks[-1]
+
+    @staticmethod
+    def build_search_query(search):
+        """Turn the words of a search into an FTS5 query that matches tracks containing all of them as prefixes.
+
+        Every word is quoted, so FTS5 operators and punctuation in the search are matched literally.
+
+        :param str search: words to search for
+        :return: str FTS5 MATCH expression, None if the search has no words
+        """
+        words = [word.replace('"', '') for word in search.split()]
+        words = [word for word in words if word]
+        if not words:
+            return None
+        return ' '.join(f'"{word}"*' for word in words)
+
+    @staticmethod
+    def encode_cursor(sort_field, sort_order, value, track_id):
+        """Encode the position after a track as an opaque, URL safe cursor."""
+        position = json.dumps([sort_field, sort_order, value, track_id]).encode('utf-8')
+        return base64.urlsafe_b64encode(position).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(cursor, sort_field, sort_order):
+        """Decode a cursor made by encode_cursor for the same sort field and order.
+
+        :return: tuple(sort value, track id) of the last track of the previous page
+        """
+        try:
+            cursor_field, cursor_order, value, track_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        except Exception:
+            raise Exception('Provided cursor is invalid.')
+        if cursor_field != sort_field or cursor_order != sort_order:
+            raise Exception('Provided cursor belongs to a different sort_field or sort_order.')
+        return value, track_id
+
+    def get_track_recommendations(self, track_id, how_many_recommendations, recommendation_engine):
         """
         Recommend me n tracks similar to my track based on id.
 
         Example:
             client.recommend_track(25, 10)
 
-        :param int track_id: id of the track to delete.
-        :paran np.array recommendation_matrix: matrix of track information used for recommendation
+        :param int track_id: id of the track to get recommendations for.
         :param int how_many_recommendations: how many recommendations for the track
+        :param SimilarityEngine recommendation_engine: engine holding the recommendation matrix
+        :return: list of tracks, most similar first
         """
 
-        try:
-            track_array = recommendation_matrix[track_id]
-        except:
-            raise Exception("Invalid track id or track not found.")
-        recommendation_indeces = self.get_sorted_recommendation_indeces(track_array, recommendation_matrix)
-        return self.track_model.query.filter(self.track_model.id.in_(recommendation_indeces[0][0:how_many_recommendations].tolist())).all()
+        cached = self.get_cached_recommendations(track_id, how_many_recommendations)
+        if cached is not None:
+            return cached
+        generation = self.recommendation_cache.generation
+
+        start = time.perf_counter()
+        recommended_ids, _ = recommendation_engine.top_k(track_id, how_many_recommendations)
+        recommended_ids = recommended_ids.tolist()
+        computed = time.perf_counter()
+        recommendation_compute_seconds.observe(computed - start, kind='single')
+
+        # The database returns the tracks in arbitrary order, restore the ranking.
+        tracks_by_id = self.get_tracks_by_ids(recommended_ids)
+        tracks = [tracks_by_id[i] for i in recommended_ids if i in tracks_by_id]
+        recommendation_fetch_seconds.observe(time.perf_counter() - computed, kind='single')
+
+        self.cache_recommendations(track_id, how_many_recommendations, recommended_ids, tracks, generation)
+        return tracks
+
+    def get_batch_track_recommendations(self, track_ids, how_many_recommendations, recommendation_engine):
+        """
+        Recommend me n tracks similar to each of my tracks.
+
+        All similarities are computed by the engine in one batch and all recommended tracks are fetched from
+        the database together.
+
+        Example:
+            track_dao.get_batch_track_recommendations([25, 26, 27], 10, recommendation_engine)
+
+        :param list track_ids: ids of the tracks to get recommendations for.
+        :param int how_many_recommendations: how many recommendations per track
+        :param SimilarityEngine recommendation_engine: engine holding the recommendation matrix
+        :return: list with a list of tracks (most similar first) per requested track, None for invalid track ids
+        """
+
+        recommendations = [self.get_cached_recommendations(track_id, how_many_recommendations)
+                           for track_id in track_ids]
+        missing = [i for i, tracks in enumerate(recommendations) if tracks is None]
+        generation = self.recommendation_cache.generation
+
+        start = time.perf_counter()
+        results = recommendation_engine.top_k_batch([track_ids[i] for i in missing], how_many_recommendations)
+        recommended_ids = [result[0].tolist() if result is not None else None for result in results]
+        computed = time.perf_counter()
+        recommendation_compute_seconds.observe(computed - start, kind='batch')
+
+        tracks_by_id = self.get_tracks_by_ids({i for ids in recommended_ids if ids is not None for i in ids})
+        recommendation_fetch_seconds.observe(time.perf_counter() - computed, kind='batch')
+        for i, ids in zip(missing, recommended_ids):
+            if ids is None:
+                continue
+            recommendations[i] = [tracks_by_id[track_id] for track_id in ids if track_id in tracks_by_id]
+            self.cache_recommendations(track_ids[i], how_many_recommendations, ids, recommendations[i], generation)
+
+        return recommendations
+
+    def get_cached_recommendations(self, track_id, how_many_recommendations):
+        """
+        Return cached recommendations for a track.
+
+        Recommendations cached for a larger number of recommendations also serve smaller ones.
+
+        :param int track_id: id of the track to get recommendations for.
+        :param int how_many_recommendations: how many recommendations for the track
+        :return: list of tracks or None if nothing usable is cached
+        """
+        cached = self.recommendation_cache.get(
+            track_id, accept=lambda entry: entry[0] >= how_many_recommendations or entry[2])
+        if cached is None:
+            return None
+        return cached[1][:how_many_recommendations]
+
+    def cache_recommendations(self, track_id, how_many_recommendations, recommended_ids, tracks, generation):
+        """
+        Cache recommendations for a track.
+
+        The tracks are cached as copies that do not belong to any database session.
+
+        :param int track_id: id of the track the recommendations are for.
+        :param int how_many_recommendations: how many recommendations were requested
+        :param list recommended_ids: ids returned by the recommendation engine
+        :param list tracks: recommended tracks
+        :param int generation: cache generation before the recommendations were computed
+        :return: None
+        """
+        # The engine returned fewer tracks than requested, so there are no more to recommend.
+        complete = len(recommended_ids) < how_many_recommendations
+        columns = self.track_model.__table__.columns.keys()
+        copies = [self.track_model(**{column: getattr(track, column) for column in columns}) for track in tracks]
+        self.recommendation_cache.set(track_id, (how_many_recommendations, copies, complete), generation)
+
+    def get_tracks_by_ids(self, track_ids):
+        """
+        Load many tracks by id with as few queries as possible.
+
+        :param track_ids: ids of the tracks to load
+        :return: dict track id -> track
+        """
+        track_ids = list(track_ids)
+        tracks_by_id = {}
+        # Stay below the bound parameter limit of the database.
+        for start in range(0, len(track_ids), self.max_query_parameters):
+            chunk = track_ids[start:start + self.max_query_parameters]
+            for track in self.track_model.query.filter(self.track_model.id.in_(chunk)):
+                tracks_by_id[track.id] = track
+        return tracks_by_id
 
     def create_track(self, args):
         """
@@ -141,10 +504,17 @@ class TrackDAO:
         track_id = track.id
 
         # Commit transaction to create the object.
+        version = self.bump_catalog_version([track_id])
         self.db.session.commit()
 
         # Load track from the database.
-        return self.track_model.query.filter_by(id=track_id).first()
+        track = self.track_model.query.filter_by(id=track_id).first()
+
+        if self.recommendation_engine is not None:
+            self.recommendation_engine.set_track(track)
+        self.catalog_written(version)
+
+        return track
 
     def get_track_by_id(self, track_id):
         """
@@ -186,9 +556,16 @@ class TrackDAO:
             raise Exception('Cannot update track, track_id does not exist.')
 
         self.track_model.query.filter_by(id=track_id).update(args)
+        version = self.bump_catalog_version([track_id])
         self.db.session.commit()
 
-        return self.track_model.query.filter_by(id=track_id).first()
+        track = self.track_model.query.filter_by(id=track_id).first()
+
+        if self.recommendation_engine is not None:
+            self.recommendation_engine.set_track(track)
+        self.catalog_written(version)
+
+        return track
 
     def delete_track_by_id(self, track_id):
         """
@@ -206,63 +583,488 @@ class TrackDAO:
             raise Exception(f'Cannot delete track, track_id = {track_id} does not exist.')
 
         self.db.session.delete(track)
+        version = self.bump_catalog_version([track_id])
         self.db.session.commit()
 
-    def set_recommendation_matrix(self, path, columns_to_be_vectorized):
-        """Get all songs from DB and save them as a numpy file (recommendation_matrix.npy) 
-        if it doesn't exist already
+        if self.recommendation_engine is not None:
+            self.recommendation_engine.remove_track(track_id)
+        self.catalog_written(version)
+
+    def create_tracks(self, tracks):
+        """
+        Create many tracks in a single transaction.
+
+        Every track is validated like create_track (all fields are mandatory), valid tracks are inserted with
+        one batched statement and committed together, invalid ones are skipped.
+
+        Example:
+            results = track_dao.create_tracks([args, other_args])
+
+        :param list tracks: Dictionaries with fields to create new records.
+        :return: list of dicts, one per track in input order:
+                 status:201 and track:dict of the created track, or status:400 and msg:str
+        """
+        self.check_bulk_size(tracks)
+        results, valid = self.validate_tracks(tracks)
+        if not valid:
+            return results
+
+        models = [self.track_model(**row) for row, _ in valid]
+        try:
+            self.db.session.add_all(models)
+            # The database assigns the ids when the rows are flushed, any database and concurrent inserts included.
+            self.db.session.flush()
+            track_ids = [model.id for model in models]
+            version = self.bump_catalog_version(track_ids)
+            self.db.session.commit()
+        except Exception:
+            self.db.session.rollback()
+            raise
+
+        created = []
+        for track_id, (row, result) in zip(track_ids, valid):
+            track = dict(id=track_id, **row)
+            result.update(status=201, track=track)
+            created.append(track)
+
+        if self.recommendation_engine is not None:
+            self.recommendation_engine.set_tracks(created)
+        self.catalog_written(version)
+
+        return results
+
+    def update_tracks(self, tracks):
+        """
+        Update many existing tracks in a single transaction.
+
+        Every track needs its id and all other fields. The existing ids are looked up with one query, the updates
+        are applied with one batched statement and committed together.
+
+        Example:
+            results = track_dao.update_tracks([track, other_track])
+
+        :param list tracks: Dictionaries with the id and the fields of existing tracks.
+        :return: list of dicts, one per track in input order:
+                 status:200 and track:dict of the updated track, status:404 and msg:str if the id does not exist,
+                 or status:400 and msg:str if the track is invalid
+        """
+        self.check_bulk_size(tracks)
+        results, valid = self.validate_tracks(tracks, with_id=True)
+
+        existing = self.get_existing_track_ids([row['id'] for row, _ in valid])
+        updates = []
+        for row, result in valid:
+            if row['id'] in existing:
+                updates.append((row, result))
+            else:
+                result.update(status=404, msg='Cannot update track, track_id does not exist.')
+        if not updates:
+            return results
+
+        table = self.track_model.__table__
+        columns = [name for name in self.serializer.names if name != 'id']
+        statement = table.update().where(table.c.id == bindparam('_id')) \
+            .values({name: bindparam(name) for name in columns})
+        try:
+            self.db.session.execute(statement, [dict(row, _id=row['id']) for row, _ in updates])
+            version = self.bump_catalog_version([row['id'] for row, _ in updates])
+            self.db.session.commit()
+        except Exception:
+            self.db.session.rollback()
+            raise
+
+        for row, result in updates:
+            result.update(status=200, track=row)
+
+        if self.recommendation_engine is not None:
+            self.recommendation_engine.set_tracks([row for row, _ in updates])
+        self.catalog_written(version)
+
+        return results
+
+    def delete_tracks(self, track_ids):
+        """
+        Delete many tracks by id in a single transaction.
+
+        Example:
+            results = track_dao.delete_tracks([25, 26, 27])
+
+        :param list track_ids: ids of the tracks to delete.
+        :return: list of dicts, one per id in input order:
+                 track_id:int and status:200, or track_id:int, status:404 and msg:str if the id does not exist
+        """
+        self.check_bulk_size(track_ids)
+        existing = self.get_existing_track_ids(track_ids)
+
+        results = []
+        for track_id in track_ids:
+            if track_id in existing:
+                results.append({'track_id': track_id, 'status': 200})
+            else:
+                results.append({'track_id': track_id, 'status': 404,
+                                'msg': f'Cannot delete track, track_id = {track_id} does not exist.'})
+        if not existing:
+            return results
+
+        ids = sorted(existing)
+        try:
+            for start in range(0, len(ids), self.max_query_parameters):
+                self.track_model.query.filter(self.track_model.id.in_(ids[start:start + self.max_query_parameters])) \
+                    .delete(synchronize_session=False)
+            version = self.bump_catalog_version(ids)
+            self.db.session.commit()
+        except Exception:
+            self.db.session.rollback()
+            raise
+
+        if self.recommendation_engine is not None:
+            self.recommendation_engine.remove_tracks(ids)
+        self.catalog_written(version)
+
+        return results
+
+    def check_bulk_size(self, items):
+        """Raise if a bulk write has more than max_bulk_tracks items."""
+        if len(items) > self.max_bulk_tracks:
+            raise Exception(f'At most {self.max_bulk_tracks} tracks per bulk request.')
+
+    def validate_tracks(self, tracks, with_id=False):
+        """
+        Check that tracks of a bulk write have all fields and convert their values, in one pass.
+
+        :param list tracks: dictionaries with the fields of tracks
+        :param bool with_id: the tracks must have an id, each id may only appear once
+        :return: tuple(list of result dicts in input order, list of tuple(row dict, its result dict) of the valid
+                 tracks). Results of invalid tracks have status:400 and msg:str, the others no status yet.
+        """
+        fields = [(name, whole_number if convert is int else convert)
+                  for name, convert in zip(self.serializer.names, self.serializer.converters) if with_id or name != 'id']
+
+        results, valid, seen_ids = [], [], set()
+        for track in tracks:
+            result = {}
+            results.append(result)
+            if not isinstance(track, dict):
+                result.update(status=400, msg='Track must be an object.')
+                continue
+            if with_id:
+                result['track_id'] = track.get('id')
+
+            row, msg = {}, None
+            for name, convert in fields:
+                value = track.get(name)
+                if value is None:
+                    msg = f'Field {name} is required.'
+                    break
+                try:
+                    row[name] = value if convert is None else convert(value)
+                except (TypeError, ValueError):
+                    msg = f'Field {name} has an invalid value.'
+                    break
+            if msg is None and with_id:
+                if row['id'] in seen_ids:
+                    msg = 'Track id appears more than once.'
+                seen_ids.add(row['id'])
+
+            if msg is not None:
+                result.update(status=400, msg=msg)
+            else:
+                valid.append((row, result))
+        return results, valid
+
+    def get_existing_track_ids(self, track_ids):
+        """Return the set of the given ids that exist in the database, read in chunks of max_query_parameters."""
+        track_ids = list(set(track_ids))
+        existing = set()
+        for start in range(0, len(track_ids), self.max_query_parameters):
+            chunk = track_ids[start:start + self.max_query_parameters]
+            existing.update(track_id for track_id, in self.track_model.query.with_entities(self.track_model.id)
+                            .filter(self.track_model.id.in_(chunk)))
+        return existing
+
+    def get_catalog_version(self):
+        """
+        Return the version of the track catalog, it changes with every write of any server process.
+
+        A single row lookup, cheap enough to run before deciding whether a request has to be answered at all.
+
+        :return: tuple(int version, float unix time of the last write)
+        """
+        version, modified = self.db.session.execute(text('SELECT version, modified FROM catalog_version')).one()
+        return version, modified
+
+    def bump_catalog_version(self, track_ids):
+        """
+        Mark the catalog as changed and log the changed tracks, called by every write inside its transaction.
+
+        :param track_ids: ids of the created, updated or deleted tracks
+        :return: int new catalog version
+        """
+        version = self.db.session.execute(
+            text('UPDATE catalog_version SET version = version + 1, modified = :modified RETURNING version'),
+            {'modified': time.time()}).scalar()
+        self.db.session.execute(text('INSERT INTO catalog_change (version, track_id) VALUES (:version, :track_id)'),
+                                [{'version': version, 'track_id': track_id} for track_id in track_ids])
+        self.db.session.execute(text('DELETE FROM catalog_change WHERE version <= :oldest'),
+                                {'oldest': version - self.catalog_change_versions})
+        return version
+
+    def catalog_written(self, version):
+        """
+        Clear the caches after a write of this process. The write updated the recommendation engine, so it reflects
+        the new catalog version unless another process wrote in between.
+
+        :param int version: catalog version of the write
+        :return: None
+        """
+        self.invalidate_caches()
+        with self.sync_lock:
+            if self.catalog_version == version - 1:
+                self.catalog_version = version
+
+    def sync_catalog(self):
+        """
+        Catch up with the writes of other server processes. Every process keeps its own recommendation engine and
+        caches and its writes only update those. Called before every request: a single row lookup as long as the
+        catalog version is unchanged.
+
+        :return: None
+        """
+        version, _ = self.get_catalog_version()
+        if version == self.catalog_version:
+            return
+
+        with self.sync_lock:
+            known = self.catalog_version
+            if version == known:
+                return
+            if known is not None and self.recommendation_engine is not None:
+                self.apply_catalog_changes(known, version)
+            self.invalidate_caches()
+            self.catalog_version = version
+
+    def apply_catalog_changes(self, known, version):
+        """
+        Update the recommendation engine with the tracks changed between two catalog versions, read from the change
+        log. Reload the whole matrix if the log does not cover all versions in between (pruned, or written by
+        import_data.py).
+
+        :param int known: catalog version the engine reflects
+        :param int version: current catalog version
+        :return: None
+        """
+        track_ids = self.get_catalog_changes(known, version)
+        if track_ids is None:
+            print(f"Catalog changed from version {known} to {version}, reloading the recommendation matrix.")
+            self.set_recommendation_matrix(**self.recommendation_matrix_args)
+            return
+        self.update_recommendation_engine(self.recommendation_engine, track_ids)
+
+    def get_catalog_changes(self, known, version):
+        """
+        Return the ids of the tracks changed between two catalog versions, read from the change log.
+
+        :param int known: older catalog version
+        :param int version: newer catalog version
+        :return: set of track ids, None if the log does not cover all versions in between (pruned, or written by
+                 import_data.py)
+        """
+        changes = self.db.session.execute(
+            text('SELECT version, track_id FROM catalog_change WHERE version > :known AND version <= :version'),
+            {'known': known, 'version': version}).all()
+        if len({change.version for change in changes}) != version - known:
+            return None
+        return {change.track_id for change in changes}
+
+    def update_recommendation_engine(self, recommendation_engine, track_ids):
+        """
+        Write the current state of changed tracks to a recommendation engine: existing tracks are set, deleted ones
+        removed.
+
+        :param SimilarityEngine recommendation_engine: engine to update
+        :param track_ids: ids of the changed tracks
+        :return: None
+        """
+        tracks_by_id = self.get_tracks_by_ids(track_ids)
+        recommendation_engine.set_tracks(list(tracks_by_id.values()))
+        recommendation_engine.remove_tracks(sorted(set(track_ids) - tracks_by_id.keys()))
+
+    def invalidate_caches(self):
+        """
+        Clear the caches that depend on the tracks in the database, called after every write.
+
+        :return: None
+        """
+        self.recommendation_cache.clear()
+        self.count_cache.clear()
+
+    def set_recommendation_matrix(self, path, columns_to_be_vectorized, rebuild=False, index_mode='exact',
+                                  index_min_tracks=100000, index_probes=8):
+        """Load the recommendation matrix from a matrix file, build it from all songs in the DB and save it
+        if the file does not exist, was built for other columns or a different state of the database.
+
+        The file is memory mapped, processes that load the same file share the memory of the matrix. It holds the
+        catalog version it was saved at: the writes since then are replayed from the change log and the file is
+        saved again, only writes the log does not cover (e.g. import_data.py) rebuild the matrix.
+
+        Large catalogs can use an approximate nearest neighbour index (IVFIndex), it is saved next to the
+        matrix (recommendation_matrix.ivf) and rebuilt together with it.
 
         :param path: path to recommendation matrix
         :param columns_to_be_vectorized: names of the columns that need to be vectorized into the matrix
-        :return: recommendation matrix
+        :param bool rebuild: build the matrix even if the file is up to date
+        :param str index_mode: 'exact' for brute force search, 'ivf' for the approximate index,
+                               'auto' for the index once the catalog has index_min_tracks tracks
+        :param int index_min_tracks: catalog size from which 'auto' uses the index
+        :param int index_probes: lists scanned per search, more probes give better recall but slower searches
+        :return: SimilarityEngine over the recommendation matrix
         """
 
-        if os.path.exists(path) is False:
+        # numpy is only imported once recommendations are needed, it slows down the start of every process.
+        from wdb_rest.recommendation import SimilarityEngine
+
+        start = time.perf_counter()
+        self.recommendation_matrix_args = dict(path=path, columns_to_be_vectorized=columns_to_be_vectorized,
+                                               index_mode=index_mode, index_min_tracks=index_min_tracks,
+                                               index_probes=index_probes)
+        # Read before the tracks, writes during the build are applied by the next sync_catalog.
+        version, _ = self.get_catalog_version()
+        fingerprint = self.get_catalog_fingerprint(columns_to_be_vectorized)
 
-            df = pd.DataFrame(columns = columns_to_be_vectorized)
+        recommendation_engine = None
+        # Ids of the tracks written since the file was saved.
+        changed_track_ids = set()
+        if os.path.exists(path) and not rebuild:
+            try:
+                recommendation_engine, header = SimilarityEngine.load(path)
+            except Exception as e:
+                print(f"Cannot read recommendation matrix {path}: {e}")
+            else:
+                file_version = header.get('catalog_version')
+                if header['columns'] != list(columns_to_be_vectorized) or file_version is None:
+                    changed_track_ids = None
+                elif file_version == version:
+                    if header['fingerprint'] != fingerprint:
+                        changed_track_ids = None
+                elif file_version < version:
+                    changed_track_ids = self.get_catalog_changes(file_version, version)
+                else:
+                    changed_track_ids = None
+                if changed_track_ids is None:
+                    print(f"Recommendation matrix {path} does not match the database.")
+                    recommendation_engine = None
+                # The index file belongs to the matrix file, not to the current state of the database.
+                matrix_key = [repr(file_version)] + header['fingerprint']
 
-            print("Calculating recommendation matrix...")
-            alltracks = self.track_model.query.options(load_only(*columns_to_be_vectorized)).all()
-            #recommendation_matrix = np.empty((0, len(columns_to_be_vectorized)))
-            for track in alltracks:
-                track = self.track_to_vec(track, columns_to_be_vectorized)
-                df = pd.concat([df, track], axis=0, join='outer')
+        if recommendation_engine is None:
+            recommendation_matrix, track_ids, encoder = self.build_recommendation_matrix(columns_to_be_vectorized)
+            recommendation_engine = SimilarityEngine(recommendation_matrix, track_ids, encoder)
+            recommendation_engine.save(path, fingerprint, version)
+            print(f"Saved recommendation matrix to {path}.")
+            matrix_key = [repr(version)] + fingerprint
+            changed_track_ids = set()
+            rebuild = True
 
-                #recommendation_matrix = np.append(recommendation_matrix, [track_array], axis = 0)
-            
-            df["decade"] = df["decade"].astype('category').cat.codes
+        index = None
+        if index_mode == 'ivf' or (index_mode == 'auto' and recommendation_engine.size >= index_min_tracks):
+            index_path = os.path.splitext(path)[0] + '.ivf'
+            index = self.get_recommendation_index(index_path, recommendation_engine, matrix_key, rebuild)
+            recommendation_engine.set_index(index, index_probes)
 
-            df[columns_to_be_vectorized] = (df[columns_to_be_vectorized]-df[columns_to_be_vectorized].mean())/df[columns_to_be_vectorized].std()
+        if changed_track_ids:
+            # The index is set first, so the replayed tracks are assigned to their lists.
+            self.update_recommendation_engine(recommendation_engine, changed_track_ids)
+            with recommendation_engine.lock:
+                # The file leaves out deleted rows, the rows of the saved index have to match it.
+                if recommendation_engine.tombstones:
+                    recommendation_engine.compact()
+            recommendation_engine.save(path, fingerprint, version)
+            if index is not None:
+                recommendation_engine.index.save(index_path, [repr(version)] + fingerprint)
+            print(f"Applied {len(changed_track_ids)} changed tracks to recommendation matrix {path} and saved it.")
 
-            recommendation_matrix = df.to_numpy()
-            np.save(path, recommendation_matrix)
-            print("Done.")
-            return recommendation_matrix
-        else:
-            return np.load(path)
+        self.recommendation_engine = recommendation_engine
+        self.catalog_version = version
+        self.recommendation_cache.clear()
+        recommendation_matrix_load_seconds.set(time.perf_counter() - start)
+        return self.recommendation_engine
+
+    def get_recommendation_index(self, path, recommendation_engine, fingerprint, rebuild=False):
+        """Load the approximate nearest neighbour index of the recommendation matrix, build and save it if the
+        file does not exist or belongs to a different matrix.
+
+        :param path: path to the index file
+        :param SimilarityEngine recommendation_engine: engine holding the recommendation matrix
+        :param fingerprint: catalog version and fingerprint of the matrix file the index belongs to
+        :param bool rebuild: build the index even if the file exists
+        :return: IVFIndex
+        """
+        from wdb_rest.ann import IVFIndex
+
+        if os.path.exists(path) and not rebuild:
+            try:
+                index, index_fingerprint = IVFIndex.load(path)
+                if index_fingerprint == fingerprint:
+                    return index
+            except Exception as e:
+                print(f"Cannot read recommendation index {path}: {e}")
+
+        print("Building recommendation index...")
+        start = time.perf_counter()
+        with recommendation_engine.lock:
+            matrix, _, _ = recommendation_engine.snapshot()
+        index = IVFIndex.build(matrix)
+        index.save(path, fingerprint)
+        print(f"Built index with {len(index.centroids)} lists in {time.perf_counter() - start:.2f}s.")
+        return index
 
-    def track_to_vec(self, track, columns_to_be_vectorized):
-        """Transforms track from DB to a dataframe
+    def get_catalog_fingerprint(self, columns_to_be_vectorized, session=None):
+        """Fingerprint the tracks in the DB with a single aggregate query.
 
-        :param track: track to be transformed
-        :param columns_to_be_vectorized: track attributes to be included into the returned array
-        :return: transformed track
+        Row count, id range and sums of the vectorized columns change with (practically) every create, update
+        and delete, so a matrix file saved at the same catalog version with a different fingerprint was built from
+        a different database. Text columns are only summed by their length, writes changing them alone are found
+        by their catalog version.
+
+        :param columns_to_be_vectorized: names of the columns that are vectorized into the matrix
+        :param session: SQLAlchemy session of the database to fingerprint. Default: the session of the app
+        :return: list of aggregates
         """
+        aggregates = [func.count(self.track_model.id), func.min(self.track_model.id),
+                      func.max(self.track_model.id), func.sum(self.track_model.id)]
+        for column in columns_to_be_vectorized:
+            column = getattr(self.track_model, column)
+            # Text columns are summed by their length.
+            if isinstance(column.type, String):
+                column = func.length(column)
+            aggregates.append(func.sum(column))
+
+        return [repr(value) for value in (session or self.db.session).query(*aggregates).one()]
 
-        df = pd.DataFrame(columns = columns_to_be_vectorized)
-        for i in columns_to_be_vectorized:
-            df[i] = track.__dict__[i]
-        return df
+    def build_recommendation_matrix(self, columns_to_be_vectorized):
+        """Build the recommendation matrix from all songs in the DB.
 
-    def get_sorted_recommendation_indeces(self, A, B):
-        """Get sorted recommendations based on cosine similarity
-        
-        :param A: vector to get recommendations for
-        :param B: recommendation matrix
+        The vectorized columns are read with a single query, categorical columns (decade) are encoded and all
+        columns standardized in one vectorized pass.
+
+        :param columns_to_be_vectorized: names of the columns that need to be vectorized into the matrix
+        :return: tuple(float32 recommendation matrix, np.array of track ids, FeatureEncoder)
         """
+        import pandas as pd
+        from wdb_rest.recommendation import FeatureEncoder
+
+        print("Calculating recommendation matrix...")
+        start = time.perf_counter()
+
+        columns = [getattr(self.track_model, column) for column in columns_to_be_vectorized]
+        query = self.db.session.query(self.track_model.id, *columns).order_by(self.track_model.id)
+        df = pd.read_sql(query.statement, self.db.session.connection())
+        read_done = time.perf_counter()
+        print(f"Read {len(df)} tracks in {read_done - start:.2f}s.")
+
+        encoder, recommendation_matrix = FeatureEncoder.fit_transform(df, columns_to_be_vectorized)
+        print(f"Encoded {recommendation_matrix.shape[0]}x{recommendation_matrix.shape[1]} matrix "
+              f"in {time.perf_counter() - read_done:.2f}s.")
 
-        dots = np.dot(A,B.T)
-        l2norms = np.sqrt((np.array([np.sum(A**2)])[:, None])*((B**2).sum(1)))
-        cosine_dists = 1 - (dots/l2norms)
-        minval = np.nanmin(cosine_dists,axis=1)
-        return np.argsort(cosine_dists)
\ No newline at end of file
+        print(f"Done in {time.perf_counter() - start:.2f}s.")
+        return recommendation_matrix, df['id'].to_numpy(), encoder
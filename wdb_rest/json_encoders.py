@@ -1,28 +1,78 @@
 import json
-import numpy as np
-from sqlalchemy.ext.declarative import DeclarativeMeta
+from flask_restful import fields
 
-# from https://stackoverflow.com/a/10664192
-class AlchemyEncoder(json.JSONEncoder):
+# orjson is optional, it encodes several times faster than the standard library.
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-    def default(self, obj):
-        if isinstance(obj.__class__, DeclarativeMeta):
-            # an SQLAlchemy class
-            fields = {}
-            for field in [x for x in dir(obj) if not x.startswith('_') and x != 'metadata']:
-                data = obj.__getattribute__(field)
-                try:
-                    json.dumps(data) # this will fail on non-encodable values, like other classes
-                    fields[field] = data
-                except TypeError:
-                    fields[field] = None
-            # a json-encodable dict
-            return fields
 
-        return json.JSONEncoder.default(self, obj)
+def dumps(obj):
+    """
+    Encode an object as compact JSON, with orjson when it is installed.
+
+    :param obj: dicts, lists, strings, numbers, booleans and None
+    :return: bytes UTF-8 encoded JSON
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+class ColumnSerializer:
+    """
+    Turns rows of a model into JSON ready dicts.
+
+    Everything about the model is looked up once: the columns to select and one converter per column, taken from
+    the marshalling fields when given (so lists match what marshal returns for single tracks) and from the column
+    types otherwise. Serializing a row is then a single pass over its values.
+    """
+
+    # Converters of the Flask-RESTful field types.
+    field_converters = {fields.Integer: int, fields.Float: float, fields.String: str, fields.Boolean: bool}
+
+    def __init__(self, model, model_fields=None):
+        """
+        Initialize object.
+
+        :param model: SQLAlchemy model to serialize.
+        :param dict model_fields: Flask-RESTful fields of the model, only these columns are serialized.
+        """
+        columns = list(model.__table__.columns)
+        if model_fields is not None:
+            columns = [column for column in columns if column.key in model_fields]
+
+        # Column keys are str subclasses, orjson only accepts plain str keys.
+        self.names = [str(column.key) for column in columns]
+        # Select these to read rows as plain tuples, in the order of names.
+        self.columns = [getattr(model, name) for name in self.names]
+        self.converters = []
+        for column in columns:
+            if model_fields is not None:
+                field = model_fields[column.key]
+                converter = self.field_converters.get(field if isinstance(field, type) else type(field))
+            else:
+                converter = column.type.python_type
+            self.converters.append(converter)
+
+    def to_dicts(self, rows):
+        """Serialize rows selected with the columns of the serializer.
+
+        :param rows: iterable of tuples of column values
+        :return: list of dicts, column name to value
+        """
+        names_converters = list(zip(self.names, self.converters))
+        return [{name: value if value is None or convert is None else convert(value)
+                 for (name, convert), value in zip(names_converters, row)}
+                for row in rows]
+
 
 class NumpyArrayEncoder(json.JSONEncoder):
     def default(self, obj):
+        # Imported here, the server does not need numpy to start.
+        import numpy as np
+
         if isinstance(obj, np.ndarray):
             return obj.tolist()
-        return JSONEncoder.default(self, obj)
\ No newline at end of file
+        return json.JSONEncoder.default(self, obj)
@@ -0,0 +1,380 @@
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+
+from sqlalchemy import event
+
+# Upper bounds (seconds) of the latency histogram buckets, from a cached read to a slow export.
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Registry:
+    """
+    Metrics of the process, rendered in the Prometheus text format.
+
+    Metrics are kept in memory and updated in place, recording a value is a dict lookup and an addition under a lock,
+    so they can stay enabled in production.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collect(self, gauges=True):
+        """
+        Return the recorded metrics as a list of (name, help, type, samples), samples as (suffix, labels, value).
+
+        Metrics derived from others (see Ratio) are left out, render computes them.
+
+        :param bool gauges: include the gauges
+        """
+        return [(metric.name, metric.help, metric.type, metric.samples()) for metric in self.metrics
+                if not isinstance(metric, Ratio) and (gauges or metric.type != 'gauge')]
+
+    def derive(self, families):
+        """Add the derived metrics to collected or merged families, in the order they were registered."""
+        samples = {name: family_samples for name, help, type, family_samples in families}
+        derived = [(metric.name, metric.help, metric.type, metric.compute(samples)) for metric in self.metrics
+                   if isinstance(metric, Ratio)]
+        order = {metric.name: i for i, metric in enumerate(self.metrics)}
+        return sorted(families + derived, key=lambda family: order.get(family[0], len(order)))
+
+    def render(self, directory=None):
+        """
+        Return all metrics in the Prometheus text format (version 0.0.4).
+
+        With a directory the metrics of all processes that write their snapshots to it are merged, see merge.
+
+        :param str directory: snapshot directory shared by the worker processes, None for this process only
+        """
+        if directory:
+            # The snapshot of this process is written first, so every scrape reports counters at least as high as
+            # the scrapes before it, whichever worker answers.
+            self.write(directory)
+            families = merge(directory)
+        else:
+            families = self.collect()
+        lines = []
+        for name, help, type, samples in self.derive(families):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {type}')
+            for suffix, labels, value in samples:
+                lines.append(f'{name}{suffix}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, directory, gauges=True):
+        """
+        Write a snapshot of the metrics of this process to <pid>.json in a directory.
+
+        :param str directory: snapshot directory, created if missing
+        :param bool gauges: include the gauges, False for a process that does not serve requests (e.g. the master)
+        :return: None
+        """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{os.getpid()}.json')
+        # Replaced in one step, readers never see a half written file.
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.collect(gauges), f)
+        os.replace(path + '.tmp', path)
+
+    def reset(self):
+        """Clear the counters and histograms, e.g. those a forked worker inherits from the master process."""
+        for metric in self.metrics:
+            if metric.type in ('counter', 'histogram'):
+                metric.reset()
+
+    def start_export(self, directory, interval):
+        """
+        Write a snapshot of the metrics every interval seconds in a daemon thread, for the scrapes answered by the
+        other processes.
+
+        :param str directory: snapshot directory
+        :param float interval: seconds between the snapshots
+        :return: None
+        """
+        def export():
+            while True:
+                self.write(directory)
+                time.sleep(interval)
+
+        threading.Thread(target=export, name='metrics-export', daemon=True).start()
+
+
+def merge(directory):
+    """
+    Merge the metric snapshots of the processes in a directory.
+
+    Counters and histograms are summed over the processes, including processes that exited, so they only go up
+    when a worker is replaced. Gauges are reported per process with a pid label, those of exited processes are
+    dropped.
+
+    :param str directory: snapshot directory
+    :return: list of (name, help, type, samples) like Registry.collect
+    """
+    families = {}
+    for path in sorted(glob.glob(os.path.join(directory, '*.json'))):
+        pid = int(os.path.basename(path)[:-len('.json')])
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        alive = is_alive(pid)
+        for name, help, type, samples in snapshot:
+            merged = families.setdefault(name, (help, type, {}))[2]
+            if type == 'gauge':
+                if alive:
+                    for suffix, labels, value in samples:
+                        labels = dict(labels, pid=str(pid))
+                        merged[suffix, tuple(labels.items())] = value
+            else:
+                for suffix, labels, value in samples:
+                    key = suffix, tuple(labels.items())
+                    merged[key] = merged.get(key, 0) + value
+    return [(name, help, type, [(suffix, dict(labels), value) for (suffix, labels), value in merged.items()])
+            for name, (help, type, merged) in families.items()]
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def remove_snapshots(directory):
+    """Remove the metric snapshots of a directory, left over from processes of an earlier server."""
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        os.remove(path)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base class of metrics with labels. Values are recorded per combination of label values."""
+
+    type = 'untyped'
+
+    def __init__(self, name, help, labelnames=(), registry=None):
+        """
+        Initialize object.
+
+        :param str name: metric name
+        :param str help: description of the metric
+        :param tuple labelnames: names of the labels, every recorded value passes a value for each
+        :param Registry registry: registry to add the metric to, the registry of the module by default
+        """
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        (registry or default_registry).register(self)
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def labels_of(self, key):
+        return dict(zip(self.labelnames, key))
+
+    def samples(self):
+        with self.lock:
+            return [('', self.labels_of(key), value) for key, value in sorted(self.values.items())]
+
+    def reset(self):
+        with self.lock:
+            self.values.clear()
+
+
+class Counter(Metric):
+    """Value that only goes up, for example the number of requests."""
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that goes up and down, for example the requests in flight."""
+
+    type = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    """Distribution of observed values (e.g. latencies) in cumulative buckets, with their count and sum."""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=default_buckets, registry=None):
+        super().__init__(name, help, labelnames, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            values = self.values.get(key)
+            if values is None:
+                # Count per bucket (the last one is +Inf), then the sum.
+                values = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            values[i] += 1
+            values[-1] += value
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, values in sorted(self.values.items()):
+                labels = self.labels_of(key)
+                count = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), values):
+                    count += bucket_count
+                    samples.append(('_bucket', dict(labels, le=format_value(float(bound))), count))
+                samples.append(('_count', labels, count))
+                samples.append(('_sum', labels, values[-1]))
+        return samples
+
+
+class CallbackMetric(Metric):
+    """Metric read when the metrics are rendered, for values counted elsewhere (e.g. the hits of a cache)."""
+
+    def __init__(self, name, help, type, callback, labelnames=(), registry=None):
+        """
+        Initialize object.
+
+        :param str type: 'counter' or 'gauge'
+        :param callback: function returning a dict of tuple(label values) -> value
+        """
+        super().__init__(name, help, labelnames, registry)
+        self.type = type
+        self.callback = callback
+
+    def samples(self):
+        return [('', self.labels_of(key), value) for key, value in sorted(self.callback().items())]
+
+
+class Ratio(Metric):
+    """
+    Share of one counter in the sum of two, e.g. the hit ratio of a cache from its hits and misses.
+
+    Computed from the counters when the metrics are rendered, so with merged processes it is the ratio of the summed
+    counters, one series for all of them.
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, help, part, rest, labelnames=(), registry=None):
+        """
+        Initialize object.
+
+        :param str part: name of the counter counted by the ratio (e.g. the hits)
+        :param str rest: name of the counter making up the rest of the total (e.g. the misses)
+        """
+        super().__init__(name, help, labelnames, registry)
+        self.part = part
+        self.rest = rest
+
+    def compute(self, samples):
+        """
+        Return the samples of the ratio.
+
+        :param dict samples: metric name -> samples of the collected or merged metrics
+        """
+        part = {tuple(labels.items()): value for suffix, labels, value in samples.get(self.part, [])}
+        rest = {tuple(labels.items()): value for suffix, labels, value in samples.get(self.rest, [])}
+        ratios = []
+        for key in sorted(set(part) | set(rest)):
+            total = part.get(key, 0) + rest.get(key, 0)
+            ratios.append(('', dict(key), part.get(key, 0) / total if total else 0.0))
+        return ratios
+
+
+default_registry = Registry()
+
+request_duration_seconds = Histogram('wdb_http_request_duration_seconds', 'Time to answer a request.',
+                                     ['endpoint', 'method'])
+requests_total = Counter('wdb_http_requests_total', 'Answered requests.', ['endpoint', 'method', 'status'])
+requests_in_flight = Gauge('wdb_http_requests_in_flight', 'Requests being answered.')
+request_sql_statements = Histogram('wdb_http_request_sql_statements', 'SQL statements run per request.',
+                                   ['endpoint'], buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100))
+sql_statements_total = Counter('wdb_sql_statements_total', 'SQL statements run, by kind of statement.', ['kind'])
+sql_duration_seconds = Histogram('wdb_sql_duration_seconds', 'Time to run a SQL statement.', ['kind'])
+recommendation_compute_seconds = Histogram('wdb_recommendation_compute_seconds',
+                                           'Time of the similarity search for a recommendation request.', ['kind'])
+recommendation_fetch_seconds = Histogram('wdb_recommendation_fetch_seconds',
+                                         'Time to read the recommended tracks from the database.', ['kind'])
+recommendation_matrix_load_seconds = Gauge('wdb_recommendation_matrix_load_seconds',
+                                           'Time the last load (or build) of the recommendation matrix took.')
+
+# SQL statements run by the request of the current thread, see start_request_sql.
+request_state = threading.local()
+
+# Kinds of statements counted separately, everything else is 'other'.
+sql_kinds = {'select', 'insert', 'update', 'delete', 'pragma'}
+
+
+def start_request_sql():
+    """Start counting the SQL statements of the request handled by this thread."""
+    request_state.sql_statements = 0
+
+
+def request_sql():
+    """Return the SQL statements run by the request handled by this thread."""
+    return getattr(request_state, 'sql_statements', 0)
+
+
+def instrument_engine(engine):
+    """
+    Count and time every SQL statement run by an engine.
+
+    :param engine: SQLAlchemy engine
+    :return: None
+    """
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info['query_start'].pop()
+        kind = statement.lstrip()[:6].lower()
+        if kind not in sql_kinds:
+            kind = 'other'
+        sql_statements_total.inc(kind=kind)
+        sql_duration_seconds.observe(duration, kind=kind)
+        request_state.sql_statements = request_sql() + 1
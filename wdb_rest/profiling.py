@@ -0,0 +1,156 @@
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+
+from sqlalchemy import event
+
+# Profile and SQL trace of the request handled by the current thread, None while it is not profiled.
+request_state = threading.local()
+
+# cProfile can only profile one request of the process at a time, others are answered without a profile.
+profile_lock = threading.Lock()
+
+
+class RequestProfile:
+    """
+    Profile of a single request: the functions it called (cProfile) and the SQL statements it ran, each with its
+    duration and row count.
+    """
+
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+        # Dicts with statement, parameters, seconds and rows, in the order the statements ran.
+        self.statements = []
+        self.start = None
+        self.duration = None
+
+    def stats(self):
+        return pstats.Stats(self.profiler)
+
+    def top_functions(self, n=10, sort='cumulative'):
+        """
+        Return the functions that took longest.
+
+        :param int n: number of functions
+        :param str sort: 'cumulative' for the time including the functions called, 'tottime' for the time spent
+                         in the function itself
+        :return: list of tuple(function as 'file:line(name)', calls, seconds)
+        """
+        i = 3 if sort == 'cumulative' else 2
+        functions = sorted(self.stats().stats.items(), key=lambda item: item[1][i], reverse=True)
+        return [(f'{os.path.basename(filename)}:{line}({name})', timings[1], timings[i])
+                for (filename, line, name), timings in functions[:n]]
+
+    def summary_headers(self, n=10, sort='cumulative'):
+        """
+        Summarize the profile in response headers.
+
+        :param int n: number of functions and statements listed
+        :param str sort: order of the functions, see top_functions
+        :return: dict of header name -> value
+        """
+        sql_seconds = sum(statement['seconds'] for statement in self.statements)
+        slowest = sorted(self.statements, key=lambda statement: statement['seconds'], reverse=True)[:n]
+        return {
+            'X-Profile-Duration': f'{self.duration * 1000:.2f}ms',
+            'X-Profile-SQL': f'{len(self.statements)} statements, {sql_seconds * 1000:.2f}ms',
+            'X-Profile-SQL-Slowest': '; '.join(
+                f"{statement['seconds'] * 1000:.2f}ms {statement['rows']} rows "
+                f"{' '.join(statement['statement'].split())[:200]}" for statement in slowest),
+            'X-Profile-Functions': '; '.join(
+                f'{seconds * 1000:.2f}ms {calls}x {function}' for function, calls, seconds in self.top_functions(n, sort))
+        }
+
+    def dump(self, directory, name):
+        """
+        Save the profile (pstats format, open with python -m pstats or snakeviz) and the SQL trace (JSON).
+
+        :param str directory: directory of the dump files, created if missing
+        :param str name: name of the request, part of the file names
+        :return: path of the profile, the SQL trace has the same path ending in .sql.json
+        """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{time.strftime("%Y%m%d-%H%M%S")}-{time.time_ns() % 10 ** 9:09d}-{name}.prof')
+        self.profiler.dump_stats(path)
+        with open(path[:-len('.prof')] + '.sql.json', 'w') as f:
+            json.dump({'duration': self.duration, 'statements': self.statements}, f, indent=2, default=str)
+        return path
+
+
+def start():
+    """
+    Start profiling the request handled by this thread.
+
+    :return: RequestProfile, or None when another request of the process is being profiled
+    """
+    if not profile_lock.acquire(blocking=False):
+        return None
+    profile = RequestProfile()
+    try:
+        profile.profiler.enable()
+    except ValueError:
+        # Another profiler (or debugger) is active.
+        profile_lock.release()
+        return None
+    request_state.profile = profile
+    profile.start = time.perf_counter()
+    return profile
+
+
+def stop():
+    """
+    Stop profiling the request handled by this thread.
+
+    :return: the finished RequestProfile, None if the request was not profiled
+    """
+    profile = getattr(request_state, 'profile', None)
+    if profile is None:
+        return None
+    profile.profiler.disable()
+    profile.duration = time.perf_counter() - profile.start
+    request_state.profile = None
+    profile_lock.release()
+    return profile
+
+
+def instrument(engine, session):
+    """
+    Trace the SQL statements of profiled requests. Only called when profiling is enabled, other servers do not pay
+    for the event listeners.
+
+    :param engine: SQLAlchemy engine, its statements are traced with their duration and parameters
+    :param session: SQLAlchemy session (or scoped session), the rows of its queries are counted
+    :return: None
+    """
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if getattr(request_state, 'profile', None) is not None:
+            conn.info.setdefault('profile_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        profile = getattr(request_state, 'profile', None)
+        if profile is None or not conn.info.get('profile_start'):
+            return
+        seconds = time.perf_counter() - conn.info['profile_start'].pop()
+        # Drivers know the rows of writes, the rows of queries are counted when they are read.
+        rows = cursor.rowcount if cursor.rowcount >= 0 else None
+        profile.statements.append({'statement': statement, 'parameters': parameters if not executemany else
+                                   f'{len(parameters)} parameter sets', 'seconds': seconds, 'rows': rows})
+
+    @event.listens_for(session, 'do_orm_execute')
+    def do_orm_execute(orm_execute_state):
+        profile = getattr(request_state, 'profile', None)
+        if profile is None:
+            return None
+        traced = len(profile.statements)
+        result = orm_execute_state.invoke_statement()
+        if not getattr(result, 'returns_rows', True) or len(profile.statements) == traced:
+            return result
+        # Read all rows to count them, the caller gets a copy of the result.
+        frozen = result.freeze()
+        profile.statements[-1]['rows'] = len(frozen.data)
+        return frozen()
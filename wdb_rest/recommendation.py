@@ -0,0 +1,531 @@
+import json
+import os
+import struct
+import threading
+
+import numpy as np
+
+# Recommendation matrix file format, see SimilarityEngine.save.
+MATRIX_FILE_MAGIC = b'WDBMATRX'
+MATRIX_FILE_VERSION = 1
+# Data blocks start at multiples of this, so they can be memory mapped.
+MATRIX_FILE_ALIGNMENT = 64
+
+
+class FeatureEncoder:
+    """
+    Turns tracks into standardized feature vectors.
+
+    Holds the normalization statistics of the recommendation matrix (column means and standard deviations
+    and the codes of categorical columns like decade), so single tracks can be encoded the same way as the
+    whole catalog when they are created or updated.
+    """
+
+    def __init__(self, columns, means, stds, categories):
+        """
+        Initialize object.
+
+        :param list columns: names of the vectorized columns, in matrix order.
+        :param list means: mean of every column.
+        :param list stds: standard deviation of every column.
+        :param dict categories: column name -> list of category values, the code of a value is its list index.
+        """
+        self.columns = list(columns)
+        self.means = np.asarray(means, dtype=np.float64)
+        self.stds = np.asarray(stds, dtype=np.float64)
+        # Constant columns would divide by zero.
+        self.stds[~(self.stds > 0)] = 1
+        self.categories = {column: list(values) for column, values in categories.items()}
+        # Encoding an unseen category value appends it to the categories, writes of several threads encode at once.
+        self.lock = threading.RLock()
+
+    @classmethod
+    def fit(cls, df, columns):
+        """Compute the normalization statistics of a catalog.
+
+        Non-numeric columns are treated as categorical, their codes follow the sorted category values.
+
+        :param pd.DataFrame df: dataframe with one row per track
+        :param list columns: names of the columns to vectorize
+        :return: FeatureEncoder
+        """
+        return cls.fit_transform(df, columns)[0]
+
+    @classmethod
+    def fit_transform(cls, df, columns):
+        """Compute the normalization statistics of a catalog and encode it in the same pass.
+
+        :param pd.DataFrame df: dataframe with one row per track
+        :param list columns: names of the columns to vectorize
+        :return: tuple(FeatureEncoder, float32 matrix with one row per track)
+        """
+        categories = {}
+        for column in columns:
+            if df[column].dtype.kind not in 'biuf':
+                categories[column] = sorted(df[column].unique().tolist())
+
+        encoder = cls(columns, np.zeros(len(columns)), np.ones(len(columns)), categories)
+        codes = encoder.to_codes(df)
+        encoder = cls(columns, codes.mean(axis=0), codes.std(axis=0, ddof=1), categories)
+
+        codes -= encoder.means
+        codes /= encoder.stds
+        return encoder, codes.astype(np.float32)
+
+    @classmethod
+    def from_dict(cls, stats):
+        """Create an encoder from the output of to_dict."""
+        return cls(stats['columns'], stats['means'], stats['stds'], stats['categories'])
+
+    def to_dict(self):
+        """Return the normalization statistics as a JSON serializable dictionary."""
+        with self.lock:
+            categories = {column: list(values) for column, values in self.categories.items()}
+        return dict(columns=self.columns, means=self.means.tolist(), stds=self.stds.tolist(), categories=categories)
+
+    def category_code(self, column, value):
+        """Return the code of a categorical value, unseen values get the next free code.
+
+        :param str column: name of the categorical column
+        :param value: value to encode
+        :return: int code
+        """
+        values = self.categories[column]
+        with self.lock:
+            try:
+                return values.index(value)
+            except ValueError:
+                values.append(value)
+                return len(values) - 1
+
+    def to_codes(self, df):
+        """Return the raw (not standardized) numeric values of a dataframe as a float64 matrix."""
+        codes = np.empty((len(df), len(self.columns)), dtype=np.float64)
+        for i, column in enumerate(self.columns):
+            if column in self.categories:
+                # Register unseen values first, then map the whole column at once.
+                with self.lock:
+                    for value in df[column].unique():
+                        self.category_code(column, value)
+                    mapping = {value: code for code, value in enumerate(self.categories[column])}
+                codes[:, i] = df[column].map(mapping).to_numpy(dtype=np.float64)
+            else:
+                codes[:, i] = df[column].to_numpy(dtype=np.float64)
+        return codes
+
+    def encode_frame(self, df):
+        """Encode a dataframe of tracks.
+
+        :param pd.DataFrame df: dataframe with one row per track
+        :return: float32 matrix, one row per track
+        """
+        return ((self.to_codes(df) - self.means) / self.stds).astype(np.float32)
+
+    def encode(self, track):
+        """Encode a single track in O(d).
+
+        :param track: track object (or dictionary) with all the vectorized attributes
+        :return: float32 vector
+        """
+        values = np.empty(len(self.columns), dtype=np.float64)
+        for i, column in enumerate(self.columns):
+            value = track[column] if isinstance(track, dict) else getattr(track, column)
+            values[i] = self.category_code(column, value) if column in self.categories else value
+        return ((values - self.means) / self.stds).astype(np.float32)
+
+
+class SimilarityEngine:
+    """
+    Cosine similarity search over the recommendation matrix.
+
+    The matrix is normalized to unit length once, when the engine is created, so the cosine similarity
+    of a track against the whole catalog is a single matrix-vector product. The best k tracks are
+    selected with np.argpartition, only the selected k are sorted.
+    """
+
+    # Compact the matrix once this fraction of its rows are tombstones.
+    compaction_ratio = 0.25
+
+    def __init__(self, matrix, track_ids, encoder=None, normalized=False):
+        """
+        Initialize object.
+
+        :param np.array matrix: recommendation matrix, one row per track.
+        :param track_ids: track id of every row in the matrix.
+        :param FeatureEncoder encoder: normalization statistics used to encode tracks on writes.
+        :param bool normalized: the rows are already unit length float32, use the matrix without copying it.
+        """
+        self.encoder = encoder
+        self.lock = threading.Lock()
+
+        self.track_ids = np.asarray(track_ids, dtype=np.int64)
+        self.matrix = matrix if normalized else self.normalize(matrix)
+
+        if len(self.track_ids) != len(self.matrix):
+            raise Exception('Recommendation matrix and track ids have different lengths.')
+
+        # Number of used rows, the arrays have spare capacity for appended tracks.
+        self.size = len(self.matrix)
+        # Deleted tracks stay in the matrix as tombstones until the next compaction.
+        self.alive = np.ones(self.size, dtype=bool)
+        self.tombstones = 0
+
+        # Optional approximate nearest neighbour index, exact search when None.
+        self.index = None
+        self.probes = 8
+
+        # Rows are usually ordered by track id, then a binary search finds them. Otherwise fall back to a dictionary.
+        self.id_to_row = None
+        if np.any(np.diff(self.track_ids) <= 0):
+            self.index_rows()
+
+    @classmethod
+    def load(cls, path):
+        """Open a matrix file written by save.
+
+        The matrix and the track ids are memory mapped copy-on-write, so all processes that load the same file
+        share one copy in the page cache. Writes to the engine only copy the pages they touch.
+
+        :param str path: path to the matrix file
+        :return: tuple(SimilarityEngine, dict file header)
+        """
+        with open(path, 'rb') as f:
+            magic, header_length = struct.unpack('<8sI', f.read(12))
+            if magic != MATRIX_FILE_MAGIC:
+                raise Exception(f'{path} is not a recommendation matrix file.')
+            header = json.loads(f.read(header_length).decode('utf-8'))
+
+        if header['format_version'] != MATRIX_FILE_VERSION:
+            raise Exception(f'Unsupported recommendation matrix format version {header["format_version"]}.')
+
+        shape = (header['rows'], len(header['columns']))
+        if header['rows'] > 0:
+            matrix = np.memmap(path, dtype=header['dtype'], mode='c', offset=header['matrix_offset'], shape=shape)
+            track_ids = np.memmap(path, dtype=np.int64, mode='c', offset=header['ids_offset'], shape=(shape[0],))
+        else:
+            # Empty memory maps are not allowed.
+            matrix, track_ids = np.zeros(shape, dtype=header['dtype']), np.zeros(0, dtype=np.int64)
+
+        encoder = FeatureEncoder.from_dict(header['normalization'])
+        return cls(matrix, track_ids, encoder, normalized=True), header
+
+    def save(self, path, fingerprint=None, catalog_version=None):
+        """Save the engine to a versioned matrix file.
+
+        Layout: magic bytes, header length (uint32), JSON header, the normalized float32 matrix and the int64
+        track ids. The header holds the format version, the vectorized columns, dtype, row count, offsets of the
+        data blocks, the normalization statistics and the catalog version and fingerprint of the database state
+        the matrix was built from. Tombstoned rows are not written. The file is replaced atomically, processes that still map the
+        old file keep reading it.
+
+        :param str path: path to the matrix file
+        :param fingerprint: JSON serializable fingerprint of the database, compared when the file is loaded.
+        :param int catalog_version: catalog version of the matrix, later writes are replayed when it is loaded.
+        :return: None
+        """
+        with self.lock:
+            keep = np.flatnonzero(self.alive[:self.size])
+            matrix = np.ascontiguousarray(self.matrix[keep], dtype=np.float32)
+            track_ids = np.ascontiguousarray(self.track_ids[keep], dtype=np.int64)
+
+        header = dict(format_version=MATRIX_FILE_VERSION,
+                      columns=self.encoder.columns if self.encoder is not None else None,
+                      dtype='float32',
+                      rows=len(matrix),
+                      normalization=self.encoder.to_dict() if self.encoder is not None else None,
+                      fingerprint=fingerprint,
+                      catalog_version=catalog_version,
+                      matrix_offset=0,
+                      ids_offset=0)
+
+        # The offsets are part of the header, so its length has to be known first. Reserve room for the digits.
+        header_length = len(json.dumps(header).encode('utf-8')) + 40
+        header['matrix_offset'] = self.align(12 + header_length)
+        header['ids_offset'] = self.align(header['matrix_offset'] + matrix.nbytes)
+        header_bytes = json.dumps(header).encode('utf-8').ljust(header_length)
+
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(struct.pack('<8sI', MATRIX_FILE_MAGIC, header_length))
+            f.write(header_bytes)
+            f.seek(header['matrix_offset'])
+            f.write(matrix.tobytes())
+            f.seek(header['ids_offset'])
+            f.write(track_ids.tobytes())
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def align(offset):
+        """Round an offset up to the next multiple of MATRIX_FILE_ALIGNMENT."""
+        return -(-offset // MATRIX_FILE_ALIGNMENT) * MATRIX_FILE_ALIGNMENT
+
+    @staticmethod
+    def normalize(matrix):
+        """Return a float32 copy of the matrix with every row scaled to unit length.
+
+        :param np.array matrix: matrix to normalize
+        :return: normalized matrix
+        """
+        matrix = np.nan_to_num(np.asarray(matrix, dtype=np.float32))
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        # Zero vectors stay zero instead of turning into NaN.
+        norms[norms == 0] = 1
+        return matrix / norms
+
+    def index_rows(self):
+        """Switch the track id lookup to a dictionary, needed once the rows are not ordered by id anymore."""
+        self.id_to_row = {track_id: row for row, track_id in enumerate(self.track_ids[:self.size].tolist())}
+
+    def find_row(self, track_id):
+        """Return the matrix row of a track, tombstoned rows included. Call with the lock held.
+
+        :param int track_id: id of the track
+        :return: row index or None
+        """
+        if self.id_to_row is not None:
+            return self.id_to_row.get(track_id)
+
+        row = int(np.searchsorted(self.track_ids[:self.size], track_id))
+        if row < self.size and self.track_ids[row] == track_id:
+            return row
+        return None
+
+    def get_row(self, track_id):
+        """Return the matrix row of a track. Call with the lock held.
+
+        :param int track_id: id of the track
+        :return: row index
+        """
+        row = self.find_row(track_id)
+        if row is None or not self.alive[row]:
+            raise Exception('Invalid track id or track not found.')
+        return row
+
+    def snapshot(self, copy_alive=True):
+        """Return a consistent view of the used part of the matrix. Call with the lock held.
+
+        Writes swap the arrays when they grow or get compacted, readers work on the arrays they got here.
+
+        :param bool copy_alive: return a copy of the alive mask instead of a view that later writes change.
+        :return: tuple(matrix, track_ids, alive mask)
+        """
+        alive = self.alive[:self.size]
+        return self.matrix[:self.size], self.track_ids[:self.size], alive.copy() if copy_alive else alive
+
+    def top_k(self, track_id, k, probes=None):
+        """Get the k tracks most similar to a track, the track itself is never part of the result.
+
+        With an approximate index (see set_index) only the rows in the closest lists are scanned.
+
+        :param int track_id: id of the track to get recommendations for
+        :param int k: how many recommendations to return
+        :param int probes: lists to scan with an approximate index. Default value: self.probes
+        :return: tuple(np.array of track ids, np.array of cosine similarities), best match first
+        """
+        with self.lock:
+            row = self.get_row(track_id)
+            index = self.index
+            matrix, track_ids, alive = self.snapshot(copy_alive=index is None)
+
+        if index is not None:
+            rows, scores = index.search(matrix, alive, row, k, probes or self.probes)
+            return track_ids[rows], scores
+
+        scores = matrix @ matrix[row]
+        alive[row] = False
+        scores[~alive] = -np.inf
+        return self.select_top_k(scores, k, int(alive.sum()), track_ids)
+
+    def top_k_batch(self, track_ids, k, max_chunk_bytes=64 * 1024 * 1024):
+        """Get the k most similar tracks for many tracks at once.
+
+        The similarities are computed as matrix-matrix products over chunks of the requested tracks, a chunk
+        holds at most max_chunk_bytes of scores so memory stays bounded however many tracks are requested.
+        With an approximate index every track is searched in the index instead.
+
+        :param list track_ids: ids of the tracks to get recommendations for
+        :param int k: how many recommendations to return per track
+        :param int max_chunk_bytes: memory budget for the scores of one chunk
+        :return: list with a tuple(np.array of track ids, np.array of scores) per requested track,
+                 None for tracks that do not exist
+        """
+        if self.index is not None:
+            results = []
+            for track_id in track_ids:
+                try:
+                    results.append(self.top_k(track_id, k))
+                except Exception:
+                    results.append(None)
+            return results
+
+        with self.lock:
+            rows = [self.find_row(track_id) for track_id in track_ids]
+            rows = [row if row is not None and self.alive[row] else None for row in rows]
+            matrix, ids, alive = self.snapshot()
+
+        results = [None] * len(rows)
+        valid = [i for i, row in enumerate(rows) if row is not None]
+        k = min(k, int(alive.sum()) - 1)
+
+        chunk_size = max(1, max_chunk_bytes // max(1, 4 * len(matrix)))
+        for start in range(0, len(valid), chunk_size):
+            chunk = valid[start:start + chunk_size]
+            chunk_rows = np.array([rows[i] for i in chunk])
+
+            scores = matrix[chunk_rows] @ matrix.T
+            scores[:, ~alive] = -np.inf
+            # The requested tracks are never their own recommendation.
+            scores[np.arange(len(chunk)), chunk_rows] = -np.inf
+
+            # k is at most the number of live rows minus one, so it is always smaller than the row count.
+            if k <= 0:
+                best = np.zeros((len(chunk), 0), dtype=np.int64)
+            else:
+                best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(scores, best, axis=1)
+            order = np.argsort(-best_scores, axis=1, kind='stable')
+            best = np.take_along_axis(best, order, axis=1)
+            best_scores = np.take_along_axis(best_scores, order, axis=1)
+
+            for i, result_index in enumerate(chunk):
+                results[result_index] = ids[best[i]], best_scores[i]
+
+        return results
+
+    @staticmethod
+    def select_top_k(scores, k, available, track_ids):
+        """Select the k best scores in ranked order.
+
+        :param np.array scores: similarity of every row in the matrix
+        :param int k: how many rows to select
+        :param int available: how many rows are valid candidates
+        :param np.array track_ids: track id of every row in the matrix
+        :return: tuple(np.array of track ids, np.array of scores)
+        """
+        k = min(k, available)
+        if k <= 0:
+            return track_ids[:0], scores[:0]
+
+        if k < len(scores):
+            best = np.argpartition(-scores, k - 1)[:k]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(-scores[best], kind='stable')]
+        return track_ids[best], scores[best]
+
+    def set_track(self, track):
+        """Add a new track to the matrix or overwrite the row of an existing one.
+
+        :param track: track object with an id and all the vectorized attributes
+        :return: None
+        """
+        self.set_tracks([track])
+
+    def set_tracks(self, tracks):
+        """Add new tracks to the matrix or overwrite the rows of existing ones, all under one lock.
+
+        :param list tracks: track objects (or dictionaries) with an id and all the vectorized attributes
+        :return: None
+        """
+        if self.encoder is None:
+            raise Exception('Recommendation engine has no normalization statistics, it cannot encode tracks.')
+        if not tracks:
+            return
+
+        track_ids = [track['id'] if isinstance(track, dict) else track.id for track in tracks]
+        vectors = self.normalize(np.stack([self.encoder.encode(track) for track in tracks]))
+
+        with self.lock:
+            # Rows of existing tracks -> position of their new vector.
+            overwritten = {}
+            for i, (track_id, vector) in enumerate(zip(track_ids, vectors)):
+                row = self.find_row(track_id)
+                if row is None:
+                    if self.size == len(self.matrix):
+                        self.grow()
+                    row = self.size
+                    self.size += 1
+                    self.track_ids[row] = track_id
+                    self.alive[row] = False
+                    if self.id_to_row is not None:
+                        self.id_to_row[track_id] = row
+                    elif row > 0 and self.track_ids[row - 1] >= track_id:
+                        self.index_rows()
+                else:
+                    overwritten[row] = i
+                    if not self.alive[row]:
+                        self.tombstones -= 1
+
+                self.matrix[row] = vector
+                self.alive[row] = True
+
+            # The vector of an updated track may be closer to another centroid now, searches would miss it in its
+            # old list. Searches running outside the lock keep the index they started with.
+            if self.index is not None and overwritten:
+                rows = np.fromiter(overwritten.keys(), dtype=np.int64, count=len(overwritten))
+                self.index = self.index.reassign(rows, vectors[list(overwritten.values())])
+
+    def remove_track(self, track_id):
+        """Tombstone the row of a deleted track, compacting the matrix when there are too many tombstones.
+
+        :param int track_id: id of the deleted track
+        :return: None
+        """
+        self.remove_tracks([track_id])
+
+    def remove_tracks(self, track_ids):
+        """Tombstone the rows of deleted tracks, compacting the matrix at most once.
+
+        :param list track_ids: ids of the deleted tracks
+        :return: None
+        """
+        with self.lock:
+            for track_id in track_ids:
+                row = self.find_row(track_id)
+                if row is None or not self.alive[row]:
+                    continue
+                self.alive[row] = False
+                self.tombstones += 1
+
+            if self.tombstones > self.compaction_ratio * self.size:
+                self.compact()
+
+    def grow(self):
+        """Double the capacity of the matrix, so appending tracks is amortized O(d). Call with the lock held."""
+        capacity = max(2 * len(self.matrix), 16)
+
+        matrix = np.zeros((capacity, self.matrix.shape[1]), dtype=np.float32)
+        matrix[:self.size] = self.matrix[:self.size]
+        track_ids = np.zeros(capacity, dtype=np.int64)
+        track_ids[:self.size] = self.track_ids[:self.size]
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:self.size] = self.alive[:self.size]
+
+        self.matrix, self.track_ids, self.alive = matrix, track_ids, alive
+
+    def compact(self):
+        """Drop the tombstoned rows from the matrix. Call with the lock held."""
+        keep = np.flatnonzero(self.alive[:self.size])
+
+        self.matrix = self.matrix[keep]
+        self.track_ids = self.track_ids[keep]
+        self.size = len(keep)
+        self.alive = np.ones(self.size, dtype=bool)
+        self.tombstones = 0
+        if self.id_to_row is not None:
+            self.index_rows()
+        # Searches running outside the lock keep the arrays and the index they started with, swap in new ones.
+        if self.index is not None:
+            self.index = self.index.remap(keep)
+
+    def set_index(self, index, probes=None):
+        """Use an approximate nearest neighbour index for searches.
+
+        :param IVFIndex index: index built for this matrix, None for exact searches
+        :param int probes: default number of lists to scan per search
+        :return: None
+        """
+        with self.lock:
+            self.index = index
+            if probes is not None:
+                self.probes = probes
@@ -0,0 +1,183 @@
+import time
+
+# Table of the tracks, the table of TrackModel in server.py.
+create_track_table_sql = '''
+CREATE TABLE IF NOT EXISTS "track_model" (
+  "id" INTEGER PRIMARY KEY AUTOINCREMENT,
+  "track" TEXT NOT NULL,
+  "artist" TEXT NOT NULL,
+  "danceability" REAL NOT NULL,
+  "key" INTEGER NOT NULL,
+  "instrumentalness" REAL NOT NULL,
+  "tempo" REAL NOT NULL,
+  "duration_ms" INTEGER NOT NULL,
+  "popularity" INTEGER NOT NULL,
+  "decade" TEXT NOT NULL
+)
+'''
+
+# Columns of a track besides its id, in table order.
+track_columns = ['track', 'artist', 'danceability', 'key', 'instrumentalness', 'tempo', 'duration_ms', 'popularity',
+                 'decade']
+
+# Columns the track list can be sorted and filtered by. Every index ends with id, the tiebreaker of the sort.
+indexed_columns = ['track', 'artist', 'danceability', 'key', 'instrumentalness', 'tempo', 'duration_ms',
+                   'popularity', 'decade']
+
+# Full-text index over the names of tracks and artists. It is an external content table: it stores only the
+# index and reads the text from track_model. The triggers keep it in sync with every insert, update and delete.
+create_search_table_sql = [
+    '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS track_search USING fts5(
+      track, artist, content='track_model', content_rowid='id'
+    )
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS track_search_insert AFTER INSERT ON track_model BEGIN
+      INSERT INTO track_search(rowid, track, artist) VALUES (new.id, new.track, new.artist);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS track_search_delete AFTER DELETE ON track_model BEGIN
+      INSERT INTO track_search(track_search, rowid, track, artist) VALUES ('delete', old.id, old.track, old.artist);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS track_search_update AFTER UPDATE ON track_model BEGIN
+      INSERT INTO track_search(track_search, rowid, track, artist) VALUES ('delete', old.id, old.track, old.artist);
+      INSERT INTO track_search(rowid, track, artist) VALUES (new.id, new.track, new.artist);
+    END
+    '''
+]
+
+
+# Version of the track catalog, one row. TrackDAO bumps it in the transaction of every write, so all server
+# processes agree on it and can answer conditional requests (ETag and Last-Modified) without reading tracks.
+create_version_table_sql = '''
+CREATE TABLE IF NOT EXISTS catalog_version (
+  "id" INTEGER PRIMARY KEY CHECK ("id" = 1),
+  "version" INTEGER NOT NULL,
+  "modified" REAL NOT NULL
+)
+'''
+
+# Tracks changed by every catalog version, written in the transaction of the write. The other server processes read
+# it to update their recommendation matrix, old versions are pruned (see TrackDAO.catalog_change_versions).
+create_change_table_sql = [
+    '''
+    CREATE TABLE IF NOT EXISTS catalog_change (
+      "version" INTEGER NOT NULL,
+      "track_id" INTEGER NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS ix_catalog_change_version ON catalog_change (version)'
+]
+
+
+def create_track_table(conn):
+    """
+    Create the track table if it does not exist.
+
+    :param conn: sqlite3 connection (or any DB-API connection to a SQLite database)
+    :return: None
+    """
+    conn.cursor().execute(create_track_table_sql)
+    conn.commit()
+
+
+def create_indexes(conn, commit=True):
+    """
+    Create the indexes used for sorting and filtering the track list.
+
+    :param conn: sqlite3 connection (or any DB-API connection to a SQLite database)
+    :param bool commit: commit the changes, False leaves them to the transaction of the caller
+    :return: None
+    """
+    c = conn.cursor()
+    for column in indexed_columns:
+        c.execute(f'CREATE INDEX IF NOT EXISTS ix_track_model_{column} ON track_model ("{column}", id)')
+    if commit:
+        conn.commit()
+
+
+def create_search_table(conn, commit=True):
+    """
+    Create the full-text search table and its triggers, index the existing tracks if the table is new.
+
+    :param conn: sqlite3 connection (or any DB-API connection to a SQLite database)
+    :param bool commit: commit the changes, False leaves them to the transaction of the caller
+    :return: None
+    """
+    c = conn.cursor()
+    c.execute("SELECT 1 FROM sqlite_master WHERE name = 'track_search'")
+    exists = c.fetchone() is not None
+
+    for sql in create_search_table_sql:
+        c.execute(sql)
+    if not exists:
+        c.execute("INSERT INTO track_search(track_search) VALUES ('rebuild')")
+    if commit:
+        conn.commit()
+
+
+def create_version_table(conn, commit=True):
+    """
+    Create the catalog version table, starting at version 1 modified now.
+
+    :param conn: sqlite3 connection (or any DB-API connection to a SQLite database)
+    :param bool commit: commit the changes, False leaves them to the transaction of the caller
+    :return: None
+    """
+    c = conn.cursor()
+    c.execute(create_version_table_sql)
+    c.execute('INSERT OR IGNORE INTO catalog_version (id, version, modified) VALUES (1, 1, ?)', (time.time(),))
+    if commit:
+        conn.commit()
+
+
+def create_change_table(conn, commit=True):
+    """
+    Create the table of the tracks changed by every catalog version.
+
+    :param conn: sqlite3 connection (or any DB-API connection to a SQLite database)
+    :param bool commit: commit the changes, False leaves them to the transaction of the caller
+    :return: None
+    """
+    c = conn.cursor()
+    for sql in create_change_table_sql:
+        c.execute(sql)
+    if commit:
+        conn.commit()
+
+
+def drop_indexes(conn):
+    """
+    Drop the track list indexes, for example to speed up large imports.
+
+    :param conn: sqlite3 connection (or any DB-API connection to a SQLite database)
+    :return: None
+    """
+    c = conn.cursor()
+    for column in indexed_columns:
+        c.execute(f'DROP INDEX IF EXISTS ix_track_model_{column}')
+    conn.commit()
+
+
+def migrate(conn, commit=True):
+    """
+    Bring an existing database up to date: indexes, full-text search table, catalog version and change log. Safe to
+    run repeatedly.
+
+    :param conn: sqlite3 connection (or any DB-API connection to a SQLite database)
+    :param bool commit: commit the changes, False leaves them to the transaction of the caller
+    :return: None
+    """
+    create_indexes(conn, commit=False)
+    create_search_table(conn, commit=False)
+    create_version_table(conn, commit=False)
+    create_change_table(conn, commit=False)
+    # Let the query planner know about the new indexes.
+    conn.cursor().execute('ANALYZE')
+    if commit:
+        conn.commit()
+
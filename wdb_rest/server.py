@@ -1,28 +1,81 @@
-import json
-from flask import Flask, send_from_directory, Markup, render_template, request, g
-from flask_restful import Api, Resource, marshal_with, fields, reqparse
+import csv
+import io
+from functools import wraps
+from flask import Flask, send_from_directory, Markup, render_template, request, g, make_response, Response, \
+    stream_with_context
+from flask_restful import Api, Resource, marshal, marshal_with, fields, reqparse
+from flask_restful.utils import unpack
 from flask_sqlalchemy import SQLAlchemy
 import os
-import requests
+import threading
+import time
+from werkzeug.http import http_date
 
+from wdb_rest import metrics, profiling
+from wdb_rest.config import default_engine_options, default_sqlite_pragmas, load_config, set_sqlite_pragmas
 from wdb_rest.data import TrackDAO
+from wdb_rest.json_encoders import dumps
+from wdb_rest.schema import create_change_table, create_version_table
 
 # Create the application.
 app = Flask(__name__)
 # API(app) instance to indicate that this is a REST API.
 api = Api(app)
 
-# Give SQLite information to SQLAlchemy and link the db instance.
+# Give SQLite information to SQLAlchemy and link the db instance. Relative SQLite paths start in the instance folder.
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///../database.db'
+# Options of the SQLAlchemy engine, e.g. pool_size of a server database. They override the defaults for the URI.
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {}
+# Connections kept open to a SQLite database file, shared by the request threads.
+app.config['sqlite_pool_size'] = 10
+# Pragmas run on every new SQLite connection, see wdb_rest/config.py.
+app.config['sqlite_pragmas'] = dict(default_sqlite_pragmas)
 app.config["columns_to_be_vectorized"] = ["danceability", "key", "instrumentalness", "tempo", "duration_ms",
             "popularity", "decade"]
-app.config["recommendation_matrix"] = None
-app.config["recommendation_matrix_path"] = "./recommendation_matrix.npy"
+app.config["recommendation_matrix_path"] = "./recommendation_matrix.bin"
+# 'exact' (brute force), 'ivf' (approximate index) or 'auto' (index for catalogs with at least index_min_tracks).
+app.config["recommendation_index"] = "auto"
+app.config["recommendation_index_min_tracks"] = 100000
+# Lists scanned per search with the approximate index, more probes give better recall but slower searches.
+app.config["recommendation_index_probes"] = 8
+# Recommendation results are cached per track for recommendation_cache_ttl seconds, writes clear the cache.
+app.config["recommendation_cache_size"] = 10000
+app.config["recommendation_cache_ttl"] = 300
+# Number of tracks per filter of the track list, cached until the next write.
+app.config["count_cache_size"] = 1000
+app.config["count_cache_ttl"] = 300
+# Track reads carry an ETag and Last-Modified of the catalog version, clients revalidate before reusing them.
+app.config["cache_control"] = "no-cache"
+
+# Profile single requests that ask for it with the profiling_header (or ?profile=1): summary in response headers,
+# pstats and SQL trace saved to profiling_dir if set. Off by default, disabled profiling costs nothing.
+app.config["profiling"] = False
+app.config["profiling_header"] = "X-Profile"
+app.config["profiling_dir"] = None
+# Functions and SQL statements listed in the summary headers, functions ordered by 'cumulative' or 'tottime'.
+app.config["profiling_top"] = 10
+app.config["profiling_sort"] = "cumulative"
+
+# Metrics are recorded per process. With several worker processes each one writes a snapshot of its metrics to
+# metrics_dir every metrics_interval seconds and /metrics merges them, gunicorn.conf.py sets the directory.
+app.config["metrics_dir"] = None
+app.config["metrics_interval"] = 1.0
+
+# Flask-RESTful answers exceptions of API resources itself ({"message": "Internal Server Error"}) unless they
+# propagate, in debug mode they always do. Let them propagate to handle_exception in production too.
+app.config['PROPAGATE_EXCEPTIONS'] = True
+
+# Override the defaults above from the WDB_REST_CONFIG file and WDB_REST_* environment variables.
+load_config(app.config)
+
+db = SQLAlchemy(app, engine_options=default_engine_options(app.config['SQLALCHEMY_DATABASE_URI'],
+                                                           app.config['sqlite_pool_size']))
+with app.app_context():
+    set_sqlite_pragmas(db.engine, app.config['sqlite_pragmas'])
+    metrics.instrument_engine(db.engine)
+    if app.config["profiling"]:
+        profiling.instrument(db.engine, db.session)
 
-db = SQLAlchemy(app)
-
-# Base URL for the endpoints.
-default_url = 'http://127.0.0.1:5000/'
 
 class TrackModel(db.Model):
     """
@@ -65,11 +118,218 @@ track_put_args.add_argument('duration_ms', type=float, help='Duration is require
 track_put_args.add_argument('popularity', type=int, help='Popularity is required.', required=True)
 track_put_args.add_argument('decade', type=str, help='Decade is required.', required=True)
 
+# Parse the body of batch recommendation requests.
+batch_recommendation_args = reqparse.RequestParser()
+batch_recommendation_args.add_argument('track_ids', type=int, action='append', location='json',
+                                       help='List of track ids is required.', required=True)
+batch_recommendation_args.add_argument('how_many_recommendations', type=int, location='json', default=10)
+
+
+def json_value(value):
+    """Keep a JSON value as it is."""
+    return value
+
+
+# Parse the body of bulk write requests. The tracks are validated one by one by the data access object, an invalid
+# track gets its own 400 result instead of failing the whole request.
+bulk_track_args = reqparse.RequestParser()
+bulk_track_args.add_argument('tracks', type=json_value, action='append', location='json',
+                             help='List of tracks is required.', required=True)
+bulk_delete_args = reqparse.RequestParser()
+bulk_delete_args.add_argument('track_ids', type=int, action='append', location='json',
+                              help='List of track ids is required.', required=True)
+
+# Most tracks accepted by a single batch recommendation request.
+max_batch_recommendation_tracks = 1000
+
 # Create Track data access object for communicating with the database.
-track_dao = TrackDAO(db, TrackModel)
+track_dao = TrackDAO(db, TrackModel, app.config["recommendation_cache_size"],
+                     app.config["recommendation_cache_ttl"], app.config["count_cache_size"],
+                     app.config["count_cache_ttl"], track_fields=track_fields)
+
+
+# Hits, misses, hit ratio and size of the caches of the data access object, read when the metrics are rendered.
+def cache_stats(stat):
+    return {(name,): cache.stats()[stat]
+            for name, cache in (('recommendation', track_dao.recommendation_cache), ('count', track_dao.count_cache))}
+
+metrics.CallbackMetric('wdb_cache_hits_total', 'Cache lookups that found a value.', 'counter',
+                       lambda: cache_stats('hits'), ['cache'])
+metrics.CallbackMetric('wdb_cache_misses_total', 'Cache lookups that found nothing.', 'counter',
+                       lambda: cache_stats('misses'), ['cache'])
+# Computed from the summed hits and misses, one series for all worker processes.
+metrics.Ratio('wdb_cache_hit_ratio', 'Share of the cache lookups that found a value.', 'wdb_cache_hits_total',
+              'wdb_cache_misses_total', ['cache'])
+metrics.CallbackMetric('wdb_cache_size', 'Entries in the cache.', 'gauge', lambda: cache_stats('size'), ['cache'])
+
+
+def start_metrics_export():
+    """
+    Start writing the metric snapshots of a worker process forked from the master, see metrics_dir.
+
+    The counters the worker inherited from the warm-up in the master are cleared, the master's snapshot holds them.
+    """
+    metrics.default_registry.reset()
+    for cache in (track_dao.recommendation_cache, track_dao.count_cache):
+        with cache.lock:
+            cache.hits = cache.misses = 0
+    metrics.default_registry.start_export(app.config["metrics_dir"], app.config["metrics_interval"])
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    metrics.requests_in_flight.inc()
+    metrics.start_request_sql()
+
+
+# Endpoints that do not read tracks.
+endpoints_without_tracks = {'readiness', 'prometheus_metrics', 'favicon', 'static'}
+
+
+@app.before_request
+def sync_catalog():
+    # Every worker process keeps its own recommendation engine and caches, catch up with the writes of the others.
+    if request.endpoint not in endpoints_without_tracks:
+        track_dao.sync_catalog()
+
+
+@app.after_request
+def record_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def record_request_metrics(exception):
+    """Record latency, status and SQL statements of the request, once the response is sent (or streamed)."""
+    if 'request_start' not in g:
+        return
+    endpoint = request.endpoint or 'unknown'
+    metrics.requests_in_flight.dec()
+    metrics.request_duration_seconds.observe(time.perf_counter() - g.request_start, endpoint=endpoint,
+                                             method=request.method)
+    metrics.requests_total.inc(endpoint=endpoint, method=request.method, status=g.get('response_status', 500))
+    metrics.request_sql_statements.observe(metrics.request_sql(), endpoint=endpoint)
+
+
+def start_profile():
+    if request.headers.get(app.config["profiling_header"]) or request.args.get('profile'):
+        g.profile_requested = True
+        profiling.start()
+
+
+def finish_profile(response):
+    """Add the profile summary of a profiled request to its response, save the profile if configured."""
+    if not g.get('profile_requested'):
+        return response
+    profile = profiling.stop()
+    if profile is None:
+        response.headers[app.config["profiling_header"]] = 'busy'
+        return response
+
+    response.headers.extend(profile.summary_headers(app.config["profiling_top"], app.config["profiling_sort"]))
+    if app.config["profiling_dir"]:
+        path = profile.dump(app.config["profiling_dir"], request.endpoint or 'unknown')
+        response.headers['X-Profile-Dump'] = os.path.basename(path)
+    return response
+
+
+def discard_profile(exception):
+    # The profile of a request that failed before its response was finished.
+    profiling.stop()
+
+
+# Hooks are only installed if profiling is enabled, so that other servers do not run them.
+if app.config["profiling"]:
+    app.before_request(start_profile)
+    app.after_request(finish_profile)
+    app.teardown_request(discard_profile)
+
+
+# Concurrent first requests must not build the recommendation matrix more than once.
+recommendation_engine_lock = threading.Lock()
+
+
+def get_recommendation_engine():
+    """Return the recommendation engine, loading or building the recommendation matrix on first use."""
+    if track_dao.recommendation_engine is not None:
+        return track_dao.recommendation_engine
+
+    with recommendation_engine_lock:
+        if track_dao.recommendation_engine is None:
+            track_dao.set_recommendation_matrix(
+                app.config["recommendation_matrix_path"],
+                app.config["columns_to_be_vectorized"],
+                index_mode=app.config["recommendation_index"],
+                index_min_tracks=app.config["recommendation_index_min_tracks"],
+                index_probes=app.config["recommendation_index_probes"]
+            )
+    return track_dao.recommendation_engine
+
+
+# Set once warm_up has finished, the /ready endpoint reports it to load balancers and orchestrators.
+ready = threading.Event()
+
+
+def warm_up():
+    """
+    Prepare the server for traffic: create the catalog version and the change log if missing, load (or build) the
+    recommendation matrix and fill the caches of the first track list pages, then report ready. Run before forking
+    the workers of a WSGI server, so they start warm and share the loaded memory copy-on-write.
+    """
+    with app.app_context():
+        # Every request reads the catalog version, create it and the change log in databases that were not migrated
+        # yet (see migrate_db.py for the indexes and the search table).
+        conn = db.engine.raw_connection()
+        try:
+            create_version_table(conn)
+            create_change_table(conn)
+        finally:
+            conn.close()
+        get_recommendation_engine()
+        # Counts the whole catalog, the total of every unfiltered page.
+        track_dao.get_tracks_list()
+    ready.set()
+
+
+def clamp_how_many_recommendations(how_many_recommendations):
+    """Limit the number of recommendations per track to 1-100."""
+    return min(max(how_many_recommendations, 1), 100)
+
+
+def conditional(method):
+    """
+    Answer GET requests for an unchanged catalog with 304 Not Modified.
+
+    The ETag is the catalog version, Last-Modified the time of the last write. Both are read before the method
+    runs, so a write during the request makes the response look older, never newer, than its data. When the
+    validators of the request still match, the method is not called and no other query runs.
+    """
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        version, modified = track_dao.get_catalog_version()
+        headers = {'ETag': f'W/"{version}"', 'Last-Modified': http_date(modified),
+                   'Cache-Control': app.config['cache_control']}
+
+        # If-None-Match takes precedence over If-Modified-Since.
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains_weak(str(version))
+        else:
+            not_modified = request.if_modified_since is not None \
+                           and int(modified) <= request.if_modified_since.timestamp()
+        if not_modified:
+            return Response(status=304, headers=headers)
+
+        data, code, response_headers = unpack(method(*args, **kwargs))
+        if code == 200:
+            response_headers = dict(headers, **(response_headers or {}))
+        return data, code, response_headers
+    return wrapper
 
 
 class TrackList(Resource):
+    method_decorators = [conditional]
 
     @marshal_with(track_fields)
     def get_trackmodel(self, track):
@@ -83,39 +343,131 @@ class TrackList(Resource):
 
         filter_field = request.args.get('filter_field', type=str)
         filter_value = request.args.get('filter_value', type=str)
+        # Word prefix search on track and artist names through the full-text index.
+        search = request.args.get('search', type=str)
+
+        # Cursor pagination, an empty cursor requests the first page.
+        cursor = request.args.get('cursor', type=str)
+        # Callers that do not need tracks_iter can skip counting the matching tracks.
+        with_total = request.args.get('with_total', type=str, default='true').lower() not in ['false', '0', 'no']
 
-        result = track_dao.get_tracks_list(filter_field, filter_value, sort_field, sort_order, page)
+        result = track_dao.get_tracks_list(filter_field, filter_value, sort_field, sort_order, page, cursor,
+                                           with_total, search)
 
         return result, 200
 
 
+class TrackExport(Resource):
+
+    def get(self):
+        export_format = request.args.get('format', type=str, default='ndjson')
+        if export_format not in export_formats:
+            return {'msg': f'Provided format {export_format} is invalid. Use ndjson or csv.'}, 400
+
+        batches = track_dao.export_tracks(request.args.get('filter_field', type=str),
+                                          request.args.get('filter_value', type=str),
+                                          request.args.get('sort_field', type=str, default='id'),
+                                          request.args.get('sort_order', type=str, default='asc'),
+                                          request.args.get('search', type=str))
+
+        encode, mimetype = export_formats[export_format]
+        # The database is read batch by batch while the response is sent.
+        return Response(stream_with_context(encode(batches)), mimetype=mimetype)
+
+
+def encode_ndjson(batches):
+    """Encode batches of tracks as one JSON object per line."""
+    for tracks in batches:
+        yield b''.join(dumps(track) + b'\n' for track in tracks)
+
+
+def encode_csv(batches):
+    """Encode batches of tracks as CSV with a header line."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(track_dao.serializer.names)
+    for tracks in batches:
+        writer.writerows(track.values() for track in tracks)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # No tracks, only the header.
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+# Encoder and mimetype of every export format.
+export_formats = {'ndjson': (encode_ndjson, 'application/x-ndjson'), 'csv': (encode_csv, 'text/csv')}
+
+
 class Recommender(Resource):
+    method_decorators = [conditional]
 
     def __init__(self):
-        if app.config["recommendation_matrix"] is None:
-            app.config["recommendation_matrix"] = track_dao.set_recommendation_matrix(
-                app.config["recommendation_matrix_path"],
-                app.config["columns_to_be_vectorized"]
-            )
+        get_recommendation_engine()
 
     @marshal_with(track_fields)
     def get(self, track_id):
 
         try:
             how_many_recommendations = request.args.get('how_many_recommendations', 10, type=int)
-            if how_many_recommendations > 100:
-                how_many_recommendations = 100
-            if how_many_recommendations < 1:
-                how_many_recommendations = 1
+            how_many_recommendations = clamp_how_many_recommendations(how_many_recommendations)
         except:
             how_many_recommendations = 10
 
         result = track_dao.get_track_recommendations(track_id, how_many_recommendations,
-                                                     app.config["recommendation_matrix"])
+                                                     get_recommendation_engine())
+        return result, 200
+
+
+class BatchRecommender(Resource):
+
+    def __init__(self):
+        get_recommendation_engine()
+
+    def post(self):
+        args = batch_recommendation_args.parse_args()
+        track_ids = args['track_ids']
+        if len(track_ids) > max_batch_recommendation_tracks:
+            return {'msg': f'At most {max_batch_recommendation_tracks} track ids per request.'}, 400
+
+        how_many_recommendations = clamp_how_many_recommendations(args['how_many_recommendations'])
+
+        recommendations = track_dao.get_batch_track_recommendations(track_ids, how_many_recommendations,
+                                                                    get_recommendation_engine())
+
+        result = []
+        for track_id, tracks in zip(track_ids, recommendations):
+            if tracks is None:
+                result.append({'track_id': track_id, 'msg': 'Invalid track id or track not found.'})
+            else:
+                result.append({'track_id': track_id, 'recommendations': marshal(tracks, track_fields)})
         return result, 200
 
 
+class TrackBulk(Resource):
+
+    def put(self):
+        tracks = bulk_track_args.parse_args()['tracks']
+        if len(tracks) > track_dao.max_bulk_tracks:
+            return {'msg': f'At most {track_dao.max_bulk_tracks} tracks per request.'}, 400
+        return track_dao.create_tracks(tracks), 200
+
+    def patch(self):
+        tracks = bulk_track_args.parse_args()['tracks']
+        if len(tracks) > track_dao.max_bulk_tracks:
+            return {'msg': f'At most {track_dao.max_bulk_tracks} tracks per request.'}, 400
+        return track_dao.update_tracks(tracks), 200
+
+    def delete(self):
+        track_ids = bulk_delete_args.parse_args()['track_ids']
+        if len(track_ids) > track_dao.max_bulk_tracks:
+            return {'msg': f'At most {track_dao.max_bulk_tracks} track ids per request.'}, 400
+        return track_dao.delete_tracks(track_ids), 200
+
+
 class Track(Resource):
+    method_decorators = {'get': [conditional]}
 
     @marshal_with(track_fields)
     def put(self, track_id):
@@ -139,10 +491,22 @@ class Track(Resource):
         return {}, 200
 
 
+@api.representation('application/json')
+def output_json(data, code, headers=None):
+    """Encode API responses in a single pass, with orjson when it is installed."""
+    response = make_response(dumps(data), code)
+    response.headers.extend(headers or {})
+    response.content_type = 'application/json'
+    return response
+
+
 # Define the type of parameters to pass
 api.add_resource(Track, '/api/track/<int:track_id>')
 api.add_resource(TrackList, '/api/tracks/')
+api.add_resource(TrackExport, '/api/tracks/export/')
+api.add_resource(TrackBulk, '/api/tracks/bulk/')
 api.add_resource(Recommender, '/api/recommendation/<int:track_id>/')
+api.add_resource(BatchRecommender, '/api/recommendations/')
 
 
 @app.route('/')
@@ -153,24 +517,34 @@ def index():
 
 @app.route('/alltracks/')
 def alltracks():
-    page = request.args.get('page')
-    if page is None:
-        page = 1
-    r = requests.get(default_url + 'api/tracks/' + '?page=' + str(page))
-    response = r.json()
-    # Response["items"] is jsonified in the api call and jsonified here again, maybe this is bad
-    response["items"] = json.loads(response["items"])
-    return render_template('tracks.html', pagination=response)
+    page = request.args.get('page', 1, type=int)
+    # Read through the data access object, the page costs no extra HTTP request.
+    pagination = track_dao.get_tracks_list(page=page)
+    return render_template('tracks.html', pagination=pagination)
 
 @app.route('/recommendation/', methods=["GET", "POST"])
 def recommend_form():
     if request.method == 'POST':
-        title = request.form
-        r = requests.get(default_url + 'api/recommendation/' + str(title["track_id"]) + "/10")
-        response = r.json()
-        return response
+        track_id = request.form.get('track_id', type=int)
+        if track_id is None:
+            raise Exception('Invalid track id or track not found.')
+        tracks = track_dao.get_track_recommendations(track_id, 10, get_recommendation_engine())
+        return marshal(tracks, track_fields)
     return render_template('recommendation.html')
 
+@app.route('/ready')
+def readiness():
+    # 503 until warm-up is complete, so no traffic is sent to a cold server.
+    if not ready.is_set():
+        return {'ready': False}, 503
+    return {'ready': True}, 200
+
+@app.route('/metrics')
+def prometheus_metrics():
+    # Metrics in the Prometheus text format, of all worker processes if they share a metrics_dir.
+    return Response(metrics.default_registry.render(app.config["metrics_dir"]),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/favicon.ico')
 def favicon():
     return send_from_directory(os.path.join(app.root_path, 'static'),
@@ -182,4 +556,8 @@ def handle_exception(e):
     return {'msg': str(e)}, 500
 
 if __name__ == '__main__':
+    # Development server, for production use gunicorn (see gunicorn.conf.py). The debug reloader runs this module in
+    # two processes, only the one serving requests warms up, in the background.
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        threading.Thread(target=warm_up, daemon=True).start()
     app.run(debug=True, host='0.0.0.0') # To enable docker access
\ No newline at end of file
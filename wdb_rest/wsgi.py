@@ -0,0 +1,22 @@
+import gc
+
+from wdb_rest.server import app, db, warm_up
+
+
+def create_app():
+    """
+    Application factory for WSGI servers, returns the warmed up application.
+
+    With gunicorn's preload_app it runs once in the master process: the recommendation matrix and the caches are
+    loaded there and the forked workers share them copy-on-write.
+
+    :return: Flask application
+    """
+    warm_up()
+    # Database connections must not be shared by forked processes, every worker opens its own.
+    with app.app_context():
+        db.engine.dispose()
+    # Move everything loaded so far out of the garbage collector's reach, so collections in the workers do not
+    # touch (and copy) the pages shared with the master.
+    gc.freeze()
+    return app